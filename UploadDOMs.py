@@ -4,219 +4,809 @@
 # John Jacobsen, NPX Designs, Inc., john@mail.npxdesigns.com
 # Started: Fri Oct 26 18:12:39 2007
 
-import unittest, optparse, re, time, threading, os, os.path, random
-import gzip, select, signal, re, md5
+import unittest, optparse, re, time, os, os.path, random, sys
+import gzip, select, signal, re, md5, tempfile
 
 from domapptools.dor import *
 from domapptools.exc_string import exc_string
 from domapptools.domapp import *
 from domapptools.MiniDor import *
+from domapptools.decode_dom_buffer import printable_string
 
 def stripCR(s):
     return re.sub('\r',' ',re.sub('\n', ' ', s))
 
+class UploadFailure(Exception): pass
+
+def formatETA(sec):
+    if sec is None: return "unknown"
+    return "%dm%02ds" % (int(sec) / 60, int(sec) % 60)
+
+def icebootBuild(txt):
+    "Build number from the iceboot banner in txt, or None"
+    m = re.search('Iceboot.+?build (\d+)\.', txt)
+    if not m: return None
+    return m.group(1)
+
+# Actions yielded by the DOMUpload stage generators and carried out by the
+# Uploader event loop
+
+class Sleep:
+    "Wait without blocking the other DOMs"
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class Exchange:
+    """
+    Send text, then read until the regex expect matches what the DOM has
+    sent back (which the stage gets back from its yield) within timeoutMsec
+    """
+    def __init__(self, send, expect, timeoutMsec):
+        self.send    = send
+        self.pattern = expect
+        self.expect  = re.compile(expect, re.S)
+        self.timeout = timeoutMsec
+
+class Stream:
+    "Write the whole release image to the DOM"
+    stallTimeout = 30 # Seconds without any bytes accepted before giving up
+
+class Acquire:
+    "Wait until the Uploader's scheduler gives the DOM a streaming slot"
+
+class RetryPolicy:
+    """
+    How often a stage is tried, and where a retry starts over: restart is
+    the stage to go back to (None for the failed stage itself).  Retries
+    wait delay seconds, multiplied by factor after every failure of the
+    stage, up to maxDelay.
+    """
+    def __init__(self, trials=1, restart=None, delay=1., factor=2., maxDelay=60.):
+        self.trials   = trials
+        self.restart  = restart
+        self.delay    = delay
+        self.factor   = factor
+        self.maxDelay = maxDelay
+
+    def backoff(self, failures):
+        "Delay before the retry after the given number of failures"
+        return min(self.maxDelay, self.delay * self.factor**(failures-1))
+
+    def copy(self, trials=None, delay=None):
+        if trials is None: trials = self.trials
+        if delay is None: delay = self.delay
+        return RetryPolicy(trials, self.restart, delay, self.factor, self.maxDelay)
+
+# Stage name, DOMUpload method, retry policy.  Once data is in DOM memory a
+# failure starts over from SOFTBOOT1, since what's in memory can't be
+# trusted any more; a failed flash write is never retried automatically.
+STAGES = (("PROBE",          "probe",         RetryPolicy(3)),
+          ("SOFTBOOT1",      "softboot1",     RetryPolicy(5)),
+          ("ISET",           "iset",          RetryPolicy(2, "SOFTBOOT1")),
+          ("READ_BIN",       "readBin",       RetryPolicy(2, "SOFTBOOT1")),
+          ("STREAM",         "stream",        RetryPolicy(2, "SOFTBOOT1")),
+          ("CHECK_ICEBOOT2", "checkIceboot2", RetryPolicy(2, "SOFTBOOT1")),
+          ("CHECK_STACK",    "checkStack",    RetryPolicy(2, "SOFTBOOT1")),
+          ("CHECK_MD5SUM",   "checkMd5sum",   RetryPolicy(2, "SOFTBOOT1")),
+          ("GUNZIP",         "gunzip",        RetryPolicy(2, "SOFTBOOT1")),
+          ("INSTALL",        "install",       RetryPolicy(1)),
+          ("SOFTBOOT2",      "softboot2",     RetryPolicy(3)),
+          ("CHECK_VERSION",  "checkVersion",  RetryPolicy(3, "SOFTBOOT2")))
+
+# Stages after which a new invocation can pick up a DOM again: the flash is
+# written, so only the version check is left.  It is always done again,
+# since the DOM may have been swapped or reflashed since.
+RESUME_AFTER = { "INSTALL" : "SOFTBOOT2", "SOFTBOOT2" : "SOFTBOOT2",
+                 "CHECK_VERSION" : "SOFTBOOT2" }
+
+UPLOAD_STAGES = ("READ_BIN", "STREAM", "CHECK_ICEBOOT2", "CHECK_STACK",
+                 "CHECK_MD5SUM", "GUNZIP", "INSTALL")
+
+class DOMUpload:
+    """
+    State machine for one DOM: the stage it is in, the action that stage
+    is waiting on, and the bytes in flight.  Each stage is a generator
+    method; the Uploader calls readable(), writable() and tick() when
+    the DOM's fd is ready or a deadline passes, and the stage is resumed
+    once its action completes.
+    """
+    def __init__(self, uploader, cwd, card, pair, aorb):
+        self.up      = uploader
+        self.cwd     = cwd
+        self.dor     = MiniDor(card, pair, aorb)
+        self.fd      = None
+        self.stages  = [(name, method, uploader.policy(policy))
+                        for (name, method, policy) in STAGES if uploader.wantStage(name)]
+        self.index   = -1
+        self.failures = {} # Stage name -> failures so far
+        self.retrying = False # In the back-off before a retry
+        self.running  = None  # Stage charged with failures (the restart stage during a back-off)
+        self.gen     = None
+        self.action  = None
+        self.outbuf  = ""
+        self.inbuf   = ""
+        self.deadline = None
+        self.txbytes = 0
+        self.lastTx  = None
+        self.streamStart = None
+        self.streamEnd   = None
+        self.started = None
+        self.ended   = None
+        self.result  = None # "DONE", "FAIL", "SKIPPED", "CURRENT" or "OLD" when finished
+        self.build   = None
+        self.probedBuild = None
+        self.expectBuild = None # Build a resumed DOM should have; else uploaded again
+        self.loc     = None
+        self.length  = None
+        self.card    = card
+        self.pair    = pair
+        self.hasSlot = False # Holds one of the scheduler's streaming slots
+
+    def warn(self, m): self.up.warn(self.cwd, m)
+    def log(self, m):  self.up.log(self.cwd, m)
+
+    def stage(self):
+        if 0 <= self.index < len(self.stages): return self.stages[self.index][0]
+        return None
+
+    def open(self):
+        self.fd = os.open(self.dor.devFileName, os.O_RDWR | os.O_NONBLOCK)
+        self.dor.fd = self.fd
+
+    def close(self):
+        if self.fd is None: return
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        self.fd = None
+
+    # Driving the stages
+
+    def stageIndex(self, name):
+        for i in range(len(self.stages)):
+            if self.stages[i][0] == name: return i
+        return None
+
+    def start(self):
+        self.started = time.time()
+        last = self.up.progress.get(self.cwd, {}).get("stage")
+        if last in RESUME_AFTER:
+            resumeAt = RESUME_AFTER[last]
+            self.expectBuild = self.up.progress[self.cwd].get("build") or self.up.targetBuild
+            self.warn("RESUMING at %s" % resumeAt)
+            self.index = self.stageIndex(resumeAt) - 1
+        self.dor.commStatReset()
+        self.nextStage()
+
+    def nextStage(self):
+        if self.retrying:
+            self.retrying = False
+        elif self.index >= 0 and self.gen is not None:
+            self.up.completed(self, self.stages[self.index][0])
+        self.index += 1
+        if self.index == len(self.stages):
+            self.finish("DONE")
+            return
+        self.startStage()
+
+    def startStage(self):
+        name = self.stages[self.index][0]
+        self.running = name
+        self.up.event(self, "stage", stage=name, failures=self.failures.get(name, 0))
+        self.gen = getattr(self, self.stages[self.index][1])()
+        self.resume(None)
+
+    def retry(self, delay):
+        yield Sleep(delay)
+
+    def resume(self, value):
+        try:
+            action = self.gen.send(value)
+        except StopIteration:
+            if self.result is None: self.nextStage()
+            return
+        self.action = action
+        self.deadline = None
+        if isinstance(action, Sleep):
+            self.deadline = time.time() + action.seconds
+        elif isinstance(action, Exchange):
+            self.outbuf = action.send
+            self.inbuf  = ""
+            self.deadline = time.time() + action.timeout/1000.
+        elif isinstance(action, Stream):
+            self.pos = 0
+            self.txbytes = 0
+            self.streamStart = self.lastTx = time.time()
+            self.deadline = self.lastTx + Stream.stallTimeout
+
+    def failed(self, e):
+        """
+        Handle an exception from the current stage: retry according to the
+        stage's RetryPolicy if it has trials left, otherwise fail the DOM.
+        Either way the comstat and FPGA registers are dumped.  A failure
+        before the first stage has started fails the DOM outright.
+        """
+        if self.running is None:
+            name, policy = "START", RetryPolicy()
+        else:
+            name, method, policy = self.stages[self.stageIndex(self.running)]
+        failures = self.failures.get(name, 0) + 1
+        self.failures[name] = failures
+        snapshot = self.up.snapshot(self)
+        if failures < policy.trials and not isinstance(e, KeyboardInterrupt):
+            delay = policy.backoff(failures)
+            restart = policy.restart or name
+            self.warn("WARNING: %s failed (trial %d), retrying from %s in %.1f sec "
+                      "after exception '%s'" % (name, failures, restart, delay, stripCR(str(e))))
+            for line in snapshot.split('\n'):
+                self.warn("WARNING: "+line)
+            self.up.event(self, "retry", stage=name, failures=failures, restart=restart,
+                          delay=delay, error=stripCR(str(e)))
+            self.up.releaseSlot(self)
+            self.close()
+            # The back-off runs as a pseudo-stage just before the restart stage
+            self.index = self.stageIndex(restart) - 1
+            self.running = restart
+            self.gen = None
+            self.up.step(self, self.backoff, delay)
+            return
+        self.up.failedStage(self, name, e, snapshot)
+        if isinstance(e, KeyboardInterrupt):
+            self.warn("Interrupting...")
+        elif isinstance(e, UploadFailure):
+            self.warn(str(e))
+        elif isinstance(e, (IOError, OSError)):
+            self.warn("IOError: "+str(e))
+        elif isinstance(e, ExpectStringNotFoundException):
+            self.warn("Unexpected DOM output: "+str(e))
+        else:
+            self.warn(exc_string())
+        for line in snapshot.split('\n'):
+            self.warn("WARNING: "+line)
+        self.finish("FAIL")
+
+    def backoff(self, delay):
+        self.retrying = True
+        self.gen = self.retry(delay)
+        self.resume(None)
+
+    def finish(self, result):
+        self.result = result
+        self.ended  = time.time()
+        self.action = self.gen = None
+        self.deadline = None
+        self.up.releaseSlot(self)
+        self.close()
+        if result == "FAIL": self.warn("FAIL")
+        self.up.event(self, "result", result=result, build=self.build,
+                      elapsed=self.ended - (self.started or self.ended))
+
+    # Event handling
+
+    def pollMask(self):
+        mask = 0
+        if self.fd is None: return mask
+        if isinstance(self.action, Exchange):
+            mask |= select.POLLIN
+            if self.outbuf: mask |= select.POLLOUT
+        elif isinstance(self.action, Stream):
+            mask |= select.POLLOUT
+        return mask
+
+    def writable(self):
+        if isinstance(self.action, Stream):
+            self.writeImage()
+            return
+        while self.outbuf:
+            try:
+                nw = os.write(self.fd, self.outbuf)
+            except OSError, e:
+                if e.errno == EAGAIN: return
+                raise
+            self.outbuf = self.outbuf[nw:]
+
+    def writeImage(self):
+        "Write as many segments as the driver takes, until it would block"
+        image = self.up.image
+        seg   = self.dor.blockSize
+        pos   = self.pos
+        try:
+            while pos < len(image):
+                nw = os.write(self.fd, image[pos:pos+seg])
+                if nw <= 0: break
+                pos += nw
+                if nw < seg: break
+        except OSError, e:
+            if e.errno != EAGAIN: raise
+        if pos > self.pos:
+            self.txbytes += pos - self.pos
+            self.up.txbytes += pos - self.pos
+            self.pos = pos
+            self.lastTx = time.time()
+            self.deadline = self.lastTx + Stream.stallTimeout
+        if pos == len(image):
+            self.streamEnd = time.time()
+            self.resume(None)
+
+    def readable(self):
+        while True:
+            try:
+                buf = os.read(self.fd, self.dor.blockSize)
+            except OSError, e:
+                if e.errno == EAGAIN: break
+                raise
+            if not buf: break
+            self.inbuf += buf
+        if isinstance(self.action, Exchange) and self.action.expect.search(self.inbuf):
+            self.resume(self.inbuf)
+
+    def tick(self, now):
+        "Complete a Sleep, or time out an Exchange or a stalled Stream"
+        if self.deadline is None or now < self.deadline: return
+        a = self.action
+        if isinstance(a, Sleep):
+            self.resume(None)
+        elif isinstance(a, Exchange):
+            raise ExpectStringNotFoundException(
+                "Expected string '%s' did not arrive in %d msec: got '%s'" \
+                % (a.pattern, a.timeout, stripCR(printable_string(self.inbuf))))
+        elif isinstance(a, Stream):
+            raise WriteTimeoutException("No data accepted in %d sec (%d of %d bytes sent)" %
+                                        (Stream.stallTimeout, self.pos, len(self.up.image)))
+
+    def rate(self):
+        "Streaming rate so far, in MB/s"
+        if self.streamStart is None: return 0.
+        dt = (self.streamEnd or time.time()) - self.streamStart
+        if dt <= 0: return 0.
+        return self.txbytes / dt / 1e6
+
+    # Stages
+
+    def probe(self):
+        "Softboot to iceboot and read its build; stop here if it is already the target"
+        self.close()
+        self.log("PROBE")
+        self.dor.startSoftboot()
+        yield Sleep(MiniDor.softbootSleepTime)
+        self.open()
+        txt = yield Exchange("\r\n", ">", 100000)
+        self.probedBuild = icebootBuild(txt)
+        if self.probedBuild is None:
+            raise UploadFailure("Build number not found: %s" % stripCR(txt))
+        current = self.probedBuild == self.up.targetBuild
+        if self.up.verifyOnly:
+            self.build = self.probedBuild
+            self.warn("%s (%s)" % (current and "CURRENT" or "OLD", self.build))
+            self.finish(current and "CURRENT" or "OLD")
+        elif current:
+            self.build = self.probedBuild
+            self.warn("SKIPPED (already build %s)" % self.build)
+            self.finish("SKIPPED")
+        else:
+            self.log("PROBED (build %s)" % self.probedBuild)
+
+    def softboot1(self):
+        self.close()
+        self.log("SOFTBOOT1")
+        self.dor.startSoftboot()
+        yield Sleep(MiniDor.softbootSleepTime)
+        self.log("OPEN")
+        self.open()
+        self.log("CHECK_ICEBOOT1")
+        yield Exchange("\r", "> $", 10000)
+
+    def iset(self):
+        self.log("ISET")
+        yield Exchange("$ffffffff $01000000 $00800000 4 / iset\r\n", ">", 30000)
+
+    def readBin(self):
+        self.log("QUEUED")
+        yield Acquire()
+        self.log("READ_BIN")
+        yield Exchange("%d read-bin\r\n" % len(self.up.image), "read-bin\r\n", 30000)
+
+    def stream(self):
+        self.warn("SENDING (0%)")
+        yield Stream()
+        self.up.releaseSlot(self)
+        self.log("SENT %d bytes (%.3f MB/s)" % (self.txbytes, self.rate()))
+
+    def checkIceboot2(self):
+        # Make sure iceboot still there
+        self.log("CHECK_ICEBOOT2")
+        yield Exchange("\r", "> $", 10000)
+
+    def checkStack(self):
+        # Get location and length (last two items on stack)
+        self.log("CHECK_STACK")
+        txt = yield Exchange(".s\r", "\d+ \d+\s+> $", 10000)
+        m = re.search('(\d+) (\d+)\s+> $', txt)
+        if not m:
+            raise UploadFailure("Bad stack details '%s'!  Flash not changed." % stripCR(txt))
+        self.loc, self.length = m.group(1), m.group(2)
+
+    def checkMd5sum(self):
+        self.log("CHECK_MD5SUM")
+        txt = yield Exchange("md5sum type crlf type\r", "md5sum.+?> $", 10000)
+        m = re.search('md5sum.+?\s+(\w+)\s+> $', txt)
+        if not m:
+            raise UploadFailure("Unexpected md5sum '%s'!  Flash not changed." % stripCR(txt))
+        if self.up.md5sum != m.group(1):
+            raise UploadFailure("MD5SUM ERROR: local '%s' remote '%s'" % (self.up.md5sum,
+                                                                          m.group(1)))
+        self.log("MD5SUM (%s)" % m.group(1))
+
+    def gunzip(self):
+        # gunzip/hex-to-bin command
+        self.log("GUNZIP")
+        txt = yield Exchange("%s %s gunzip $01000000 $01000000 hex-to-bin\r" % (self.loc, self.length),
+                             "hex-to-bin\s+> $", 60000)
+        self.log("Got %s" % stripCR(txt))
+
+    def install(self):
+        # Flash the image.  Here we want to make sure there is no extra output!
+        self.warn("INSTALLING")
+        txt0 = yield Exchange("$01000000 $00400000 install-image\r",
+                              "install-image\s+install:.+?are you sure [y/n]?",
+                              10000)
+        txt1 = yield Exchange("y\r", "^y.*> $", 240000)
+        m = re.search('write ERRORS detected', txt1, re.S)
+        if m:
+            self.warn("WARNING: FLASH ERRORS\n"+stripCR(txt0+txt1))
+        m = re.search("chip 0: unlock\.\.\. erase\.\.\.\s+"+
+                      "chip 1: unlock\.\.\. erase\.\.\.\s+"+
+                      "Programming\.\.\.\s+"+
+                      "chip 0: lock\.\.\.\s+"+
+                      "chip 1: lock\.\.\.\s+> $", txt1, re.S)
+        if not m:
+            self.warn("WARNING: unexpected flash write output\n"+stripCR(txt0+txt1))
+
+    def softboot2(self):
+        self.log("SOFTBOOT2")
+        self.dor.startSoftboot()
+        yield Sleep(MiniDor.softbootSleepTime)
+        if self.fd is None: self.open() # Resumed or retried here
+
+    def checkVersion(self):
+        self.log("CHECK_VERSION")
+        txt = yield Exchange("\r\n", ">", 100000)
+        self.build = icebootBuild(txt)
+        if self.expectBuild is not None and self.build != self.expectBuild:
+            # Not what the earlier run left on this DOM: start over
+            self.warn("Build %s, not %s as left by an earlier run: UPLOADING again" %
+                      (self.build, self.expectBuild))
+            self.expectBuild = None
+            self.up.progress.pop(self.cwd, None)
+            self.up.saveProgress()
+            self.retrying = True # Don't record this stage as completed
+            self.index = -1
+            return
+        if self.build is None:
+            self.warn("WARNING: Build number not found: %s" % stripCR(txt))
+        else:
+            self.warn("DONE (%s)" % self.build)
+
+
 class Uploader:
+    """
+    Upload a release to many DOMs at once from a single poll() loop; each
+    DOM runs its own DOMUpload state machine, so one slow or stuck DOM
+    doesn't hold up the others
+    """
+    reportInterval = 10 # Seconds between progress reports
+    sampleInterval = 2  # Seconds between comstat samples of streaming DOMs
+    rateWeight     = 0.5 # Weight of the newest sample in the link rate averages
+
     def __init__(self, releaseFile, domHash, md5sum=None,
-                 verbose=False, doSkip=False, noFlash=False):
-        self.card    = {}
-        self.pair    = {}
-        self.aorb    = {}
+                 verbose=False, doSkip=False, noFlash=False,
+                 targetBuild=None, verifyOnly=False, perPair=1, perCard=0,
+                 retries=None, backoff=None, progressFile=None, fresh=False,
+                 events=None):
         self.doms    = []
-        self.txbytes = {}
+        self.txbytes = 0
         self.doSkip  = doSkip
         self.noFlash = noFlash
         self.release = releaseFile
         self.verbose = verbose
         self.md5sum  = md5sum
+        self.targetBuild = targetBuild # Build to skip DOMs at, if probing
+        self.verifyOnly  = verifyOnly  # Only probe and report builds
+        self.perPair = perPair # Concurrent streams per wire pair (0: no limit)
+        self.perCard = perCard # Concurrent streams per DOR card (0: no limit)
+        self.slots   = {}      # (card, pair) -> DOMs streaming there
+        self.linkRate = {}     # (card, pair) -> learned TX rate (bytes/sec)
+        self.lastTX  = {}      # DOM -> (time, comstat TX byte count)
+        self.retries = retries # Trials for stages that may be retried (None: per stage)
+        self.backoffDelay = backoff # First retry delay (None: per stage)
+        self.progressFile = progressFile # Per-DOM progress, for resuming (None: don't keep)
+        self.progress = {}     # DOM -> {"stage" : last completed, "build", "failure"}
+        self.events  = events  # File for JSON-lines telemetry, or None
+        self.json    = None    # json module, imported once if progress or events are kept
+        if progressFile or events:
+            import json # Python 2.6
+            self.json = json
+        if progressFile and os.path.exists(progressFile) and not fresh:
+            self.progress = self.json.load(file(progressFile))
+        self.image   = None
+        if not doSkip and not verifyOnly: self.image = file(releaseFile, "rb").read()
+        self.uploads = {}
         for d in domHash.values():
             dom = "%d%d%s" % (d[0],d[1],d[2])
             self.doms.append(dom)
-            self.card[dom] = d[0]
-            self.pair[dom] = d[1]
-            self.aorb[dom] = d[2]
+            self.uploads[dom] = DOMUpload(self, dom, d[0], d[1], d[2])
+        self.doms.sort()
 
         if self.verbose:
             print "Uploading", releaseFile, "to",
             for d in self.doms: print d,
             print "..."
-            
-        self.lock    = threading.Lock()
-        self.threads = {}
+
+    def wantStage(self, name):
+        if name == "PROBE": return self.targetBuild is not None
+        if self.verifyOnly: return False
+        if self.doSkip and name in UPLOAD_STAGES: return False
+        if self.noFlash and name == "INSTALL": return False
+        if not self.md5sum and name == "CHECK_MD5SUM": return False
+        return True
 
     def warn(self, cwd, m):
-        self.lock.acquire()
         print cwd+": "+m
-        self.lock.release()
         sys.stdout.flush()
 
     def log(self, cwd, m):
         if self.verbose: self.warn(cwd, m)
 
-    def dumpEverything(self, cwd, dor):
-        txt = dor.fpgaRegs()
-        txt += dor.commStats()
-        for line in txt.split('\n'):
-            self.warn(cwd, "WARNING: "+line)
-        
-    def runThread(self, cwd):
-        dor = MiniDor(self.card[cwd],
-                      self.pair[cwd],
-                      self.aorb[cwd])
-        dor.commStatReset()
-        self.txbytes[cwd] = 0
+    def policy(self, policy):
+        "A stage's RetryPolicy with the command-line overrides applied"
+        trials = None
+        if self.retries is not None and policy.trials > 1: trials = self.retries
+        return policy.copy(trials, self.backoffDelay)
+
+    def snapshot(self, u):
+        "FPGA registers and comstat of a DOM, as text"
         try:
-            nloops = 0
-            while nloops < 5:
-                try:
-                    self.log(cwd, "SOFTBOOT1")
-                    dor.softboot()
-                    self.log(cwd, "OPEN")
-                    dor.open()
-                    # if random() < 0.1:
-                    #     raise IOError('Failed to open /dev file')
-                    self.log(cwd, "CHECK_ICEBOOT1")
-                    txt = dor.se1("\r", "> $", 10000)
-                    # if random() < 0.1:
-                    #    raise ExpectStringNotFoundException(txt)
-                    break
-                # Make a broad except block here to retry at least once, since so many things
-                # can go wrong with so-called softboot failures or "dropped DOMs"
-                except Exception, e:
-                    nloops += 1
-                    self.warn(cwd, "WARNING: retrying (trial %d) after exception '%s'" % \
-                             (nloops, stripCR(str(e))))
-                    self.dumpEverything(cwd, dor)
-                    try:
-                        dor.close()
-                    except Exception:
-                        pass
-            
-            self.log(cwd, "ISET")
-            txt = dor.se1("$ffffffff $01000000 $00800000 4 / iset\r\n", ">", 30000)
-
-            if not self.doSkip:
-                fileSize = os.path.getsize(self.release)
-                txt = dor.se1("%d read-bin\r\n" % fileSize, "read-bin\r\n", 30000)
-                f = file(self.release)
-                segsize  = 4000 # =< 4092
-                buf = None
-                totbytes = os.path.getsize(self.release)
-                txbytes  = 0
-                timeout = 10*1000
-                t = MiniTimer(timeout)
-                self.warn(cwd, "SENDING (0%)")
-                while True:
-                    buf = f.read(segsize)
-                    if (not buf) or len(buf) == 0: break
-                    while len(buf) > 0:
-                        ready = select.select([],[dor.fd],[],10)
-                        if len(ready[1]) > 0:
-                            nw = os.write(dor.fd, buf)
-                            self.txbytes[cwd] += nw
-                            txbytes += nw
-                            buf = buf[nw:]
-                        if t.expired():
-                            self.warn(cwd, "SENDING (%2.3f%%)" % (100.*txbytes/float(totbytes)))
-                            t = MiniTimer(timeout)
-                       
-                # Make sure iceboot still there
-                self.log(cwd, "CHECK_ICEBOOT2")
-                txt = dor.se1("\r", "> $", 10000)
-
-                # Get location and length (last two items on stack)
-                self.log(cwd, "CHECK_STACK")
-                txt = dor.se1(".s\r", "\d+ \d+\s+> $", 10000)
-                m = re.search('(\d+) (\d+)\s+> $', txt)
-                if not m:
-                    self.warn(cwd, "Bad stack details '%s'!  Flash not changed." % stripCR(txt))
-                    self.warn(cwd, "FAIL")
-                    return
-                loc, length = m.group(1), m.group(2)
-
-                # Check md5sum
-                if self.md5sum:
-                    self.log(cwd, "CHECK_MD5SUM")
-                    txt = dor.se1("md5sum type crlf type\r", "md5sum.+?> $", 10000)
-                    m = re.search('md5sum.+?\s+(\w+)\s+> $', txt)
-                    if not m:
-                        self.warn(cwd, "Unexpected md5sum '%s'!  Flash not changed." % stripCR(txt))
-                        self.warn(cwd, "FAIL")
-                        return
-                    if self.md5sum != m.group(1):
-                        self.warn(cwd, "MD5SUM ERROR: local '%s' remote '%s'" % (self.md5sum,
-                                                                                 m.group(1)))
-                        self.warn(cwd, "FAIL")
-                        return
-                    self.log(cwd, "MD5SUM (%s)" % m.group(1))
-                
-                # gunzip/hex-to-bin command
-                self.log(cwd, "GUNZIP")
-                txt = dor.se1("%s %s gunzip $01000000 $01000000 hex-to-bin\r" % (loc, length),
-                              "hex-to-bin\s+> $", 60000)
-                self.log(cwd, "Got %s" % stripCR(txt))
-
-                # Flash the image.  Here we want to make sure there is no extra output!
-                if not self.noFlash:
-                    self.warn(cwd, "INSTALLING")
-                    txt0 = dor.se1("$01000000 $00400000 install-image\r",
-                                   "install-image\s+install:.+?are you sure [y/n]?",
-                                   10000)
-                    txt1 = dor.se1("y\r", "^y.*> $", 240000)
-                    m = re.search('write ERRORS detected', txt1, re.S)
-                    if m:
-                        self.warn(cwd, "WARNING: FLASH ERRORS\n"+stripCR(txt0+txt1))
-                    m = re.search("chip 0: unlock\.\.\. erase\.\.\.\s+"+
-                                  "chip 1: unlock\.\.\. erase\.\.\.\s+"+
-                                  "Programming\.\.\.\s+"+
-                                  "chip 0: lock\.\.\.\s+"+
-                                  "chip 1: lock\.\.\.\s+> $", txt1, re.S)
-                    if not m:
-                        self.warn(cwd, "WARNING: unexpected flash write output\n"+stripCR(txt0+txt1))
-                    
-            # Check version
-            self.log(cwd, "SOFTBOOT2")
-            dor.softboot()
-            self.log(cwd, "CHECK_VERSION")
-            txt = dor.se1("\r\n", ">", 100000)
-            m = re.search('Iceboot.+?build (\d+)\.', txt)
-            if not m:
-                self.warn(cwd, "WARNING: Build number not found: %s", stripCR(txt))
-            else:
-                self.warn(cwd, "DONE (%s)" % m.group(1))
-            dor.close()
-            
-        except KeyboardInterrupt, k:
-            self.warn(cwd, "Interrupting...")
-            self.warn(cwd, "FAIL")
-            return
-        except IOError, e:
-            self.warn(cwd, "IOError: "+str(e))
-            self.warn(cwd, "FAIL")
-            return
-        except ExpectStringNotFoundException, e:
-            self.warn(cwd, "Unexpected DOM output: "+str(e))
-            self.warn(cwd, "FAIL")
-            return
+            return u.dor.fpgaRegs() + u.dor.commStats()
         except Exception, e:
-            self.warn(cwd, exc_string())
-            self.warn(cwd, "FAIL")
-            return
-        
-    def go(self):
-        for dom in self.doms:
-            self.threads[dom] = threading.Thread(target=self.runThread, args=(dom, ))
-            self.threads[dom].start()
+            return "(no comstat/fpga snapshot: %s)" % e
+
+    def saveProgress(self):
+        """
+        Write the progress file, keeping the entries of DOMs that another
+        invocation is uploading the same release to
+        """
+        if not self.progressFile: return
+        saved = {}
+        try:
+            saved = self.json.load(file(self.progressFile))
+        except (IOError, ValueError):
+            pass
         for dom in self.doms:
+            if dom in self.progress: saved[dom] = self.progress[dom]
+            else: saved.pop(dom, None)
+        atomicWrite(self.progressFile, self.json.dumps(saved, indent=1, sort_keys=True))
+
+    def completed(self, u, stage):
+        self.progress[u.cwd] = { "stage" : stage, "build" : u.build, "time" : time.time() }
+        self.saveProgress()
+
+    def failedStage(self, u, stage, e, snapshot):
+        entry = self.progress.setdefault(u.cwd, {})
+        entry["failure"] = { "stage" : stage, "error" : stripCR(str(e)),
+                             "snapshot" : snapshot, "time" : time.time() }
+        self.saveProgress()
+
+    def releaseSlot(self, u):
+        if not u.hasSlot: return
+        u.hasSlot = False
+        self.slots[(u.card, u.pair)].remove(u)
+
+    def schedule(self):
+        """
+        Give streaming slots to DOMs waiting for one, within the per-pair
+        and per-card limits.  The DOMs on the slowest links (as learned
+        from comstat, unknown counting as slowest) go first, so they
+        don't end up as stragglers after the fast ones are done.
+        """
+        waiting = [u for u in self.uploads.values()
+                   if u.result is None and isinstance(u.action, Acquire)]
+        waiting.sort(key=lambda u: (self.linkRate.get((u.card, u.pair), 0.), u.cwd))
+        for u in waiting:
+            onPair = len(self.slots.get((u.card, u.pair), []))
+            onCard = sum([len(v) for (c, p), v in self.slots.items() if c == u.card])
+            if self.perPair and onPair >= self.perPair: continue
+            if self.perCard and onCard >= self.perCard: continue
+            self.slots.setdefault((u.card, u.pair), []).append(u)
+            u.hasSlot = True
+            self.step(u, u.resume, None)
+
+    def sample(self, now):
+        "Update the learned link rates from the comstat TX counters of streaming DOMs"
+        for u in self.uploads.values():
+            if not isinstance(u.action, Stream): continue
             try:
-                while True:
-                    self.threads[dom].join(1)
-                    if not self.threads[dom].isAlive(): break
-            except KeyboardInterrupt:
-                raise SystemExit
-            except Exception, e:
-                print exc_string()
-                raise SystemExit
-        
+                tx = CommStats(u.dor.commStats()).txbytes
+            except (IOError, InvalidComstatException):
+                continue
+            last = self.lastTX.get(u.cwd)
+            self.lastTX[u.cwd] = (now, tx)
+            if last is None or now <= last[0]: continue
+            rate = (tx - last[1]) / (now - last[0])
+            link = (u.card, u.pair)
+            if link in self.linkRate:
+                rate = self.rateWeight*rate + (1-self.rateWeight)*self.linkRate[link]
+            self.linkRate[link] = rate
+
+    def step(self, u, fn, *args):
+        "Call a DOMUpload event handler, passing any exception to its failure handling"
+        try:
+            fn(*args)
+        except Exception, e:
+            u.failed(e)
+
+    def event(self, u, kind, **fields):
+        "Write one JSON-lines telemetry record, if an events file was given"
+        if not self.events: return
+        fields["t"] = round(time.time(), 3)
+        fields["event"] = kind
+        if u is not None: fields["dom"] = u.cwd
+        self.events.write(self.json.dumps(fields, sort_keys=True) + "\n")
+        self.events.flush()
+
+    def streamETA(self, uploads, rates):
+        """
+        Seconds until the given DOMs (all on one pair) have been sent the
+        image, from their current rates or the pair's learned rate (or
+        the mean of rates); None if no rate is known yet
+        """
+        left = 0.
+        n = 0
+        for u in uploads:
+            if u.result is not None or u.streamEnd or self.image is None: continue
+            remaining = len(self.image)
+            rate = 0.
+            if isinstance(u.action, Stream):
+                remaining -= u.txbytes
+                rate = u.rate() * 1e6
+            if rate <= 0: rate = self.linkRate.get((u.card, u.pair), 0.)
+            if rate <= 0 and rates: rate = sum(rates) / len(rates)
+            if rate <= 0: return None
+            left += remaining / rate
+            n += 1
+        if n == 0: return 0.
+        concurrency = min(self.perPair or n, n)
+        return left / concurrency
+
+    def report(self, now):
+        """
+        Print a compact progress summary for each card: DOMs done, failed,
+        streaming and still to stream, its throughput and streaming ETA;
+        then the stragglers and the projected completion.  Stream
+        progress goes to the events file too.
+        """
+        streaming = [u for u in self.uploads.values() if isinstance(u.action, Stream)]
+        for u in streaming:
+            self.event(u, "bytes", tx=u.txbytes, size=len(self.image),
+                       rate=int(u.rate() * 1e6))
+        rates = [u.rate() * 1e6 for u in streaming if u.rate() > 0] + self.linkRate.values()
+        etaAll = 0.
+        for card in sorted(set([u.card for u in self.uploads.values()])):
+            onCard = [u for u in self.uploads.values() if u.card == card]
+            pairs = {}
+            for u in onCard: pairs.setdefault(u.pair, []).append(u)
+            eta = 0.
+            for pair in pairs:
+                e = self.streamETA(pairs[pair], rates)
+                if e is None or eta is None: eta = None
+                else: eta = max(eta, e)
+            if eta is None or etaAll is None: etaAll = None
+            else: etaAll = max(etaAll, eta)
+            done = len([u for u in onCard if u.result is not None and u.result != "FAIL"])
+            fail = len([u for u in onCard if u.result == "FAIL"])
+            strm = [u for u in streaming if u.card == card]
+            toGo = len([u for u in onCard if u.result is None and not u.streamEnd
+                        and not isinstance(u.action, Stream)])
+            rate = sum([u.rate() for u in strm])
+            if done + fail == len(onCard): continue # Nothing left to report
+            print "card %d: %d/%d done, %d failed, %d streaming at %.3f MB/s, %d to stream, ETA %s" % \
+                  (card, done, len(onCard), fail, len(strm), rate, toGo, formatETA(eta))
+            self.event(None, "card", card=card, done=done, failed=fail, streaming=len(strm),
+                       rate=int(rate * 1e6), eta=eta)
+        if len(streaming) >= 3:
+            median = sorted([u.rate() for u in streaming])[len(streaming)/2]
+            slow = [u for u in streaming if u.rate() < 0.5 * median]
+            if slow:
+                print "stragglers: " + ", ".join(["%s (%.3f MB/s)" % (u.cwd, u.rate())
+                                                   for u in sorted(slow, key=lambda u: u.cwd)])
+        if self.image is not None:
+            print "streaming done in %s" % formatETA(etaAll)
+        if self.verbose:
+            for u in sorted(streaming, key=lambda u: u.cwd):
+                u.warn("SENDING (%2.3f%%) %.3f MB/s" % (100.*u.txbytes/len(self.image), u.rate()))
+        sys.stdout.flush()
+
+    def summary(self):
+        counts = {}
+        for u in self.uploads.values():
+            counts[u.result] = counts.get(u.result, 0) + 1
+        self.event(None, "summary", counts=counts, txbytes=self.txbytes,
+                   linkRates=dict([("%d%d" % k, int(v)) for k, v in self.linkRate.items()]))
+        counts = {}
+        for dom in self.doms:
+            u = self.uploads[dom]
+            counts[u.result] = counts.get(u.result, 0) + 1
+            line = "%s: %-7s" % (dom, u.result)
+            if u.build: line += " build %s" % u.build
+            if u.streamEnd: line += ", %d bytes at %.3f MB/s" % (u.txbytes, u.rate())
+            if u.ended and u.started: line += ", %.1f sec" % (u.ended - u.started)
+            print line
+        for (card, pair) in sorted(self.linkRate.keys()):
+            print "Card %d pair %d: %.3f MB/s (comstat TX)" % \
+                  (card, pair, self.linkRate[(card, pair)] / 1e6)
+        if self.verifyOnly:
+            print "%d of %d DOMs at build %s, %d at another build, %d failed" % \
+                  (counts.get("CURRENT", 0), len(self.doms), self.targetBuild,
+                   counts.get("OLD", 0), counts.get("FAIL", 0))
+        elif self.targetBuild is not None:
+            print "%d of %d DOMs done, %d skipped (already build %s), %d failed" % \
+                  (counts.get("DONE", 0), len(self.doms), counts.get("SKIPPED", 0),
+                   self.targetBuild, counts.get("FAIL", 0))
+        else:
+            print "%d of %d DOMs done, %d failed" % \
+                  (counts.get("DONE", 0), len(self.doms), counts.get("FAIL", 0))
+
+    def go(self):
+        self.event(None, "start", release=self.release, doms=self.doms,
+                   size=self.image and len(self.image))
+        poller = select.poll()
+        registered = {} # fd -> (poll mask, DOMUpload)
+        for dom in self.doms:
+            self.step(self.uploads[dom], self.uploads[dom].start)
+        nextReport = time.time() + self.reportInterval
+        nextSample = time.time() + self.sampleInterval
+        try:
+            while True:
+                self.schedule()
+                active = [u for u in self.uploads.values() if u.result is None]
+                if not active: break
+                wanted = {}
+                deadline = min(nextReport, nextSample)
+                for u in active:
+                    mask = u.pollMask()
+                    if mask: wanted[u.fd] = (mask, u)
+                    if u.deadline is not None and u.deadline < deadline: deadline = u.deadline
+                for fd in registered.keys():
+                    if fd not in wanted or wanted[fd][1] is not registered[fd][1]:
+                        poller.unregister(fd)
+                        del registered[fd]
+                for fd, (mask, u) in wanted.items():
+                    if fd not in registered or registered[fd][0] != mask:
+                        poller.register(fd, mask)
+                    registered[fd] = (mask, u)
+                timeout = max(0, int((deadline - time.time()) * 1000))
+                for fd, event in poller.poll(timeout):
+                    if fd not in registered: continue
+                    u = registered[fd][1]
+                    if event & select.POLLOUT:
+                        self.step(u, u.writable)
+                    if u.fd == fd and event & (select.POLLIN | select.POLLERR | select.POLLHUP):
+                        self.step(u, u.readable)
+                now = time.time()
+                for u in active:
+                    if u.result is None: self.step(u, u.tick, now)
+                if now >= nextSample:
+                    self.sample(now)
+                    nextSample = now + self.sampleInterval
+                if now >= nextReport:
+                    self.report(now)
+                    nextReport = now + self.reportInterval
+        except KeyboardInterrupt, k:
+            for u in self.uploads.values():
+                if u.result is None: u.failed(k)
+            raise SystemExit
+        self.summary()
+
 class TestMyStuff(unittest.TestCase):
     def test1(self): self.assertEqual(2+2, 4)
 
@@ -255,14 +845,26 @@ def domsToUse(arglist, dict):
             raise SystemExit
     return ret
 
-def doGzip(f, verbose):
-    base = os.path.basename(f)
-    newFile = "/tmp/%s.gz" % base
-    if verbose: print "Creating %s..." % newFile
-    gz = gzip.GzipFile(newFile, "wb")
-    gz.write(file(f).read())
-    gz.close()
-    return newFile
+def releaseBuild(releaseFile):
+    "Build number taken from the release file name (e.g. rel443.hex), or None"
+    nums = re.findall('\d+', os.path.basename(releaseFile))
+    if not nums: return None
+    return str(int(nums[-1]))
+
+BLOCKSIZE = 1<<20 # Read size for hashing and compressing release files
+
+DEFAULT_CACHE = os.path.join(tempfile.gettempdir(), "uploaddoms-cache")
+
+class HashingWriter:
+    "File wrapper that keeps the md5 of everything written through it"
+    def __init__(self, f):
+        self.f   = f
+        self.md5 = md5.new()
+    def write(self, buf):
+        self.md5.update(buf)
+        self.f.write(buf)
+    def flush(self):
+        self.f.flush()
 
 def getMd5sum(fname):
     """
@@ -271,13 +873,64 @@ def getMd5sum(fname):
     f = file(fname, "rb")
     m = md5.new()
     while True:
-        buf = f.read(8092)
+        buf = f.read(BLOCKSIZE)
         if not buf: break
         m.update(buf)
     f.close()
     ret = m.hexdigest()
     return ret
 
+def atomicWrite(fname, data):
+    "Write a small file so that readers see either nothing or all of it"
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname))
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.rename(tmp, fname)
+
+def cachedGzip(releaseFile, cacheDir=DEFAULT_CACHE, verbose=False):
+    """
+    Gzipped release image and its md5sum, from a cache keyed by the md5 of
+    the release file's contents.  On a miss the image is compressed in
+    BLOCKSIZE pieces into a temporary file and renamed into place, so
+    uploads running at the same time never see a partial image.  The gzip
+    header has a fixed name and time, so the same release always gives
+    the same image.  Returns (gzip file name, md5sum of it).
+    """
+    key = getMd5sum(releaseFile)
+    gzName  = os.path.join(cacheDir, key + ".gz")
+    md5Name = gzName + ".md5"
+    if os.path.exists(gzName) and os.path.exists(md5Name):
+        md5sum = file(md5Name).read().strip()
+        if verbose: print "Using cached %s" % gzName
+        return gzName, md5sum
+    if not os.path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            if not os.path.isdir(cacheDir): raise # Else another upload made it
+    if verbose: print "Creating %s..." % gzName
+    fd, tmp = tempfile.mkstemp(dir=cacheDir)
+    try:
+        out = HashingWriter(os.fdopen(fd, "wb"))
+        gz = gzip.GzipFile(os.path.basename(releaseFile), "wb", 9, out, 0)
+        f = file(releaseFile, "rb")
+        while True:
+            buf = f.read(BLOCKSIZE)
+            if not buf: break
+            gz.write(buf)
+        f.close()
+        gz.close()
+        out.f.close()
+        md5sum = out.md5.hexdigest()
+        os.rename(tmp, gzName)
+    except:
+        if os.path.exists(tmp): os.unlink(tmp)
+        raise
+    atomicWrite(md5Name, md5sum + "\n")
+    return gzName, md5sum
+
 def main():
     p = optparse.OptionParser(usage="usage: %prog [options] <releasefile>")
     p.add_option("-s", "--skip-actual-upload", action="store_true", dest="doSkip",
@@ -286,9 +939,50 @@ def main():
                  help="Do everything but write the actual flash")
     p.add_option("-v", "--verbose",            action="store_true", dest="verbose",
                  help="Print more output")
-    p.set_defaults(doSkip  = False,
-                   noFlash = False,
-                   verbose = False)
+    p.add_option("-c", "--skip-current",       action="store_true", dest="skipCurrent",
+                 help="Probe all DOMs first and skip those already running the release build "+
+                      "(needs --build)")
+    p.add_option("-V", "--verify-only",        action="store_true", dest="verifyOnly",
+                 help="Only probe all DOMs and report which run the release build")
+    p.add_option("-b", "--build",              action="store", type="string", dest="build",
+                 help="Iceboot build number of the release (with -V, default: last number "+
+                      "in the release file name)")
+    p.add_option("--per-pair",                 action="store", type="int", dest="perPair",
+                 help="Stream to at most N DOMs per wire pair at once (0: no limit; default 1)",
+                 metavar="N")
+    p.add_option("--per-card",                 action="store", type="int", dest="perCard",
+                 help="Stream to at most N DOMs per DOR card at once (default: no limit)",
+                 metavar="N")
+    p.add_option("--cache",                    action="store", type="string", dest="cacheDir",
+                 help="Directory for compressed release images (default %s)" % DEFAULT_CACHE)
+    p.add_option("--retries",                  action="store", type="int", dest="retries",
+                 help="Try each retryable stage up to N times (default: per stage)",
+                 metavar="N")
+    p.add_option("--backoff",                  action="store", type="float", dest="backoff",
+                 help="Seconds before the first retry of a stage; doubles with each "+
+                      "further failure (default 1)", metavar="SEC")
+    p.add_option("--fresh",                    action="store_true", dest="fresh",
+                 help="Ignore the progress saved by earlier runs with this release")
+    p.add_option("-e", "--events",             action="store", type="string", dest="events",
+                 help="Write stage transitions and progress as JSON lines to FILE "+
+                      "('-' for stdout)", metavar="FILE")
+    p.add_option("--report",                   action="store", type="float", dest="report",
+                 help="Seconds between progress summaries (default %d)" % Uploader.reportInterval,
+                 metavar="SEC")
+    p.set_defaults(doSkip      = False,
+                   events      = None,
+                   report      = None,
+                   retries     = None,
+                   backoff     = None,
+                   fresh       = False,
+                   cacheDir    = DEFAULT_CACHE,
+                   perPair     = 1,
+                   perCard     = 0,
+                   noFlash     = False,
+                   verbose     = False,
+                   skipCurrent = False,
+                   verifyOnly  = False,
+                   build       = None)
     
     opt, args = p.parse_args()
 
@@ -316,32 +1010,58 @@ def main():
         print "No communicating DOMs selected!"
         raise SystemExit
 
+    # A wrong build number could skip DOMs that need the release, so skipping
+    # needs it given explicitly; -V only reports, so there a guess will do
+    targetBuild = None
+    if opt.skipCurrent or opt.verifyOnly:
+        targetBuild = opt.build
+        how = "given with --build"
+        if targetBuild is None and opt.skipCurrent:
+            print "Skipping current DOMs needs the build of %s; please give it with --build" % \
+                  releaseFile
+            raise SystemExit
+        if targetBuild is None:
+            targetBuild = releaseBuild(releaseFile)
+            how = "guessed from the file name"
+        if targetBuild is None:
+            print "Can't tell the build of %s; please give it with --build" % releaseFile
+            raise SystemExit
+        print "Comparing DOMs with build %s (%s)" % (targetBuild, how)
+
+    events = None
+    if opt.events == "-":
+        events = sys.stdout
+    elif opt.events:
+        events = file(opt.events, "a")
+    if opt.report: Uploader.reportInterval = opt.report
+
+    if opt.verifyOnly:
+        Uploader(releaseFile, uploadSet, None, opt.verbose,
+                 targetBuild=targetBuild, verifyOnly=True, events=events).go()
+        raise SystemExit
+
     # Compress image
-    tmpFile = None
+    gzFile = md5sum = None
     try:
         if not opt.doSkip:
-            tmpFile = doGzip(releaseFile, opt.verbose)
+            gzFile, md5sum = cachedGzip(releaseFile, opt.cacheDir, opt.verbose)
     except Exception, e:
         print "Couldn't create gzip file corresponding to %s: %s" % (releaseFile, exc_string())
         raise SystemExit
+    if md5sum and opt.verbose: print "Local md5sum is %s" % md5sum
 
-    if tmpFile:
-        md5sum = getMd5sum(tmpFile)
-        if opt.verbose: print "Local md5sum is %s" % md5sum               
-    else:
-        md5sum = None
+    # Progress is kept next to the cached image, so it belongs to this release
+    progressFile = None
+    if gzFile and not opt.noFlash:
+        progressFile = os.path.splitext(gzFile)[0] + ".progress"
 
     # Do the upload
-    u = Uploader(tmpFile, uploadSet, md5sum, opt.verbose, opt.doSkip, opt.noFlash)
+    u = Uploader(gzFile, uploadSet, md5sum, opt.verbose, opt.doSkip, opt.noFlash,
+                 targetBuild, perPair=opt.perPair, perCard=opt.perCard,
+                 retries=opt.retries, backoff=opt.backoff, progressFile=progressFile,
+                 fresh=opt.fresh, events=events)
     u.go()
 
-    # Clean up
-    try:
-        if not opt.doSkip:
-            os.unlink(tmpFile)
-    except Exception, e:
-        print "Couldn't unlink %s: %s" % (tmpFile, exc_string())
-
     raise SystemExit
     
 if __name__ == "__main__": main()
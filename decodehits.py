@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#
+# decodehits.py
+#
+# Decode and print hit data: raw getWaveformData() payload files
+# (delta-compressed or engineering format) or hit archive directories
+# written by domapptest.py --save-hits
+#
+#---------------------------------------------------------------
+
+import sys, os, tempfile, struct
+from optparse import OptionParser
+from domapptools.hitarchive import *
+from domapptools.DeltaHit import DeltaHit, MalformedDeltaCompressedHitBuffer
+from domapptools.EngHit import EngHit, MalformedEngineeringEventBuffer
+
+# Errors that mean an input can't be decoded; they are reported per file
+DECODE_ERRORS = (IOError, OSError, struct.error, HitArchiveException,
+                 MalformedDeltaCompressedHitBuffer, MalformedEngineeringEventBuffer)
+
+#---------------------------------------------------------------
+
+usage = "usage: %prog [options] file|archive [file2 ...]"
+parser = OptionParser(usage=usage)
+
+parser.add_option("-e", "--engineering",
+                  dest="engineering", action="store_true", default=False,
+                  help="Raw input files are engineering format (default is delta-compressed)")
+
+parser.add_option("-m", "--mbid",
+                  dest="mbid", type="string", default=None,
+                  help="Decode only hits from DOM with specified mainboard ID")
+
+parser.add_option("--domid",
+                  dest="domid", type="string", default="0",
+                  help="Mainboard ID to assign to hits in raw input files")
+
+parser.add_option("-t", "--trigger",
+                  dest="trigger", type="string", default=None,
+                  help="Decode only hits with a trigger bit in MASK set (e.g. 0x4 for beacons)",
+                  metavar="MASK")
+
+parser.add_option("-u", "--lcup",
+                  dest="lcup", action="store_true", default=False,
+                  help="Decode only hits with the LC up flag set")
+
+parser.add_option("-n", "--lcdown",
+                  dest="lcdown", action="store_true", default=False,
+                  help="Decode only hits with the LC down flag set")
+
+parser.add_option("--since",
+                  dest="since", type="string", default=None,
+                  help="Decode only hits with DOM clock >= CLOCK", metavar="CLOCK")
+
+parser.add_option("--until",
+                  dest="until", type="string", default=None,
+                  help="Decode only hits with DOM clock < CLOCK", metavar="CLOCK")
+
+parser.add_option("-v", "--verbose",
+                  dest="verbose", action="store_true", default=False,
+                  help="Print the fully decoded hit instead of a one-line header summary")
+
+parser.add_option("-s", "--summary",
+                  dest="summary", action="store_true", default=False,
+                  help="Print only summary statistics of the selected hits")
+
+parser.add_option("-j", "--jobs",
+                  dest="jobs", type="int", default=1,
+                  help="Decode up to N input files in parallel processes", metavar="N")
+
+(options, args) = parser.parse_args()
+if len(args) < 1:
+    parser.error("must specify at least one input hit file or archive")
+
+if options.jobs < 1:
+    parser.error("--jobs must be at least 1")
+
+def _int(s):
+    if s is None: return None
+    try:
+        return long(s, 0)
+    except ValueError:
+        parser.error("bad number '%s'" % s)
+
+trigmask = _int(options.trigger)
+since    = _int(options.since)
+until    = _int(options.until)
+flagmask = 0
+if options.lcup:   flagmask |= FLAG_LCUP
+if options.lcdown: flagmask |= FLAG_LCDOWN
+mbid = None
+if options.mbid is not None: mbid = long(options.mbid, 16)
+format = FORMAT_DELTA
+if options.engineering: format = FORMAT_ENGINEERING
+
+#---------------------------------------------------------------
+
+def selected(domid, clock, trigger, flags):
+    """Apply the command-line filters to header values"""
+    if mbid is not None and domid != mbid: return False
+    if trigmask is not None and not trigger & trigmask: return False
+    if flags & flagmask != flagmask: return False
+    if since is not None and clock < since: return False
+    if until is not None and clock >= until: return False
+    return True
+
+class HitSummary:
+    """Counts for the selected hits; summaries of several files can be merged"""
+    def __init__(self):
+        self.nhits   = 0
+        self.nbytes  = 0
+        self.lcup    = 0
+        self.lcdown  = 0
+        self.minbias = 0
+        self.triggers = {}
+        self.first   = None
+        self.last    = None
+
+    def add(self, clock, trigger, flags, size):
+        self.nhits  += 1
+        self.nbytes += size
+        if flags & FLAG_LCUP:    self.lcup    += 1
+        if flags & FLAG_LCDOWN:  self.lcdown  += 1
+        if flags & FLAG_MINBIAS: self.minbias += 1
+        self.triggers[trigger] = self.triggers.get(trigger, 0) + 1
+        if self.first is None or clock < self.first: self.first = clock
+        if self.last  is None or clock > self.last:  self.last  = clock
+
+    def merge(self, other):
+        self.nhits   += other.nhits
+        self.nbytes  += other.nbytes
+        self.lcup    += other.lcup
+        self.lcdown  += other.lcdown
+        self.minbias += other.minbias
+        for t, n in other.triggers.items():
+            self.triggers[t] = self.triggers.get(t, 0) + n
+        for c in (other.first, other.last):
+            if c is None: continue
+            if self.first is None or c < self.first: self.first = c
+            if self.last  is None or c > self.last:  self.last  = c
+
+    def __str__(self):
+        s = "%d hits (%d bytes): LCUP %d LCDN %d minbias %d" % \
+            (self.nhits, self.nbytes, self.lcup, self.lcdown, self.minbias)
+        if self.nhits:
+            s += "\nDOM clock 0x%012x - 0x%012x" % (self.first, self.last)
+            for t in sorted(self.triggers.keys()):
+                s += "\ntrigger 0x%04x: %d" % (t, self.triggers[t])
+        return s
+
+def hitLine(domid, clock, trigger, flags, raw):
+    if options.verbose:
+        if flags & FLAG_ENGINEERING: return str(EngHit(raw))
+        return str(DeltaHit(raw, clock >> 32))
+    lc = ""
+    if flags & FLAG_LCUP:   lc += "U"
+    if flags & FLAG_LCDOWN: lc += "D"
+    return "%012x clk 0x%012x trig 0x%04x LC %-2s %4d bytes" % \
+           (domid, clock, trigger, lc, len(raw))
+
+def rawRows(filename):
+    """(domid, clock, trigger, flags, raw) for each hit in a raw payload file"""
+    domid = long(options.domid, 16)
+    f = open(filename, "rb")
+    try:
+        for payload in readPayloads(f, format):
+            for clock, trigger, flags, raw in payloadRows(payload, format):
+                yield domid, clock, trigger, flags, raw
+    finally:
+        f.close()
+
+def archiveRows(path, chunk=65536):
+    """(domid, clock, trigger, flags, raw) for each hit in an archive, in clock order
+    if a clock range was selected and in file order otherwise"""
+    a = HitArchive(path)
+    if since is not None or until is not None:
+        t1 = until
+        if t1 is None: t1 = 1L<<48
+        for row in a.window(since or 0, t1):
+            yield (a.get("domid", row), a.get("clock", row), a.get("trigger", row),
+                   a.get("flags", row), a.raw(row))
+        return
+    for start in xrange(0, len(a), chunk):
+        stop = min(start + chunk, len(a))
+        cols = zip(a.column("domid", start, stop), a.column("clock", start, stop),
+                   a.column("trigger", start, stop), a.column("flags", start, stop))
+        for i, (domid, clock, trigger, flags) in enumerate(cols):
+            if selected(domid, clock, trigger, flags):
+                yield domid, clock, trigger, flags, a.raw(start + i)
+
+def decode(filename, out):
+    """Decode one input, writing hit lines to out; returns its HitSummary"""
+    summary = HitSummary()
+    if os.path.isdir(filename):
+        rows = archiveRows(filename)
+    else:
+        rows = rawRows(filename)
+    for domid, clock, trigger, flags, raw in rows:
+        if not selected(domid, clock, trigger, flags): continue
+        summary.add(clock, trigger, flags, len(raw))
+        if not options.summary:
+            print >>out, hitLine(domid, clock, trigger, flags, raw)
+    return summary
+
+def decodeToFile(filename):
+    """
+    Pool worker: decode into a temporary file so the parent can print the
+    files in order without holding their output in memory
+    """
+    fd, tmp = tempfile.mkstemp(prefix="decodehits-")
+    out = os.fdopen(fd, "w")
+    try:
+        try:
+            return filename, tmp, decode(filename, out), None
+        except DECODE_ERRORS, e:
+            return filename, tmp, None, errorText(e)
+    finally:
+        out.close()
+
+def errorText(e):
+    return str(e) or e.__class__.__name__
+
+def report(filename, summary, error):
+    if error is not None:
+        print "Error: couldn't decode %s: %s" % (filename, error)
+    elif options.summary:
+        print "%s: %s" % (filename, summary)
+
+#---------------------------------------------------------------
+total = HitSummary()
+
+if options.jobs == 1:
+    for filename in args:
+        summary = error = None
+        try:
+            summary = decode(filename, sys.stdout)
+        except DECODE_ERRORS, e:
+            error = errorText(e)
+        report(filename, summary, error)
+        if summary: total.merge(summary)
+else:
+    from multiprocessing import Pool
+    pool = Pool(min(options.jobs, len(args)))
+    for filename, tmp, summary, error in pool.imap(decodeToFile, args):
+        try:
+            f = open(tmp)
+            while True:
+                buf = f.read(1<<16)
+                if not buf: break
+                sys.stdout.write(buf)
+            f.close()
+        finally:
+            os.remove(tmp)
+        report(filename, summary, error)
+        if summary: total.merge(summary)
+    pool.close()
+    pool.join()
+
+if options.summary and len(args) > 1:
+    print "Total: %s" % total
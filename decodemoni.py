@@ -2,16 +2,23 @@
 # 
 # decodemoni.py
 #
-# Decode and print a .moni monitoring stream output file
+# Decode and print a .moni monitoring stream output file (StringHub,
+# 2ndbuild payload or direct DOMHub format, plain, gzipped or bzip2'ed)
 #
 # John Kelley, jkelley@icecube.wisc.edu
 # 3 August 2012
 #
 #---------------------------------------------------------------
 
-import sys
+import sys, os, tempfile, heapq, csv, cStringIO
+from struct import Struct, pack
+from itertools import imap
 from optparse import OptionParser
 from domapptools.monitoring import *
+from domapptools.monistats import MoniAggregator, EXTRACTORS, DEFAULT_QUANTITIES
+
+# Spill file entry header: sort key, length of the record text
+spillHeader = Struct('<qI')
 
 #---------------------------------------------------------------
 
@@ -26,40 +33,407 @@ parser.add_option("-d", "--domhub",
                   dest="hub", action="store_true", default=False,
                   help="Decode moni file from direct DOMHub output")
 
+parser.add_option("-S", "--stringhub",
+                  dest="stringhub", action="store_true", default=False,
+                  help="Decode moni file as StringHub .moni format only (default: detect the format of each record)")
+
 parser.add_option("-m", "--mbid",
                   dest="mbid", type="string", default=None,
                   help="Dump output only for DOM with specified mainboard ID")
 
+parser.add_option("-i", "--index",
+                  dest="index", action="store_true", default=False,
+                  help="Write (or refresh) the sidecar .idx index for each file before decoding")
+
+parser.add_option("-j", "--jobs",
+                  dest="jobs", type="int", default=1,
+                  help="Decode up to N files in parallel processes", metavar="N")
+
+parser.add_option("-s", "--sort",
+                  dest="sort", type="choice", choices=["ut", "clock"], default=None,
+                  help="Merge the records of all files into one stream ordered by 'ut' timestamp or DOM 'clock'")
+
+parser.add_option("-o", "--output",
+                  dest="output", type="choice", choices=["text", "csv", "json", "binary"],
+                  default="text",
+                  help="Output format: text (default), csv, json (one object per line) or binary (column files in --outdir)")
+
+parser.add_option("-f", "--fields",
+                  dest="fields", type="string", default=None,
+                  help="Comma-separated record fields for csv/json/binary output (e.g. timestamp,temperature)")
+
+parser.add_option("--outdir",
+                  dest="outdir", type="string", default=None,
+                  help="Directory for binary column output (one <field>.col file per field)")
+
+parser.add_option("-t", "--type",
+                  dest="types", type="string", default=None,
+                  help="Decode only records of these comma-separated types (hw, config, state, ascii or a type code such as 0xC8)")
+
+parser.add_option("--since",
+                  dest="since", type="string", default=None,
+                  help="Decode only records with UT timestamp >= T", metavar="T")
+
+parser.add_option("--until",
+                  dest="until", type="string", default=None,
+                  help="Decode only records with UT timestamp < T", metavar="T")
+
+parser.add_option("-F", "--follow",
+                  dest="follow", action="store_true", default=False,
+                  help="Keep reading the (single) file as it grows, printing new records as they arrive")
+
+parser.add_option("--poll",
+                  dest="poll", type="float", default=2.0,
+                  help="Longest interval between checks for new data in follow mode (seconds, default 2)")
+
+parser.add_option("--stats",
+                  dest="stats", action="store_true", default=False,
+                  help="Print rolling statistics of the hardware records per DOM instead of the records")
+
+parser.add_option("--alarm",
+                  dest="alarms", action="append", default=[],
+                  help="With --stats, report values of QUANTITY outside LOW..HIGH (either may be empty)",
+                  metavar="QUANTITY:LOW:HIGH")
+
+parser.add_option("--drift",
+                  dest="drifts", action="append", default=[],
+                  help="With --stats, report QUANTITY changing faster than MAX per second",
+                  metavar="QUANTITY:MAX")
+
 (options, args) = parser.parse_args()
 if len(args) < 1:
     parser.error("must specify at least one input moni file")
 
-if (options.payload and options.hub):
-    parser.error("can't specify both payload and hub formats; choose one or none (default is StringHub .moni format)")
+if options.jobs < 1:
+    parser.error("--jobs must be at least 1")
+
+if [options.payload, options.hub, options.stringhub].count(True) > 1:
+    parser.error("can't specify more than one of the payload, hub and StringHub formats; choose one or none (default is to detect the format)")
+
+if options.output == "binary":
+    if options.outdir is None:
+        parser.error("binary output needs --outdir")
+    if options.jobs > 1 or options.sort is not None:
+        parser.error("binary output can't be combined with --jobs or --sort")
+
+if options.output == "json":
+    import json # Python 2.6; only needed for json output
+
+if options.follow:
+    if len(args) != 1:
+        parser.error("follow mode takes exactly one file")
+    if options.output == "binary" or options.jobs > 1 or options.sort is not None:
+        parser.error("follow mode can't be combined with binary output, --jobs or --sort")
+    if os.path.exists(args[0]) and compressionType(args[0]) is not None:
+        parser.error("can't follow a compressed file")
+
+def _float(s):
+    if s == "": return None
+    try:
+        return float(s)
+    except ValueError:
+        parser.error("bad number '%s'" % s)
+
+thresholds = {}
+for a in options.alarms:
+    try:
+        q, lo, hi = a.split(":")
+    except ValueError:
+        parser.error("bad --alarm '%s'" % a)
+    thresholds[q] = (_float(lo), _float(hi))
+drifts = {}
+for d in options.drifts:
+    try:
+        q, limit = d.split(":")
+    except ValueError:
+        parser.error("bad --drift '%s'" % d)
+    drifts[q] = _float(limit)
+for q in thresholds.keys() + drifts.keys():
+    if q not in EXTRACTORS:
+        parser.error("unknown quantity '%s' (one of %s)" % (q, ", ".join(sorted(EXTRACTORS.keys()))))
+
+def _int(s):
+    if s is None: return None
+    try:
+        return long(s, 0)
+    except ValueError:
+        parser.error("bad number '%s'" % s)
+
+# Record type names for --type and the fields each type has
+typeNames = { "hw" : 0xC8, "config" : 0xC9, "state" : 0xCA, "ascii" : 0xCB }
+typeFields = dict([(t, cls.FIELDS) for t, cls in MONITOR_RECORD_TYPES.items()])
+
+moniTypes = None
+if options.types is not None:
+    moniTypes = []
+    for t in options.types.split(","):
+        t = t.strip()
+        if t.lower() in typeNames:
+            moniTypes.append(typeNames[t.lower()])
+        else:
+            moniTypes.append(_int(t))
+
+if options.fields is not None:
+    fields = tuple([f.strip() for f in options.fields.split(",")])
+elif moniTypes is not None and len(moniTypes) == 1:
+    fields = typeFields.get(moniTypes[0], MonitorRecord.FIELDS)
+else:
+    fields = ASCIIMonitorRecord.FIELDS
+
+filters = { "domids"    : options.mbid,
+            "moniTypes" : moniTypes,
+            "since"     : _int(options.since),
+            "until"     : _int(options.until) }
+
+filtering = [v for v in filters.values() if v is not None] != []
+
+type = None
+if options.payload:
+    type = MonitorStreamType.PAYLOAD
+elif options.hub:
+    type = MonitorStreamType.DIRECT
+elif options.stringhub:
+    type = MonitorStreamType.STRINGHUB
+else:
+    type = MonitorStreamType.AUTO
 
 #---------------------------------------------------------------
-for filename in args:
+
+csvBuf = cStringIO.StringIO()
+csvWriter = csv.writer(csvBuf, lineterminator="")
+
+def _jsonValue(v):
+    if isinstance(v, str): return v.decode("latin-1")
+    return v
+
+def render(m):
+    """One record in the selected output format, without trailing newline"""
+    if options.output == "csv":
+        csvBuf.seek(0)
+        csvBuf.truncate()
+        csvWriter.writerow([m.field(name) for name in fields])
+        return csvBuf.getvalue()
+    elif options.output == "json":
+        # Built by hand to keep the fields in the requested order
+        return "{" + ", ".join(["%s: %s" % (json.dumps(name), json.dumps(_jsonValue(m.field(name))))
+                                for name in fields]) + "}"
+    return str(m)
+
+# Missing value in an integer column of binary output
+MISSING_INT = -(1L << 63)
+
+class ColumnWriter:
+    """
+    Binary columnar output: one little-endian file per field in outdir,
+    <field>.col.  domid is unsigned 64-bit, the physical-unit hardware
+    fields are doubles (NaN if missing) and all other fields are signed
+    64-bit integers (MISSING_INT if missing), so mainboard IDs and UT
+    timestamps keep every bit; text fields are skipped.  A COLUMNS file
+    lists name and struct code per column.
+    """
+    def __init__(self, outdir, fields, batch=65536):
+        if not os.path.isdir(outdir): os.makedirs(outdir)
+        self.fields = [name for name in fields if name != "text"]
+        self.batch = batch
+        self.nrows = 0
+        self.cols = {}
+        self.files = {}
+        self.codes = {}
+        for name in self.fields:
+            if name == "domid":
+                self.codes[name] = "Q"
+            elif name in HW_UNIT_FIELDS:
+                self.codes[name] = "d"
+            else:
+                self.codes[name] = "q"
+            self.cols[name] = []
+            self.files[name] = open(os.path.join(outdir, name + ".col"), "wb")
+        f = open(os.path.join(outdir, "COLUMNS"), "w")
+        for name in self.fields:
+            print >>f, name, self.codes[name]
+        f.close()
+
+    def add(self, m):
+        for name in self.fields:
+            v = m.field(name)
+            if name == "domid":
+                v = long(v, 16)
+            elif self.codes[name] == "d":
+                if v is None: v = float("nan")
+            elif v is None:
+                v = MISSING_INT
+            self.cols[name].append(v)
+        self.nrows += 1
+        if self.nrows % self.batch == 0: self.flush()
+
+    def flush(self):
+        for name in self.fields:
+            col = self.cols[name]
+            self.files[name].write(pack("<%d%s" % (len(col), self.codes[name]), *col))
+            del col[:]
+
+    def close(self):
+        self.flush()
+        for f in self.files.values(): f.close()
+
+def openInput(filename):
+    """
+    Open one input file, decompressing it on the fly if needed; with -i,
+    first (re)build the index of an uncompressed file
+    """
+    if options.index and compressionType(filename) is None and \
+           openMoniIndex(filename, type) is None:
+        buildMoniIndex(filename, type)
+    return openMoniStream(filename)
+
+def decodeColumns(filename, writer):
+    f = openInput(filename)
     try:
-        f = open(filename, "r")
-    except:
-        print "Error: couldn't open file %s, skipping" % (filename)
-        continue
-
-    type = None
-    if options.payload:
-        type = MonitorStreamType.PAYLOAD
-    elif options.hub:
-        type = MonitorStreamType.DIRECT
-    else:
-        type = MonitorStreamType.STRINGHUB
-
-    xroot = readMoniStream(f, type)        
-    if xroot:        
-        for dom in xroot.keys():
-            for m in xroot[dom]:
-                if not hasattr(m, 'domid') or (options.mbid is None) or (m.domid == options.mbid):
-                    print m
-    else:
-        print "Error: coudln't parse monitoring stream in file",filename
+        nrec = 0
+        for m in iterMoniStream(f, type, **filters):
+            writer.add(m)
+            nrec += 1
+        return nrec
+    finally:
+        f.close()
+
+def decode(filename, out, key=None):
+    """
+    Print the records of one file to out; returns the number of records.
+    With a sort key ('ut' or 'clock') the records are sorted and written as
+    framed (key, text) entries for readSpill() instead.
+    """
+    f = openInput(filename)
+    try:
+        nrec = 0
+        if key is None:
+            for m in iterMoniStream(f, type, **filters):
+                print >>out, render(m)
+                nrec += 1
+            return nrec
+        entries = []
+        for m in iterMoniStream(f, type, **filters):
+            if key == "clock":
+                entries.append((m.domClock, render(m)))
+            else:
+                entries.append((m.timestamp, render(m)))
+        entries.sort()
+        for k, text in entries:
+            out.write(spillHeader.pack(k, len(text)))
+            out.write(text)
+        return len(entries)
+    finally:
+        f.close()
+
+def decodeToSpill(filename):
+    """
+    Worker: decode one file into a temporary spill file, so results come
+    back to the parent as a file name rather than through a pipe
+    """
+    fd, tmp = tempfile.mkstemp(prefix="decodemoni-")
+    out = os.fdopen(fd, "wb")
+    try:
+        try:
+            return filename, tmp, decode(filename, out, options.sort), None
+        except Exception, e:
+            return filename, tmp, 0, str(e)
+    finally:
+        out.close()
+
+def readSpill(tmp):
+    """Generator over the (key, text) entries of a sorted spill file"""
+    f = open(tmp, "rb")
+    try:
+        while True:
+            hdr = f.read(spillHeader.size)
+            if len(hdr) < spillHeader.size: return
+            (k, n) = spillHeader.unpack(hdr)
+            yield k, f.read(n)
+    finally:
+        f.close()
 
-    f.close()
+def report(filename, nrec, error):
+    if error is not None:
+        print "Error: couldn't decode %s: %s" % (filename, error)
+    elif nrec == 0 and not filtering:
+        print "Error: couldn't parse monitoring stream in file",filename
+
+#---------------------------------------------------------------
+if options.output == "csv" and not options.stats:
+    print ",".join(fields)
+
+if options.stats:
+    agg = MoniAggregator(quantities=DEFAULT_QUANTITIES + tuple(
+                             [q for q in thresholds.keys() + drifts.keys()
+                              if q not in DEFAULT_QUANTITIES]),
+                         thresholds=thresholds, drifts=drifts)
+    for filename in args:
+        if not os.access(filename, os.R_OK):
+            print "Error: couldn't open file %s, skipping" % (filename)
+            continue
+        f = openInput(filename)
+        agg.addStream(f, type, domids=filters["domids"],
+                      since=filters["since"], until=filters["until"])
+        f.close()
+    print "%d hardware records" % agg.nrecords
+    sys.stdout.write(agg.summary())
+    for alarm in agg.alarms:
+        print alarm
+elif options.follow:
+    try:
+        for m in followMoniStream(args[0], type, maxPoll=options.poll, **filters):
+            print render(m)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+elif options.output == "binary":
+    writer = ColumnWriter(options.outdir, fields)
+    try:
+        for filename in args:
+            if not os.access(filename, os.R_OK):
+                print "Error: couldn't open file %s, skipping" % (filename)
+                continue
+            nrec = decodeColumns(filename, writer)
+            report(filename, nrec, None)
+    finally:
+        writer.close()
+    print "%d records written to %s" % (writer.nrows, options.outdir)
+elif options.jobs == 1 and options.sort is None:
+    for filename in args:
+        if not os.access(filename, os.R_OK):
+            print "Error: couldn't open file %s, skipping" % (filename)
+            continue
+        nrec = decode(filename, sys.stdout)
+        report(filename, nrec, None)
+else:
+    if options.jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(options.jobs, len(args)))
+        results = pool.imap(decodeToSpill, args)
+    else:
+        pool = None
+        results = imap(decodeToSpill, args)
+    spills = []
+    try:
+        for filename, tmp, nrec, error in results:
+            if options.sort is None:
+                # Print each file's output as soon as it (and all before it) are done
+                f = open(tmp)
+                while True:
+                    buf = f.read(1<<16)
+                    if not buf: break
+                    sys.stdout.write(buf)
+                f.close()
+                os.remove(tmp)
+            else:
+                spills.append(tmp)
+            report(filename, nrec, error)
+        # K-way merge of the per-file sorted spills, one entry per file in memory
+        for k, text in heapq.merge(*[readSpill(tmp) for tmp in spills]):
+            print text
+    finally:
+        for tmp in spills:
+            if os.path.exists(tmp): os.remove(tmp)
+        if pool is not None:
+            pool.close()
+            pool.join()
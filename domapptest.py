@@ -4,8 +4,9 @@
 # John Jacobsen, NPX Designs, Inc., john@mail.npxdesigns.com
 # Started: Wed May  9 21:57:21 2007
 from __future__ import generators
-import time, threading, os, sys
+import time, threading, os, sys, select
 from datetime import datetime
+from heapq import heappush, heappop
 
 from re import search, sub
 from pprint import PrettyPrinter
@@ -16,6 +17,15 @@ from domapptools.domapp import *
 from domapptools.MiniDor import *
 from domapptools.DeltaHit import *
 from domapptools.EngHit import *
+from domapptools.hitclock import HitClockSeries
+from domapptools.hitstats import HitStats
+from domapptools import waveform
+from domapptools.hitarchive import HitArchiveWriter
+from domapptools.monitoring import MoniFileWriter
+from domapptools.monitoring import MonitorRecord, MonitorRecordFactory, MONITOR_RECORD_TYPES, \
+     ASCIIMonitorRecord, HardwareMonitorRecord
+from domapptools.monitoring import ASCII_FAST, ASCII_PED_ATWD, ASCII_ATWD_CS, ASCII_FADC_CS, \
+     ASCII_LBM_OVER, ASCII_PED_CONTAMINATED, ASCII_PED_LIGHT, ASCII_LC_MODE
 from domapptools.decode_dom_buffer import decode_dom_buffer
 
 from os.path import exists
@@ -98,9 +108,11 @@ class DOMTest(object):
             for m in self.debugMsgs:
                 if type(m) == type([]):
                     for i in m:
+                        i = moniMessage(i)
                         if i != "": str += "%s\n" % i
-                elif m != "":
-                    str += "%s\n" % m
+                else:
+                    m = moniMessage(m)
+                    if m != "": str += "%s\n" % m
         return str
 
     def clearDebugTxt(self): self.debugMsgs = []
@@ -563,6 +575,8 @@ class ChargeStampHistoTest(DOMAppHVTest):
             gotFADCRec = False
             gotATWDCounts = {}
             gotFADCCounts = False
+            emptyATWDRec = {} # Records from which no histogram entries were parsed
+            emptyFADCRec = False
             t = MiniTimer(self.runLength*1000)
             while not t.expired():
                 hitdata = domapp.getWaveformData()
@@ -571,23 +585,22 @@ class ChargeStampHistoTest(DOMAppHVTest):
 
                 mlist = getLastMoniMsgs(domapp)
                 for m in mlist:
+                    kind, val = moniParsed(m)
                     if doATWD:
-                        s1 = search('ATWD CS (\S+) (\d+)--(\d+) entries: (.+)', m)
-                        if s1:
-                            chip    = s1.group(1)
-                            chan    = int(s1.group(2))
-                            entries = s1.group(3)
-                            rest    = s1.group(4)
+                        if kind == ASCII_ATWD_CS:
+                            chip, chan, entries, counts = val
                             gotATWDRec[chip, chan] = True
-                            for x in map(int, rest.split()):
-                                if x > 0: gotATWDCounts[chip] = True
+                            if not counts:
+                                emptyATWDRec[chip, chan] = True
+                            elif max(counts) > 0:
+                                gotATWDCounts[chip] = True
                     else:
-                        s1 = search('FADC CS--(\d+) entries: (.+)', m)
-                        if s1:
-                            entries = s1.group(1)
-                            rest    = s1.group(2)
-                            for x in map(int, rest.split()):
-                                if x > 0: gotFADCCounts = True
+                        if kind == ASCII_FADC_CS:
+                            entries, counts = val
+                            if not counts:
+                                emptyFADCRec = True
+                            elif max(counts) > 0:
+                                gotFADCCounts = True
                             gotFADCRec = True
                     self.debugMsgs.append(m)
 
@@ -598,6 +611,11 @@ class ChargeStampHistoTest(DOMAppHVTest):
             domapp.endRun()
             
             ### Make sure I have records for each type
+            for chip, chan in emptyATWDRec.keys():
+                self.fail("No entries parsed from ATWD charge stamp histogram for chip %s, chan %d!" \
+                          % (chip, chan))
+            if emptyFADCRec:
+                self.fail("No entries parsed from FADC charge stamp histogram!")
             if doATWD:
                 for chip in ['A','B']:
                     for chan in range(0,2):
@@ -756,6 +774,7 @@ class FlasherTest(DOMAppTest):
             if len(hitdata) > 0:
                 gotData = True
                 hitBuf = EngHitBuf(hitdata)
+                hits = []
                 for hit in hitBuf.next():
                     nhits += 1
                     if hit.trigSource != 3:
@@ -778,21 +797,15 @@ class FlasherTest(DOMAppTest):
                         self.debugMsgs.append(hit)
                         hitOk = False
                         break
-                    min    = None
-                    max    = None
-                    top    = 750
-                    bot    = 500
-                    minTOT = 5
-                    start  = None
-                    end    = None
-                    for i in range(0, len(hit.atwd[3])):
-                        s = hit.atwd[3][i]
-                        if start is None:
-                            if s < bot: start = i
-                        else:
-                            if s > top: end = i
-                        if min is None or s < min: min = s
-                        if max is None or s > max: max = s
+                    hits.append(hit)
+                if not hitOk: break
+
+                # Check pulse shapes of the whole buffer at once
+                top    = 750
+                bot    = 500
+                minTOT = 5
+                windows = waveform.pulseWindows([hit.atwd[3] for hit in hits], bot, top)
+                for hit, (start, end) in zip(hits, windows):
                     badLEDpulse = True
                     if start is None:
                         self.fail("Pulse never went below %d" % bot)
@@ -882,47 +895,43 @@ def setDefaultDACs(domapp):
 
 
 def unpackMoni(monidata):
+    """
+    Generator over the monitoring records in a getMonitorData() buffer, as
+    typed records from domapptools.monitoring (types it doesn't know are
+    skipped)
+    """
     while monidata and len(monidata)>=4:
         moniLen, moniType = unpack('>hh', monidata[0:4])
-        if moniType == 0xCB: # ASCII message
-            yield monidata[10:moniLen]
-        if moniType == 0xC8:
-            vals = unpack('>bx27HLL', monidata[10:74])
-            vals = [str(i) for i in vals]
-            txt = " ".join(vals)
-            yield "[HW EVT %s]" % txt
-        if moniType == 0xC9:
-            vals = unpack('>B3xIH2xIIH2xH8B2xII', monidata[10:moniLen])
-            vals = [str(i) for i in vals]
-            txt = " ".join(vals)
-            yield "[CONFIG %s]" % txt
-        if moniType == 0xCA:
-            kind,    = unpack('b', monidata[10])
-            subkind, = unpack('b', monidata[11])
-            if kind == 2 and subkind == 0x10:
-                txt = "ENABLE HV"
-            elif kind == 2 and subkind == 0x12:
-                txt = "ENABLE HV"
-            elif kind == 2 and subkind == 0x0E:
-                val, = unpack('>h', monidata[12:14])
-                txt = "SET HV(%d)" % val
-            elif kind == 2 and subkind == 0x0D:
-                dac, val = unpack('>bxh', monidata[12:16])
-                txt = "SET DAC(%d<-%d)" % (dac,val)
-            elif kind == 2 and subkind == 0x2D:
-                mode, = unpack('b', monidata[12])
-                txt = "SET LC MODE(%d)" % mode
-            elif kind == 2 and subkind == 0x2F:
-                w = unpack('>LLLL', monidata[12:28])
-                txt = "SET LC WIN(%d %d %d %d)" % w
-            else:
-                txt = "0x%0x-0x%0x" % (kind,subkind)
-            yield "[STATE CHANGE %s]" % txt
+        if moniType in MONITOR_RECORD_TYPES:
+            yield MonitorRecordFactory(monidata[:moniLen])
         monidata = monidata[moniLen:]
 
+def moniText(m):
+    """
+    Text of an ASCII monitoring record ('' for other records); plain
+    strings, such as failure messages, are returned unchanged
+    """
+    if isinstance(m, ASCIIMonitorRecord): return m.text
+    if isinstance(m, str): return m
+    return ""
+
+def moniParsed(m):
+    """
+    (kind, values) of a structured ASCII monitoring message (see
+    domapptools.monitoring.parseASCIIMessage), (None, None) otherwise
+    """
+    if isinstance(m, ASCIIMonitorRecord): return m.parse()
+    return None, None
+
+def moniMessage(m):
+    """One-line debug rendering of a monitoring record (or anything else)"""
+    if isinstance(m, MonitorRecord): return m.message()
+    return m
+
 def getLastMoniMsgs(domapp):
     """
-    Drain buffered monitoring messages - return list of string representations
+    Drain buffered monitoring messages - return list of monitoring records
+    (a string if reading them failed)
     """
     ret = []
     try:
@@ -1065,9 +1074,9 @@ class ScalerDeadtimePulserTest(DOMAppTest):
         while not t.expired():
             mlist = getLastMoniMsgs(domapp)
             for m in mlist:
-                s1 = search(r'^F (\d+) (\d+) (\d+) (\d+)$', m)
-                if s1:
-                    deadtime = int(s1.group(4))
+                kind, val = moniParsed(m)
+                if kind == ASCII_FAST:
+                    deadtime = val[3]
                     if(deadtime <= 0):
                         numZeroRecs += 1
                         if numZeroRecs > 1:
@@ -1154,22 +1163,21 @@ class SPEScalerNotZeroTest(DOMAppHVTest):
                 mlist = getLastMoniMsgs(domapp)
                 for m in mlist:
                     self.debugMsgs.append(m)
-                    s1 = search(r'^F (\d+) (\d+) (\d+) (\d+)$', m)
-                    s2 = search(r'^\[HW EVT .+? (\d+) (\d+)\]', m)
-                    if s1:
+                    kind, val = moniParsed(m)
+                    if kind == ASCII_FAST:
                         gotMoniFast = True
                         if fastVirgin: fastVirgin = False # Skip first record which might be smaller or zero
                         else:
-                            fSPE = int(s1.group(1))
+                            fSPE = val[0]
                             if fSPE < 1:
                                 self.fail("Insufficient 'fast' SPE scaler value (%d counts)" % fSPE)
                                 ok = False
                                 break
-                    if s2:
+                    if isinstance(m, HardwareMonitorRecord):
                         gotMoniHW = True
                         if HWVirgin: HWVirgin = False
                         else:
-                            hwSPE = int(s2.group(1))
+                            hwSPE = m.getSPERate()
                             if hwSPE < 1:
                                 self.fail("Insufficient 'HW' SPE scaler value (%d counts)" % hwSPE)
                                 ok = False
@@ -1236,14 +1244,9 @@ class FastMoniTestHV(DOMAppHVTest):
             self.appendMoni(domapp)
             return
 
+        stats = HitStats()
         def countDeltaHits(): # Mini functionlette to count compressed hits
-            ret = 0
-            hitdata = domapp.getWaveformData()
-            if len(hitdata) > 0:
-                hitBuf = DeltaHitBuf(hitdata) # Does basic integrity check
-                for hit in hitBuf.next():
-                    ret += 1
-            return ret
+            return stats.ingest(domapp.getWaveformData()) # Does basic integrity check
         
         t = MiniTimer(self.runLength*1000)
         while not t.expired():
@@ -1265,32 +1268,28 @@ class FastMoniTestHV(DOMAppHVTest):
             gotF     = False
             gotHW    = False
             for m in mlist:
-                s1 = search(r'^F (\d+) (\d+) (\d+) (\d+)$', m)
-                s2 = search(r'^\[HW EVT .+? (\d+) (\d+)\]', m)
-                if s1:
+                kind, val = moniParsed(m)
+                if kind == ASCII_FAST:
                     gotF = True
                     fastMoniRecordCount += 1
-                    fSPE  = s1.group(1)
-                    fMPE  = s1.group(2)
-                    hitsMonitored += int(s1.group(3))
-                    fHits = int(s1.group(3))
-                    deadtime = int(s1.group(4))
+                    fSPE, fMPE, fHits, deadtime = val
+                    hitsMonitored += fHits
                     if deadtime <= 0:
                         numZeroRecs += 1
                         if numZeroRecs > 1:
                             self.fail("Too many bad scaler deadtime values! (%d)" % numZeroRecs)
-                if s2:
+                if isinstance(m, HardwareMonitorRecord):
                     gotHW = True
                     hwMoniRecordCount += 1
-                    hwSPE = s2.group(1)
-                    hwMPE = s2.group(2)
+                    hwSPE = m.getSPERate()
+                    hwMPE = m.getMPERate()
                 self.debugMsgs.append(m)
                 if gotF and gotHW:
                     gotF = False
                     gotHW = False
                     if(hwSPE != fSPE):
                         self.fail("ERROR: SPE values missing or disagree (%s %s)!" % (fSPE, hwSPE))
-                    elif(not hwMPE or hwMPE != fMPE):
+                    elif(hwMPE is None or hwMPE != fMPE):
                         self.fail("ERROR: MPE values missing or disagree (%s %s)!" % (fMPE, hwMPE))
             
         if(abs(expectedRecordCount-fastMoniRecordCount) > tolerance):
@@ -1324,9 +1323,9 @@ class FastMoniTestHV(DOMAppHVTest):
         
         mlist = getLastMoniMsgs(domapp)
         for m in mlist:
-            s1 = search(r'^F \d+ \d+ (\d+) \d+$', m)
-            if s1:
-                hitsMonitored += int(s1.group(1))
+            kind, val = moniParsed(m)
+            if kind == ASCII_FAST:
+                hitsMonitored += val[2]
                             
         if hitsReadOut != hitsMonitored:
             self.fail("Total hits monitored (%d) doesn't equal total hits read out (%d)"
@@ -1924,7 +1923,7 @@ class PedestalMonitoringTest(TimedDOMAppTest):
         domapp.collectPedestals(100, 100, 200, set_bias)
         
     def prepDomapp(self, domapp):
-        self.atwd_norm = [[[0 for bin in range(128)] for chan in range(3)] for chip in 0, 1]
+        self.atwd_norm = [0, 0] # Hits per chip
         self.atwd_sums = [[[0 for bin in range(128)] for chan in range(3)] for chip in 0, 1]
         self.totalBeaconHits = 0
         self.contaminated = False
@@ -1944,29 +1943,25 @@ class PedestalMonitoringTest(TimedDOMAppTest):
             mlist = getLastMoniMsgs(domapp)
             for m in mlist:
                 self.debugMsgs.append(m)
-                s = search(r'PED-ATWD (?P<atwd>\S+) CH (?P<ch>\d+)--'
-                           r'(?P<trials>\d+) trials, bias (?P<bias>\d+)', m)
-                if s:
+                kind, val = moniParsed(m)
+                if kind == ASCII_PED_ATWD:
                     pedcount += 1
                     if self._biases:
-                        atwdnum = s.group("atwd") == "B" and 1 or 0
-                        channel = int(s.group("ch"))
+                        atwd, channel, trials, bias_found = val
+                        atwdnum = atwd == "B" and 1 or 0
                         if channel == 3:
                             continue
                         bias_wanted = self._biases["atwd%s" % atwdnum][channel]
-                        bias_found = int(s.group("bias"))
                         if bias_wanted != bias_found:
                             self.fail("Expected programmed bias %d, got %d!!!" % \
                                       (bias_wanted, bias_found))
                     continue
 
-                s = search('pedestal average contaminated.*trial (\d+)', m)
-                if s:
-                    self.contaminatedTrials = int(s.group(1))
+                if kind == ASCII_PED_CONTAMINATED:
+                    self.contaminatedTrials = val
                     continue
 
-                s = search('continuing with possibly light-contaminated pedestal', m)
-                if s:
+                if kind == ASCII_PED_LIGHT:
                     self.contaminated = True
                     continue
                 
@@ -1989,11 +1984,10 @@ class PedestalMonitoringTest(TimedDOMAppTest):
             for hit in hitBuf.next():
                 assert hit.is_beacon, "Hit is not beacon hit!!! Data follows:\n%s" % hit
                 self.totalBeaconHits += 1
+                self.atwd_norm[hit.atwd_chip] += 1
+                sums = self.atwd_sums[hit.atwd_chip]
                 for chan in range(3):
-                    for bin in range(128):
-                        thisbin = hit.atwd[chan][bin]
-                        self.atwd_norm[hit.atwd_chip][chan][bin] += 1
-                        self.atwd_sums[hit.atwd_chip][chan][bin] += thisbin
+                    sums[chan] = waveform.accumulate(sums[chan], hit.atwd[chan])
         return False
 
     def finalCheck(self):
@@ -2004,12 +1998,12 @@ class PedestalMonitoringTest(TimedDOMAppTest):
         else:
             self.summary += "%d hits, " % self.totalBeaconHits
             for chip in range(2):
+                norm = self.atwd_norm[chip]
+                if norm == 0:
+                    self.fail("Got no waveform data for chip %d!" % chip)
+                    continue
                 for chan in range(3):
-                    sum_over_bins = 0.0
-                    for bin in range(128):
-                        sum = self.atwd_sums[chip][chan][bin]
-                        norm = self.atwd_norm[chip][chan][bin]
-                        sum_over_bins += sum/float(norm)
+                    sum_over_bins = sum(self.atwd_sums[chip][chan]) / float(norm)
                     average_over_bins = sum_over_bins / 128.
                     self.summary += "%1.3f " % average_over_bins
                     expected = self._biases['atwd%d' % chip][chan]
@@ -2183,6 +2177,7 @@ class DeltaCompressionBeaconTest(DOMAppTest):
         # collect data
         t = MiniTimer(self.runLength * 1000)
         gotData = False
+        stats = HitStats()
         while not t.expired():
             self.appendMoni(domapp)
 
@@ -2192,13 +2187,16 @@ class DeltaCompressionBeaconTest(DOMAppTest):
                 hitdata = domapp.getWaveformData()
                 if len(hitdata) > 0:
                     gotData = True
-                    hitBuf = DeltaHitBuf(hitdata)
-                    for hit in hitBuf.next():
-                        if hit.is_beacon and hit.natwdch < 3:
-                            self.debugMsgs.append("Beacon hit has insufficient readouts!!!")
-                            self.debugMsgs.append(`hit`)
-                            good = False
-                            break
+                    nbad = stats.beaconAtwdChannels[0] + stats.beaconAtwdChannels[1]
+                    stats.ingest(hitdata)
+                    if stats.beaconAtwdChannels[0] + stats.beaconAtwdChannels[1] > nbad:
+                        # Only decode the hits when there's a bad one to show
+                        for hit in DeltaHitBuf(hitdata).next():
+                            if hit.is_beacon and hit.natwdch < 3:
+                                self.debugMsgs.append("Beacon hit has insufficient readouts!!!")
+                                self.debugMsgs.append(`hit`)
+                                break
+                        good = False
             except Exception, e:
                 self.fail("GET WAVEFORM DATA FAILED: %s" % exc_string())
                 self.appendMoni(domapp)
@@ -2317,10 +2315,9 @@ def getLastModeTypeMsg(mlist):
     """
     mode, type = None, None
     for l in mlist:
-        m = search('set_HAL_lc_mode\(LCmode=(\d+), LCtype=(\d+)\)', l)
-        if m:
-            mode = int(m.group(1))
-            type = int(m.group(2))
+        kind, val = moniParsed(l)
+        if kind == ASCII_LC_MODE:
+            mode, type = val
     return mode, type
 
 
@@ -2392,8 +2389,8 @@ class MinimumBiasTest(TimedDOMAppTest):
                             # another, causing beacons to be
                             # suppressed; also we stop early when a
                             # beacon hit is found        
-        self.gotMinbias = False
-        self.totalHits  = 0
+        self.stats      = HitStats()
+        self.clocks     = HitClockSeries()
         TimedDOMAppTest.prepDomapp(self, domapp)
         domapp.setDataFormat(2)
         domapp.setCompressionMode(2)
@@ -2411,20 +2408,20 @@ class MinimumBiasTest(TimedDOMAppTest):
     def interval(self, domapp):
         hitdata = domapp.getWaveformData()
         if len(hitdata) > 0:
-            hitBuf = DeltaHitBuf(hitdata)
-            for hit in hitBuf.next():
-                self.totalHits += 1
-                self.debugMsgs.append("hit word0 = 0x%x" % hit.words[0])
-                if hit.isMinbias:
-                    self.gotMinbias = True
-                    return True # Test successful, if cleanup is ok
+            self.clocks.add(hitdata)
+            n = self.stats.ingest(hitdata)
+            self.debugMsgs.append("%d hits, %d minbias so far" % (n, self.stats.minbias))
+            if self.stats.minbias > 0:
+                return True # Test successful, if cleanup is ok
         return False # Keep going
 
     def finalCheck(self):
-        if self.totalHits < 1:
+        if self.stats.nhits < 1:
             self.fail("Got no waveform data!!!")
-        if not self.gotMinbias:
-            self.fail("Got no minimum bias data (%d total hits)!!!" % self.totalHits)
+        if self.stats.minbias < 1:
+            self.fail("Got no minimum bias data (%d total hits)!!!" % self.stats.nhits)
+        self.summary = "%d hits, %2.1f Hz (DOM clock)" % (self.stats.nhits,
+                                                          self.clocks.meanRate())
 
 class ATWDSelectTest(TimedDOMAppTest):
     """
@@ -2432,8 +2429,7 @@ class ATWDSelectTest(TimedDOMAppTest):
     """
     def prepDomapp(self, domapp):
         self.hadData  = False
-        self.hadAtwdA = False
-        self.hadAtwdB = False
+        self.stats    = HitStats()
         TimedDOMAppTest.prepDomapp(self, domapp)
         setDAC(domapp, DAC_INTERNAL_PULSER_AMP, 1000)
         setDAC(domapp, DAC_SINGLE_SPE_THRESH, 600)
@@ -2447,12 +2443,7 @@ class ATWDSelectTest(TimedDOMAppTest):
         hitdata = domapp.getWaveformData()
         if len(hitdata) > 0:
             self.hadData = True
-            hitBuf = DeltaHitBuf(hitdata)
-            for hit in hitBuf.next():
-                if hit.atwd_chip == 0:
-                    self.hadAtwdA = True
-                elif hit.atwd_chip == 1:
-                    self.hadAtwdB = True
+            self.stats.ingest(hitdata)
         return False # Don't abort early
 
     def cleanup(self, domapp):
@@ -2472,9 +2463,9 @@ class ATWDAOnlyTest(ATWDSelectTest):
         ATWDSelectTest.prepDomapp(self, domapp)
                                                    
     def finalCheck(self):
-        if not self.hadAtwdA:
+        if not self.stats.atwdChip[0]:
             self.fail("Got no ATWD A data!")
-        if self.hadAtwdB:
+        if self.stats.atwdChip[1]:
             self.fail("Got ATWD B data - shouldn't have!")
         ATWDSelectTest.finalCheck(self)
 
@@ -2487,9 +2478,9 @@ class ATWDBOnlyTest(ATWDSelectTest):
         ATWDSelectTest.prepDomapp(self, domapp)
 
     def finalCheck(self):
-        if self.hadAtwdA:
+        if self.stats.atwdChip[0]:
             self.fail("Got ATWD A data - shouldn't have!")
-        if not self.hadAtwdB:
+        if not self.stats.atwdChip[1]:
             self.fail("Got no ATWD B data!")
         ATWDSelectTest.finalCheck(self)
 
@@ -2504,9 +2495,9 @@ class ATWDBothTest(ATWDSelectTest):
         ATWDSelectTest.prepDomapp(self, domapp)
         
     def finalCheck(self):
-        if not self.hadAtwdA:
+        if not self.stats.atwdChip[0]:
             self.fail("Got no ATWD A data!")
-        if not self.hadAtwdB:
+        if not self.stats.atwdChip[1]:
             self.fail("Got no ATWD B data!")
         ATWDSelectTest.finalCheck(self)
 
@@ -2566,9 +2557,9 @@ class LCFRecordsTest(TimedDOMAppTest):
             self.hadData = True
         moni = getLastMoniMsgs(domapp)
         for msg in moni:
-            s = search(r'^F (\d+) (\d+) (\d+) (\d+)$', msg)
-            if s:
-                hits = int(s.group(3))
+            kind, val = moniParsed(msg)
+            if kind == ASCII_FAST:
+                hits = val[2]
                 self.hit_sum += hits
                 self.num_hit_recs += 1
 
@@ -2605,12 +2596,10 @@ def lbm_moni_warning_pointers(msg):
     """
     Detect LBM overflow in message and extract relevant pointers
     """
-    if 'LBM OVER' in msg:
-        m = search('pointer=(.+?) lbmp=(.+)', msg)
-        assert(m)
-        wrptr = int(m.group(1), 16)
-        rdptr = int(m.group(2), 16)
-        return wrptr, rdptr
+    if 'LBM OVER' in moniText(msg):
+        kind, val = moniParsed(msg)
+        assert(kind == ASCII_LBM_OVER)
+        return val
     return None, None
 
 
@@ -2629,6 +2618,7 @@ class LBMOverflowTest(TimedDOMAppTest):
         domapp.setTriggerMode(SPE_DISC_TRIG_MODE)            
         domapp.setPulser(mode=BEACON, rate=40000)
         self.had_wf = False
+        self.clocks = HitClockSeries()
 
     def runcore(self, domapp):
         """
@@ -2673,6 +2663,7 @@ class LBMOverflowTest(TimedDOMAppTest):
             wf_data = domapp.getWaveformData() # Trigger LBM check
             if len(wf_data) > 0:
                 self.had_wf = True
+                self.clocks.add(wf_data)
             wrptr, rdptr = domapp.get_lbm_ptrs()
 
             if not i%100:
@@ -2684,8 +2675,11 @@ class LBMOverflowTest(TimedDOMAppTest):
                 break
             
         # Collect more WF data to make sure LBM message is triggered
-        while len(domapp.getWaveformData()) == 0:
-            pass
+        while True:
+            wf_data = domapp.getWaveformData()
+            if len(wf_data) > 0:
+                self.clocks.add(wf_data)
+                break
 
         # Collect resulting LBM warnings, if any:
         found_last_lbm_warnings = False
@@ -2706,6 +2700,14 @@ class LBMOverflowTest(TimedDOMAppTest):
     def finalCheck(self):
         if not self.had_wf:
             self.fail("No waveform data received!!!")
+        # Hits may be lost or reordered around the wrap, so this is only
+        # reported, not a failure
+        bad = self.clocks.outOfOrder()
+        if bad:
+            msg = "%d of %d hits out of DOM clock order across LBM wrap" % \
+                  (len(bad), len(self.clocks))
+            self.summary += msg
+            self.debugMsgs.append(msg)
 
 class FADCDAQModeTest(TimedDOMAppTest):
     """
@@ -2887,10 +2889,161 @@ class selfLocalCoincidenceTest(TimedDOMAppTest):
             self.fail("Got no self-LC events!")
 
 ################################### HIGH-LEVEL TESTING LOGIC ###############################
+
+class PipeWriter:
+    "stdout replacement for worker processes: sends whole lines to the parent"
+    def __init__(self, send):
+        self.send = send
+        self.buf  = ""
+        self.lock = threading.Lock()
+
+    def write(self, s):
+        self.lock.acquire()
+        try:
+            self.buf += s
+            i = self.buf.rfind("\n")
+            if i >= 0:
+                self.send(("log", self.buf[:i+1]))
+                self.buf = self.buf[i+1:]
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.buf: self.send(("log", self.buf))
+            self.buf = ""
+        finally:
+            self.lock.release()
             
+DEFAULT_TEST_SECONDS = 10 # Estimated duration of a test with no run length or history
+
+def _bits(n):
+    count = 0
+    while n:
+        n &= n - 1
+        count += 1
+    return count
+
+def planTests(tests, startState, counts, doOnly=False, selected={}, domappOnly=False,
+              estimate=None, endState=None):
+    """
+    Plan the order in which to run tests (DOMTest objects) starting from
+    startState; returns a list of indices into tests.  counts maps test
+    class names to the number of times to run them.  Same-state tests are
+    run (only those in selected if doOnly) on the first visit to their
+    state; every state-change test is run at least once (only when needed
+    to reach a state with tests, if doOnly).
+
+    The walk through the DOM states is a shortest path from (startState,
+    nothing done) to (endState, everything done) in the graph of (state,
+    state-change tests done, states with tests visited), found with
+    Dijkstra's algorithm.  It therefore does the fewest state changes
+    possible, and, among those, takes the least estimated time (estimate
+    is a function of a test giving its duration in seconds); remaining
+    ties go to the walk taking tests earliest in the list.  If some
+    tests can't be reached at all, the plan covers as many as it can.
+    """
+    if estimate is None:
+        estimate = lambda t: t.runLength or DEFAULT_TEST_SECONDS
+    inState = {}  # State -> indices of same-state tests to run there
+    edges   = []  # Indices of state-change tests
+    need    = []  # Indices of state-change tests which must be run
+    for i in range(len(tests)):
+        t = tests[i]
+        name = t.__class__.__name__
+        if domappOnly \
+               and t.startState != DOMTest.STATE_DOMAPP \
+               and t.endState != DOMTest.STATE_DOMAPP:
+            continue
+        if counts.get(name, 1) < 1: continue
+        if t.startState != t.endState:
+            edges.append(i)
+            if not doOnly or selected.has_key(name): need.append(i)
+        elif not doOnly or selected.has_key(name):
+            inState.setdefault(t.startState, []).append(i)
+
+    needBit = {}
+    for k in range(len(need)): needBit[need[k]] = 1 << k
+    stateBit = {}
+    for k, s in enumerate(inState.keys()): stateBit[s] = 1 << k
+    allDone = (1 << len(need)) - 1
+    allSeen = (1 << len(stateBit)) - 1
+
+    start = (startState, 0, stateBit.get(startState, 0))
+    dist  = {start : (0, 0., ())} # Node -> (state changes, seconds, walk)
+    heap  = [((0, 0., ()), start)]
+    settled = {}
+    goal  = None
+    while heap:
+        cost, node = heappop(heap)
+        if settled.has_key(node): continue
+        settled[node] = True
+        state, done, seen = node
+        if done == allDone and seen == allSeen and endState in (None, state):
+            goal = node
+            break
+        for i in edges:
+            t = tests[i]
+            if t.startState != state: continue
+            nxt = (t.endState, done | needBit.get(i, 0), seen | stateBit.get(t.endState, 0))
+            c = (cost[0] + 1, cost[1] + estimate(t), cost[2] + (i,))
+            if not dist.has_key(nxt) or c < dist[nxt]:
+                dist[nxt] = c
+                heappush(heap, (c, nxt))
+
+    if goal is None: # Cover as much as possible, cheapest first
+        def badness(node):
+            state, done, seen = node
+            return (-_bits(done) - _bits(seen), endState not in (None, state), dist[node])
+        goal = min([(badness(node), node) for node in settled.keys()])[1]
+
+    plan = []
+    visited = {}
+    def visit(state):
+        if visited.has_key(state): return
+        visited[state] = True
+        for i in inState.get(state, []):
+            plan.extend([i] * counts.get(tests[i].__class__.__name__, 1))
+    visit(startState)
+    for i in dist[goal][2]:
+        plan.append(i)
+        visit(tests[i].endState)
+    return plan
+
+def formatPlan(tests, plan, estimate=None):
+    """
+    Text listing a plan from planTests(), one line per test (repeats
+    collapsed), with the number of state changes and estimated duration
+    """
+    if estimate is None:
+        estimate = lambda t: t.runLength or DEFAULT_TEST_SECONDS
+    lines = []
+    total = 0.
+    changes = 0
+    k = 0
+    while k < len(plan):
+        i = plan[k]
+        n = 1
+        while k+n < len(plan) and plan[k+n] == i: n += 1
+        t = tests[i]
+        secs = n * estimate(t)
+        total += secs
+        if t.startState != t.endState: changes += n
+        rep = ""
+        if n > 1: rep = " x%d" % n
+        lines.append("  %s->%s %-36s %7.0f sec" % (t.startState, t.endState,
+                                                    t.__class__.__name__ + rep, secs))
+        k += n
+    lines.insert(0, "Test plan: %d tests, %d state changes, about %d sec per DOM" %
+                 (len(plan), changes, total))
+    return "\n".join(lines)
+
 class TestingSet:
     "Class for running multiple tests on a group of DOMs in parallel"
-    def __init__(self, domDict, doOnly=False, domappOnly=False, stopOnFail=False, useDomapp=None):
+    def __init__(self, domDict, doOnly=False, domappOnly=False, stopOnFail=False, useDomapp=None,
+                 saveHits=None, saveMoni=None, moniRotate=0, workers=None, watchdog=600,
+                 timingsFile=None):
         self.domDict      = domDict
         self.testList     = []
         self.durationDict = {}
@@ -2907,6 +3060,21 @@ class TestingSet:
         self.stopOnFail   = stopOnFail
         self.useDomapp    = useDomapp
         self.domappOnly   = domappOnly
+        self.saveHits     = saveHits # Directory for per-DOM hit archives
+        self.saveMoni     = saveMoni # Directory for per-DOM .moni files
+        self.moniRotate   = moniRotate # Start a new .moni file every this many seconds
+        self.workers      = workers  # None (threads), "dom" or "card": process per DOM/card
+        self.watchdog     = watchdog # Seconds a test may overrun its run length (workers only)
+        self.conn         = None     # Pipe to the parent process, in a worker
+        self.sendLock     = threading.Lock()
+        self.timingsFile  = timingsFile # JSON file of past test durations
+        self.timings      = {}          # Test name -> [runs, mean seconds]
+        if timingsFile and exists(timingsFile):
+            import json # Only needed with a timings file (Python 2.6)
+            try:
+                self.timings = json.load(open(timingsFile))
+            except (IOError, ValueError), e:
+                print "Ignoring test timings in %s: %s" % (timingsFile, e)
 
     def add(self, test):
         self.testList.append(test)
@@ -2932,49 +3100,50 @@ class TestingSet:
 
     def cycle(self, testList, startState, doOnly, domappOnly, c, w, d):
         """
-        Cycle through all tests, visiting first all the ones in the current state, then
-        moving on to another state, and so on until all in-state and state-change tests
-        have completed
+        Generator over the tests in the order planned by planTests(), which
+        changes the DOM state as few times as possible and ends back in
+        startState
         """
-        
-        state = startState
-        doneDict = {}
-        while True:
-            allDone = True
-            allDoneThisState = True
-            nextTest = None
-            nextStateChangeTest = None
-            for test in testList:
-                if not doneDict.has_key(test): doneDict[test] = 0
-                # Skip non-domapp tests if required:
-                if domappOnly \
-                       and test.startState != DOMTest.STATE_DOMAPP \
-                       and test.endState != DOMTest.STATE_DOMAPP:
-                    continue
-                # Use "test" if 
-                # (1) test count hasn't surpassed specified count, and
-                # (2) state doesn't change, and
-                # (3) either we're doing all standard tests, or this test has been
-                #     specified explicitly on the command line
-                # otherwise use next state change
-                if (doneDict[test] < self.ntrialsDict[test.__class__.__name__]) \
-                       and test.startState == state:
-                    nextTest = test
-                    if test.endState == state \
-                           and (not doOnly
-                                or self.dontSkipDict.has_key(test.__class__.__name__)):
-                        allDone = False
-                        allDoneThisState = False
-                        break
-                    else:
-                        allDone = False
-                        nextStateChangeTest = test
-            if allDone: return
-            elif allDoneThisState:
-                nextTest = nextStateChangeTest
-            state = nextTest.endState
-            doneDict[nextTest] += 1
-            yield nextTest
+        for i in planTests(testList, startState, self.ntrialsDict, doOnly, self.dontSkipDict,
+                           domappOnly, self.estimate, endState=startState):
+            yield testList[i]
+
+    def estimate(self, test):
+        "Estimated duration of a test: its set run length, else past runs, else its default"
+        name = test.__class__.__name__
+        for t in self.testList:
+            if t.__name__ == name and self.durationDict[t]:
+                return self.durationDict[t]
+        if self.timings.has_key(name):
+            return self.timings[name][1]
+        return test.runLength or DEFAULT_TEST_SECONDS
+
+    def recordTiming(self, name, seconds, maxRuns=20):
+        "Update the running mean duration of a test, weighting the last maxRuns runs"
+        runs, mean = self.timings.get(name, (0, 0.))
+        runs = min(runs + 1, maxRuns)
+        self.timings[name] = [runs, mean + (seconds - mean) / runs]
+
+    def saveTimings(self):
+        if not self.timingsFile: return
+        import json
+        tmp = self.timingsFile + ".tmp"
+        try:
+            f = open(tmp, "w")
+            json.dump(self.timings, f, indent=1, sort_keys=True)
+            f.close()
+            os.rename(tmp, self.timingsFile)
+        except (IOError, OSError), e:
+            print "Could not save test timings to %s: %s" % (self.timingsFile, e)
+
+    def plan(self, startState=DOMTest.STATE_ICEBOOT):
+        "Text of the test plan for one cycle on one DOM"
+        tests = []
+        for t in self.testList:
+            tests.append(t(0, 0, 'A', None))
+        plan = planTests(tests, startState, self.ntrialsDict, self.doOnly, self.dontSkipDict,
+                         self.domappOnly, self.estimate, endState=startState)
+        return formatPlan(tests, plan, self.estimate)
 
     def doAllTests(self, domid, c, w, d, doQuiet):
         startState = DOMTest.STATE_ICEBOOT
@@ -3023,65 +3192,224 @@ class TestingSet:
                                                         % t.__class__.__name__ + "cannot be repeated.")
         for test in self.cycle(testObjList, startState, self.doOnly, self.domappOnly, c, w, d):
             tstart = time.strftime("%d %b %Y %H:%M:%S", time.localtime())
+            self.testStarting(c, w, d, test)
             t0 = time.time()
             test.reset()
             test.run(dor.fd)
-            dt = "%2.2f" % (time.time()-t0)
+            secs = time.time()-t0
+            dt = "%2.2f" % secs
             if(test.startState != test.endState): # If state change, flush buffers etc. to get clean IO
                 dor.close()
                 dor.open()
 
-            sf = False
-            #### LOCK - have to protect shared counters, as well as TTY...
-            self.counterLock.acquire()
             runLenStr = ""
             if test.runLength: runLenStr = "%d sec " % test.runLength
-            if not doQuiet or test.result != "PASS":
-                print "%s%s%s %s %s->%s %s %s%s: %s %s" % (c,w,d, tstart, test.startState,
-                                                           test.endState, dt, runLenStr,
-                                                           test.__class__.__name__, test.result,
-                                                           test.summary)
-            if test.result == "PASS":
-                self.numpassed += 1
-            else:
-                self.numfailed += 1
-                print "################################################"
-                dbg = test.getDebugTxt()
-                if len(dbg) > 0:
-                    print dbg
-                    print "################################################"
-                if self.stopOnFail: sf = True
-            self.numtests += 1
+            line = "%s%s%s %s %s->%s %s %s%s: %s %s" % (c,w,d, tstart, test.startState,
+                                                        test.endState, dt, runLenStr,
+                                                        test.__class__.__name__, test.result,
+                                                        test.summary)
+            passed = test.result == "PASS"
+            dbg = ""
+            if not passed: dbg = test.getDebugTxt()
             test.clearDebugTxt()
-            self.counterLock.release()
-            #### UNLOCK
-            if sf: break # Quit upon first failure
+            if self.conn:
+                self.send(("result", "%s%s%s" % (c,w,d), line, passed, dbg,
+                           test.__class__.__name__, secs))
+            else:
+                #### LOCK - have to protect shared counters, as well as TTY...
+                self.counterLock.acquire()
+                try:
+                    self.showResult(line, passed, dbg, doQuiet)
+                    self.recordTiming(test.__class__.__name__, secs)
+                finally:
+                    self.counterLock.release()
+                #### UNLOCK
+            if not passed and self.stopOnFail: break # Quit upon first failure
         dor.close()
+
+    def testStarting(self, c, w, d, test):
+        "In a worker process, tell the parent's watchdog which test is starting"
+        if self.conn:
+            self.send(("start", "%s%s%s" % (c,w,d), test.__class__.__name__, test.runLength))
+
+    def send(self, msg):
+        "Send a message to the parent process; the DOM threads share the pipe"
+        self.sendLock.acquire()
+        try:
+            self.conn.send(msg)
+        finally:
+            self.sendLock.release()
+
+    def showResult(self, line, passed, dbg, doQuiet):
+        "Print and count one test result"
+        if not doQuiet or not passed:
+            print line
+        if passed:
+            self.numpassed += 1
+        else:
+            self.numfailed += 1
+            print "################################################"
+            if len(dbg) > 0:
+                print dbg
+                print "################################################"
+        self.numtests += 1
             
     def runThread(self, domid, doQuiet, nCycles):
         c, w, d = self.domDict[domid]
         dor = Driver()
+        archive = None
+        if self.saveHits:
+            archive = HitArchiveWriter(os.path.join(self.saveHits, "%s%s%s" % (c,w,d)), domid)
+            setHitArchive(c, w, d, archive)
+        moniWriter = None
+        if self.saveMoni:
+            moniWriter = MoniFileWriter(os.path.join(self.saveMoni, "%s%s%s.moni" % (c,w,d)),
+                                        domid, maxSeconds=self.moniRotate)
+            setMoniWriter(c, w, d, moniWriter)
         try:
-            for i in range(nCycles):
-                self.doAllTests(domid, c,w,d, doQuiet)
-        except KeyboardInterrupt:
-            raise SystemExit
-        except Exception, e:
-            print "Test sequence aborted: %s" % exc_string()        
+            try:
+                for i in range(nCycles):
+                    self.doAllTests(domid, c,w,d, doQuiet)
+            except KeyboardInterrupt:
+                raise SystemExit
+            except Exception, e:
+                print "Test sequence aborted: %s" % exc_string()        
+        finally:
+            if archive:
+                setHitArchive(c, w, d, None)
+                archive.close()
+            if moniWriter:
+                setMoniWriter(c, w, d, None)
+                moniWriter.close()
         
     def go(self, doQuiet, nCycles):
         self.tStart = datetime.now()
-        for dom in self.domDict:
+        if not doQuiet: print self.plan()
+        try:
+            if self.workers:
+                self.goWorkers(doQuiet, nCycles)
+            else:
+                self.startThreads(self.domDict.keys(), doQuiet, nCycles)
+        finally:
+            self.saveTimings()
+
+    def startThreads(self, domids, doQuiet, nCycles):
+        for dom in domids:
             self.threads[dom] = threading.Thread(target=self.runThread, args=(dom, doQuiet, nCycles))
             self.threads[dom].setDaemon(True)
             self.threads[dom].start()
-        for dom in self.domDict:
+        for dom in domids:
             try:
                 self.threads[dom].join()
             except Exception, e:
                 print exc_string()
                 raise SystemExit
         
+    def workerGroups(self):
+        """
+        Lists of the DOM IDs run by each worker process: one DOM or one card
+        each.  Partner DOMs stay in one process if any test has to
+        synchronize with its partner, since that is done with threading
+        events.
+        """
+        sync = False
+        for t in self.testList:
+            try:
+                if t(0, 0, 'A', None).requiresSync(): sync = True
+            except Exception:
+                pass
+        groups = {}
+        for domid, (c, w, d) in self.domDict.items():
+            if self.workers == "card":  key = c
+            elif sync:                  key = (c, w)
+            else:                       key = (c, w, d)
+            groups.setdefault(key, []).append(domid)
+        return groups.values()
+
+    def runWorker(self, domids, conn, doQuiet, nCycles):
+        "Worker process: run the DOMs' test threads, sending all output to the parent"
+        self.conn = conn
+        sys.stdout = PipeWriter(self.send)
+        try:
+            self.startThreads(domids, doQuiet, nCycles)
+        finally:
+            sys.stdout.flush()
+            conn.close()
+
+    def goWorkers(self, doQuiet, nCycles):
+        """
+        Run the DOMs in worker processes; collect their results and log
+        lines, and kill any worker whose current test has run watchdog
+        seconds longer than its run length
+        """
+        from multiprocessing import Process, Pipe
+        workers = {} # Parent end of pipe -> (process, DOM names)
+        for domids in self.workerGroups():
+            parentConn, childConn = Pipe(duplex=False)
+            proc = Process(target=self.runWorker, args=(domids, childConn, doQuiet, nCycles))
+            proc.daemon = True
+            proc.start()
+            childConn.close()
+            doms = ["%s%s%s" % self.domDict[domid] for domid in domids]
+            workers[parentConn] = (proc, doms)
+        current = {} # DOM -> (test name, start time, seconds allowed)
+        try:
+            while workers:
+                ready, junk, junk = select.select(workers.keys(), [], [], 1.0)
+                for conn in ready:
+                    try:
+                        msg = conn.recv()
+                    except (EOFError, IOError):
+                        self.endWorker(workers, conn, current, doQuiet)
+                        continue
+                    if msg[0] == "start":
+                        kind, dom, name, runLength = msg
+                        current[dom] = (name, time.time(), self.watchdog + (runLength or 0))
+                    elif msg[0] == "result":
+                        kind, dom, line, passed, dbg, name, secs = msg
+                        current.pop(dom, None)
+                        self.showResult(line, passed, dbg, doQuiet)
+                        self.recordTiming(name, secs)
+                    elif msg[0] == "log":
+                        sys.stdout.write(msg[1])
+                now = time.time()
+                for conn, (proc, doms) in workers.items():
+                    hung = [dom for dom in doms if dom in current
+                            and now - current[dom][1] > current[dom][2]]
+                    if not hung: continue
+                    proc.terminate()
+                    for dom in doms:
+                        if dom not in current: continue
+                        name, t0, allowed = current.pop(dom)
+                        if dom in hung: why = "no result after %d sec" % allowed
+                        else:           why = "worker killed for hung partner"
+                        self.showResult("%s %s: FAIL watchdog: %s" % (dom, name, why),
+                                        False, "", doQuiet)
+                    self.endWorker(workers, conn, current, doQuiet, killed=True)
+        except KeyboardInterrupt:
+            for proc, doms in workers.values(): proc.terminate()
+            raise SystemExit
+
+    def endWorker(self, workers, conn, current, doQuiet, killed=False):
+        """
+        Reap a worker whose pipe has closed.  Tests it was still running are
+        reported as failed, and so is a worker that exited with an error
+        without any test in flight (unless the watchdog killed it)
+        """
+        proc, doms = workers.pop(conn)
+        conn.close()
+        proc.join()
+        lost = False
+        for dom in doms:
+            if dom not in current: continue
+            name, t0, allowed = current.pop(dom)
+            self.showResult("%s %s: FAIL worker exited (exit code %s) during test" %
+                            (dom, name, proc.exitcode), False, "", doQuiet)
+            lost = True
+        if proc.exitcode and not lost and not killed:
+            self.showResult("%s: FAIL worker exited with exit code %s" %
+                            (" ".join(doms), proc.exitcode), False, "", doQuiet)
+
     def summary(self):
         "show summary of results"
         dt = datetime.now() - self.tStart
@@ -3151,6 +3479,40 @@ def main():
                  action="store_true",
                  dest="doQuiet",      help="Suppress output for successful tests")
 
+    p.add_option("-w", "--save-hits",
+                 action="store",      type="string",
+                 dest="saveHits",     help="Save all hit data read to per-DOM " +\
+                                           "archives in this directory")
+
+    p.add_option("-M", "--save-moni",
+                 action="store",      type="string",
+                 dest="saveMoni",     help="Save all monitoring data read to per-DOM " +\
+                                           "StringHub-format .moni files in this directory")
+
+    p.add_option("--moni-rotate",
+                 action="store",      type="int",
+                 dest="moniRotate",   help="Start a new .moni file every N seconds " +\
+                                           "(default: one file per DOM)")
+
+    p.add_option("--workers",
+                 action="store",      type="choice",    choices=["dom", "card"],
+                 dest="workers",      help="Run each DOM's (dom) or each card's (card) tests " +\
+                                           "in a separate process")
+
+    p.add_option("--watchdog",
+                 action="store",      type="int",
+                 dest="watchdog",     help="With --workers, kill a worker whose test has run " +\
+                                           "this many seconds past its run length (default 600)")
+
+    p.add_option("--plan",
+                 action="store_true",
+                 dest="showPlan",     help="Print the planned order of tests and exit")
+
+    p.add_option("--timings",
+                 action="store",      type="string",
+                 dest="timingsFile",  help="Read and update past test durations in this file, " +\
+                                           "to estimate the run time (default: don't keep them)")
+
     p.add_option("-r", "--repeat-all",
                  action="store",      type="int",
                  dest="nCycles",      help="Number of times to repeat entire test cycle (default=1)")
@@ -3167,6 +3529,13 @@ def main():
                    doQuiet          = False,
                    nCycles          = 1,
                    uploadApp        = None,
+                   saveHits         = None,
+                   saveMoni         = None,
+                   moniRotate       = 0,
+                   workers          = None,
+                   watchdog         = 600,
+                   showPlan         = False,
+                   timingsFile      = None,
                    listTests        = False)
     opt, args = p.parse_args()
 
@@ -3181,8 +3550,6 @@ def main():
                    SoftbootCycle,
                    IcebootToDomapp]
 
-    # Domapp tests have to be kept together for the
-    # -o option to work correctly (FIXME)
     ListOfTests.extend([ATWDAOnlyTest,
                         ATWDBOnlyTest,
                         ATWDBothTest,
@@ -3258,21 +3625,11 @@ def main():
                         EchoCommResetTest,
                         EchoToIceboot])
 
-    try:
-        dor = Driver()
-        dor.enable_blocking(0)
-        domDict = dor.get_active_doms(opt.excludeDoms)
-    except Exception, e:
-        print "No driver present? ('%s')" % e
-        raise SystemExit
-
-    if opt.uploadApp and not exists(opt.uploadApp):
-        print "File %s does not exist!" % opt.uploadApp
-        raise SystemExit
-
-
-    testSet = TestingSet(domDict, doOnly=opt.doOnly, domappOnly=opt.domappOnly,
-                         stopOnFail=opt.stopFail, useDomapp=opt.uploadApp)
+    testSet = TestingSet({}, doOnly=opt.doOnly, domappOnly=opt.domappOnly,
+                         stopOnFail=opt.stopFail, useDomapp=opt.uploadApp,
+                         saveHits=opt.saveHits, saveMoni=opt.saveMoni,
+                         moniRotate=opt.moniRotate, workers=opt.workers,
+                         watchdog=opt.watchdog, timingsFile=opt.timingsFile)
 
     for t in ListOfTests:
         testSet.add(t)
@@ -3299,7 +3656,25 @@ def main():
             if t.__doc__:
                 print '\t', t.__doc__
         raise SystemExit
-    
+
+    if opt.showPlan:
+        print testSet.plan()
+        raise SystemExit
+
+    try:
+        dor = Driver()
+        dor.enable_blocking(0)
+        domDict = dor.get_active_doms(opt.excludeDoms)
+    except Exception, e:
+        print "No driver present? ('%s')" % e
+        raise SystemExit
+
+    if opt.uploadApp and not exists(opt.uploadApp):
+        print "File %s does not exist!" % opt.uploadApp
+        raise SystemExit
+
+    testSet.domDict = domDict # Tests could be listed and planned without a driver
+
     revTxt = "UNKNOWN/head"
     try:
         revTxt = getDomappToolsPythonVersion() # Can fail if not an official installation
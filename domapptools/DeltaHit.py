@@ -6,12 +6,12 @@
 
 from __future__ import generators
 import unittest
-from struct import unpack
+from struct import unpack, unpack_from
 
 class MalformedDeltaCompressedHitBuffer(Exception): pass
 
 class DeltaHit:
-    def __init__(self, hitbuf):
+    def __init__(self, hitbuf, tmsb=0):
         self.words = unpack('<2I', hitbuf[0:8])
         iscompressed = (self.words[0] & 0x80000000L) >> 31 # Use L constant to suppress maxint warning
         if not iscompressed:
@@ -28,6 +28,8 @@ class DeltaHit:
         self.is_spe = self.trigger & 0x01
         self.is_mpe = self.trigger & 0x02
         self.is_beacon = self.trigger & 0x04
+        # Full 48-bit DOM clock: 16 MSBs come from the buffer header
+        self.domclk     = (long(tmsb) << 32) | self.words[1]
         self.hitbytes = hitbuf[16:]
 
     def __repr__(self):
@@ -35,11 +37,12 @@ class DeltaHit:
         lcdn = self.lcdown and "LCDN" or ""
         return ("W0 0x%08x W1 0x%08x %s %s  Hit-size=%4d  "
                "ATWD-avail=%s  FADC-avail=%s  A/B=%d  "
-               "#ATWD=%d  trigword=0x%04x  rest=%d %s" %
+               "#ATWD=%d  trigword=0x%04x  clk=0x%012x  rest=%d %s" %
                 (self.words[0], self.words[1], lcup, lcdn, self.hitsize,
                  self.atwd_avail and "Y" or "n",
                  self.fadc_avail and "Y" or "n", self.atwd_chip,
-                 self.natwdch, self.trigger, len(self.hitbytes), [ord(b) for b in self.hitbytes]))
+                 self.natwdch, self.trigger, self.domclk,
+                 len(self.hitbytes), [ord(b) for b in self.hitbytes]))
 
 
 class DeltaHitBuf:
@@ -51,12 +54,27 @@ class DeltaHitBuf:
         nb -= 8
         if nb <= 0:
             raise MalformedDeltaCompressedHitBuffer()
+        self.tmsb    = tmsb
         self.payload = hitdata[8:]
-        
+
+    def headers(self):
+        """
+        Walk the buffer without building DeltaHit objects; yields
+        (offset, hitsize, word0, word1) for each hit, where offset
+        is relative to self.payload
+        """
+        payload = self.payload
+        n = len(payload)
+        pos = 0
+        while n - pos > 8:
+            w0, w1 = unpack_from('<2I', payload, pos)
+            hitsize = w0 & 0x7FF
+            if hitsize < 8:
+                raise MalformedDeltaCompressedHitBuffer("hit size %d at offset %d"
+                                                        % (hitsize, pos))
+            yield pos, hitsize, w0, w1
+            pos += hitsize
+
     def next(self):
-        rest = self.payload
-        while(len(rest) > 8):
-            words = unpack('<2i', rest[0:8])
-            hitsize = words[0] & 0x7FF
-            yield DeltaHit(rest[0:hitsize])
-            rest = rest[hitsize:]
+        for pos, hitsize, w0, w1 in self.headers():
+            yield DeltaHit(self.payload[pos:pos+hitsize], self.tmsb)
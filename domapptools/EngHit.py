@@ -6,7 +6,7 @@
 
 from __future__ import generators
 import unittest
-from struct import unpack, calcsize
+from struct import unpack, unpack_from, calcsize
 from cStringIO import StringIO
 from array import array
 
@@ -69,6 +69,22 @@ class MalformedEngineeringEventBuffer(Exception): pass
 class EngHitBuf:
     def __init__(self, hitdata):
         self.hitdata = hitdata
+
+    def headers(self):
+        """
+        Walk the buffer without building EngHit objects; yields
+        (offset, nbytes, trigByte, domclk) for each hit
+        """
+        hitdata = self.hitdata
+        n = len(hitdata)
+        pos = 0
+        while pos < n:
+            if n - pos < 16: raise MalformedEngineeringEventBuffer()
+            nb, = unpack_from('>H', hitdata, pos)
+            if nb <= 0: raise MalformedEngineeringEventBuffer()
+            trigByte, hi, lo = unpack_from('>B1xHI', hitdata, pos+8)
+            yield pos, nb, trigByte, (long(hi) << 32) | lo
+            pos += nb
         
     def next(self):
         while self.hitdata:
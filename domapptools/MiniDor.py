@@ -180,11 +180,17 @@ class MiniDor:
         f = file(os.path.join(self.cardpath(), "fpga"),"r")
         return f.read()
     
-    def softboot(self):
+    softbootSleepTime = 2 # Seconds for the FPGA to **start** reloading
+
+    def startSoftboot(self):
+        "Softboot the DOM without waiting; caller waits softbootSleepTime before using it"
         f = file(os.path.join(self.dompath(), "softboot"),"w")
         f.write("reset\n")
         f.close()
-        time.sleep(2) # Wait for FPGA to **start** reloading - assume user will re-open dev file
+
+    def softboot(self):
+        self.startSoftboot()
+        time.sleep(MiniDor.softbootSleepTime) # Assume user will re-open dev file
 
     def commReset(self):
         f = file(os.path.join(self.dompath(), "is-communicating"),"w")
@@ -7,6 +7,11 @@
 __all__ = ["domapp",
            "dor",
            "exc_string",
+           "hitarchive",
+           "hitclock",
+           "hitstats",
            "minitimer",
            "monitoring",
+           "monistats",
+           "waveform",
            ]
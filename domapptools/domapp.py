@@ -150,6 +150,32 @@ DRIVER_ROOT = "/proc/driver/domhub"
 _atwdMask = { 1 : { 0 : 0, 16 : 9, 32 : 1, 64 : 5, 128 : 13 },
               2 : { 0 : 0, 16 : 11, 32 : 3, 64 : 7, 128 : 15 } }
 
+# Hit archive writers (see hitarchive.py) keyed by (card, pair, dom); any
+# DOMApp created for that DOM appends its waveform data to the writer
+_hitArchives = {}
+
+def setHitArchive(card, pair, dom, archive):
+    """
+    Save all waveform data read from DOM (card, pair, dom) to archive
+    (a HitArchiveWriter); None stops saving
+    """
+    if archive is None:
+        _hitArchives.pop((card, pair, dom), None)
+    else:
+        _hitArchives[(card, pair, dom)] = archive
+
+_moniWriters = {}
+
+def setMoniWriter(card, pair, dom, writer):
+    """
+    Save all monitoring data read from DOM (card, pair, dom) with writer
+    (a MoniFileWriter); None stops saving
+    """
+    if writer is None:
+        _moniWriters.pop((card, pair, dom), None)
+    else:
+        _moniWriters[(card, pair, dom)] = writer
+
 class IntervalTimedOut(Exception):
     def __init__(self, data_count, moni_count, sn_count):
         self.data_count = data_count
@@ -202,6 +228,11 @@ class DOMApp:
         self.blksize = int(file(os.path.join(DRIVER_ROOT, "bufsiz")).read(100))
         self.fd = fd
         self.snrequested = False
+        self.hitArchive = _hitArchives.get((card, pair, dom))
+        # Each DOMApp is made after (re)starting domapp, which is back in
+        # its default format: skip payloads until setDataFormat() is called
+        if self.hitArchive: self.hitArchive.setFormat(None)
+        self.moniWriter = _moniWriters.get((card, pair, dom))
 
     def __del__(self):
         pass
@@ -379,6 +410,7 @@ class DOMApp:
         fmt = 2: delta format
         """
         self.sendMsg(DATA_ACCESS, DATA_ACC_SET_DATA_FORMAT, data=pack('b', fmt))
+        if self.hitArchive: self.hitArchive.setFormat(fmt)
 
     def setCompressionMode(self, mode):
         """
@@ -531,10 +563,31 @@ class DOMApp:
         lookback memory on DOM.  Please heed the caveats in
         the DOMAPP API about starting a run first.
         """
-        return self.sendMsg(DATA_ACCESS, DATA_ACC_GET_DATA)
+        data = self.sendMsg(DATA_ACCESS, DATA_ACC_GET_DATA)
+        if self.hitArchive:
+            # Archiving must never change what the caller sees; payloads the
+            # archive can't parse are left for the test's own checks
+            try:
+                self.hitArchive.append(data)
+            except Exception:
+                self.hitArchive.skipped += 1
+        return data
 
     def getMonitorData(self):
-        return self.sendMsg(DATA_ACCESS, DATA_ACC_GET_NEXT_MONI_REC)
+        data = self.sendMsg(DATA_ACCESS, DATA_ACC_GET_NEXT_MONI_REC)
+        if self.moniWriter:
+            # As for hit archiving, saving must never change what the caller
+            # sees: on a write error (disk full, writer closed) stop saving
+            # this DOM's monitoring data and say so once
+            try:
+                self.moniWriter.write(data)
+            except Exception, e:
+                print >>stderr, "%d%d%s: stopped saving monitoring data: %s" % \
+                      (self.card, self.pair, self.dom, e)
+                if _moniWriters.get((self.card, self.pair, self.dom)) is self.moniWriter:
+                    setMoniWriter(self.card, self.pair, self.dom, None)
+                self.moniWriter = None
+        return data
 
     def resetLookbackMemory(self):
         return self.sendMsg(DATA_ACCESS, DATA_ACC_RESET_LOOKBACK_MEMORY)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+"""
+hitarchive.py
+
+Append-only on-disk archive for hits read with DOMApp.getWaveformData(),
+in delta-compressed or engineering format.  An archive is a directory:
+
+    hits.dat      raw hit bytes, one hit after another
+    <name>.col    one file per header column, little-endian fixed width:
+                  domid (Q), clock (Q), offset (Q), size (H), trigger (H),
+                  flags (B)
+    clock.idx     row numbers (I) sorted by DOM clock, rebuilt on close()
+
+Each hit keeps its own raw bytes, so it can be decoded again later
+(DeltaHit gets the clock MSBs from the clock column).  Reading maps the
+column files with mmap, so a clock-window query is a binary search on
+clock.idx plus a read of only the rows and hits it returns.
+"""
+
+import os, mmap
+from struct import pack, unpack_from, calcsize
+from DeltaHit import DeltaHitBuf, DeltaHit
+from EngHit import EngHitBuf, EngHit
+
+ARCHIVE_VERSION = 1
+
+# Column name, struct code
+COLUMNS = (("domid",   "Q"),
+           ("clock",   "Q"),
+           ("offset",  "Q"),
+           ("size",    "H"),
+           ("trigger", "H"),
+           ("flags",   "B"))
+
+# Bits in the flags column
+FLAG_LCUP        = 0x01
+FLAG_LCDOWN      = 0x02
+FLAG_MINBIAS     = 0x04
+FLAG_ENGINEERING = 0x80
+
+# DOMApp.setDataFormat() codes
+FORMAT_ENGINEERING = 0
+FORMAT_DELTA       = 2
+
+
+class HitArchiveException(Exception): pass
+
+
+def _domid(domid):
+    if isinstance(domid, str): return long(domid.strip(), 16)
+    return long(domid)
+
+
+def payloadRows(hitdata, format):
+    """
+    Split one getWaveformData() payload into (clock, trigger, flags, raw hit
+    bytes) tuples, taken from the hit headers only
+    """
+    if format == FORMAT_DELTA:
+        buf = DeltaHitBuf(hitdata)
+        msb = long(buf.tmsb) << 32
+        payload = buf.payload
+        for pos, size, w0, w1 in buf.headers():
+            yield (msb | w1, (w0 >> 18) & 0x1FFF,
+                   (w0 >> 17) & FLAG_LCUP | (w0 >> 15) & FLAG_LCDOWN |
+                   (w0 >> 28) & FLAG_MINBIAS,
+                   payload[pos:pos+size])
+    elif format == FORMAT_ENGINEERING:
+        for pos, size, trigByte, domclk in EngHitBuf(hitdata).headers():
+            yield domclk, trigByte, FLAG_ENGINEERING, hitdata[pos:pos+size]
+    else:
+        raise HitArchiveException("unsupported data format %s" % format)
+
+
+def readPayloads(f, format, blocksize=1<<20):
+    """
+    Generator over the payloads in a file holding getWaveformData() output
+    written back to back.  Delta-compressed payloads carry their length in
+    the buffer header; an engineering-format stream is returned one hit at
+    a time.  Only one read block is held in memory.
+    """
+    if format == FORMAT_DELTA:
+        lenpos = 2
+    else:
+        lenpos = 0
+    buf = ""
+    pos = 0
+    while True:
+        if len(buf) - pos < 4 or len(buf) - pos < unpack_from('>H', buf, pos+lenpos)[0]:
+            more = f.read(blocksize)
+            if not more:
+                if len(buf) > pos:
+                    raise HitArchiveException("%d trailing bytes in hit stream" % (len(buf)-pos))
+                return
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        nb, = unpack_from('>H', buf, pos+lenpos)
+        if nb < 8: raise HitArchiveException("bad payload length %d" % nb)
+        yield buf[pos:pos+nb]
+        pos += nb
+
+
+class HitArchiveWriter:
+    """
+    Buffer rows and hit bytes in memory and append them to the archive
+    files every 'batch' hits (and on flush()/close())
+    """
+    def __init__(self, path, domid=0, format=None, batch=4096):
+        self.path   = path
+        self.domid  = _domid(domid)
+        self.format = format
+        self.batch  = batch
+        self.skipped = 0 # Payloads dropped: format not known or payload malformed
+        if not os.path.isdir(path): os.makedirs(path)
+        self._writeVersion()
+        self.dat = open(os.path.join(path, "hits.dat"), "ab")
+        self.offset = self.dat.tell()
+        self.cols = {}
+        for name, code in COLUMNS:
+            self.cols[name] = open(os.path.join(path, name + ".col"), "ab")
+        self._reset()
+
+    def _writeVersion(self):
+        fname = os.path.join(self.path, "VERSION")
+        if os.path.exists(fname):
+            v = int(open(fname).read())
+            if v != ARCHIVE_VERSION:
+                raise HitArchiveException("%s: archive version %d, expected %d" %
+                                          (self.path, v, ARCHIVE_VERSION))
+        else:
+            f = open(fname, "w")
+            f.write("%d\n" % ARCHIVE_VERSION)
+            f.close()
+
+    def _reset(self):
+        self.pending = dict([(name, []) for name, code in COLUMNS])
+        self.pendingHits = []
+
+    def setFormat(self, format):
+        """Tell the writer the data format set with DOMApp.setDataFormat()"""
+        self.format = format
+
+    def append(self, hitdata, format=None, domid=None):
+        """
+        Queue every hit of a getWaveformData() payload; returns the number of hits
+        """
+        if len(hitdata) == 0: return 0
+        if format is None: format = self.format
+        if domid is None:
+            domid = self.domid
+        else:
+            domid = _domid(domid)
+        if format not in (FORMAT_DELTA, FORMAT_ENGINEERING):
+            self.skipped += 1
+            return 0
+        rows = list(payloadRows(hitdata, format)) # Parse all first: no partial appends
+        p = self.pending
+        n = 0
+        for clock, trigger, flags, raw in rows:
+            self.pendingHits.append(raw)
+            p["clock"].append(clock)
+            p["trigger"].append(trigger)
+            p["flags"].append(flags)
+            p["size"].append(len(raw))
+            n += 1
+        p["domid"].extend([domid] * n)
+        for size in p["size"][-n:]:
+            p["offset"].append(self.offset)
+            self.offset += size
+        if len(self.pendingHits) >= self.batch: self.flush()
+        return n
+
+    def flush(self):
+        if not self.pendingHits: return
+        self.dat.write("".join(self.pendingHits))
+        self.dat.flush()
+        for name, code in COLUMNS:
+            vals = self.pending[name]
+            f = self.cols[name]
+            f.write(pack("<%d%s" % (len(vals), code), *vals))
+            f.flush()
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.dat.close()
+        for f in self.cols.values(): f.close()
+        buildIndex(self.path)
+
+
+def _mapFile(fname):
+    """Read-only mmap of a file, or '' if it is empty"""
+    f = open(fname, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0: return ""
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def buildIndex(path):
+    """(Re)write clock.idx, the row numbers sorted by DOM clock"""
+    clk = _mapFile(os.path.join(path, "clock.col"))
+    n = len(clk) / 8
+    clocks = unpack_from("<%dQ" % n, clk)
+    rows = sorted(xrange(n), key=clocks.__getitem__)
+    tmp = os.path.join(path, "clock.idx.tmp")
+    f = open(tmp, "wb")
+    f.write(pack("<%dI" % n, *rows))
+    f.close()
+    os.rename(tmp, os.path.join(path, "clock.idx"))
+
+
+class HitArchive:
+    """
+    Read access to an archive written by HitArchiveWriter
+    """
+    def __init__(self, path):
+        self.path = path
+        self.dat = _mapFile(os.path.join(path, "hits.dat"))
+        self.cols = {}
+        self.codes = {}
+        for name, code in COLUMNS:
+            self.cols[name] = _mapFile(os.path.join(path, name + ".col"))
+            self.codes[name] = code
+        self.nrows = len(self.cols["clock"]) / 8
+        idx = os.path.join(path, "clock.idx")
+        if not os.path.exists(idx) or os.path.getsize(idx) != 4*self.nrows:
+            buildIndex(path) # Writer didn't close cleanly
+        self.idx = _mapFile(idx)
+
+    def __len__(self):
+        return self.nrows
+
+    def get(self, name, row):
+        """Value of one column for one row"""
+        code = self.codes[name]
+        return unpack_from("<" + code, self.cols[name], row*calcsize(code))[0]
+
+    def column(self, name, start=0, stop=None):
+        """Tuple of a column's values for rows start..stop-1"""
+        if stop is None: stop = self.nrows
+        code = self.codes[name]
+        return unpack_from("<%d%s" % (stop-start, code), self.cols[name],
+                           start*calcsize(code))
+
+    def _sortedClock(self, i):
+        row, = unpack_from("<I", self.idx, 4*i)
+        return self.get("clock", row)
+
+    def window(self, t0, t1):
+        """Row numbers of hits with t0 <= clock < t1, in clock order"""
+        first = self._search(t0)
+        last  = self._search(t1)
+        return list(unpack_from("<%dI" % (last-first), self.idx, 4*first))
+
+    def _search(self, clock):
+        lo, hi = 0, self.nrows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._sortedClock(mid) < clock: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def raw(self, row):
+        """Raw bytes of one hit"""
+        off  = self.get("offset", row)
+        size = self.get("size", row)
+        return self.dat[off:off+size]
+
+    def hit(self, row):
+        """Decoded DeltaHit or EngHit for one row"""
+        if self.get("flags", row) & FLAG_ENGINEERING:
+            return EngHit(self.raw(row))
+        return DeltaHit(self.raw(row), self.get("clock", row) >> 32)
+
+    def hits(self, t0=0, t1=1L<<48):
+        """Decoded hits with t0 <= clock < t1, in clock order"""
+        for row in self.window(t0, t1):
+            yield self.hit(row)
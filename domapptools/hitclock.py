@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""
+hitclock.py
+
+Reconstruct full 48-bit DOM clock values from raw hit payloads (delta-
+compressed or engineering format) and check the resulting time series:
+ordering, gaps, duplicates and hit rates per trigger type.  Everything
+works on plain lists of clock values so that whole readouts are handled
+with map/zip/sort rather than per-hit Python objects.
+"""
+
+from operator import sub
+from DeltaHit import DeltaHitBuf
+from EngHit import EngHitBuf
+
+DOM_CLOCK_HZ = 40000000 # DOM clock ticks are 25 ns
+
+# Delta-compressed trigger word bits
+TRIG_SPE    = 0x01
+TRIG_MPE    = 0x02
+TRIG_BEACON = 0x04
+TRIG_PULSER = 0x08
+TRIG_FLASHER = 0x20
+
+
+def deltaClocks(hitdata):
+    """
+    Return (clocks, triggers) for every hit in a delta-compressed payload
+    """
+    buf = DeltaHitBuf(hitdata)
+    msb = long(buf.tmsb) << 32
+    clocks = []
+    triggers = []
+    for pos, hitsize, w0, w1 in buf.headers():
+        clocks.append(msb | w1)
+        triggers.append((w0 & 0x7ffe0000L) >> 18)
+    return clocks, triggers
+
+
+def engClocks(hitdata):
+    """
+    Return (clocks, triggers) for every hit in an engineering-format
+    payload; the trigger is the raw trigger byte
+    """
+    clocks = []
+    triggers = []
+    for pos, nb, trigByte, domclk in EngHitBuf(hitdata).headers():
+        clocks.append(domclk)
+        triggers.append(trigByte)
+    return clocks, triggers
+
+
+def clockDeltas(clocks):
+    """
+    >>> clockDeltas([10, 15, 15, 40])
+    [5, 0, 25]
+    """
+    return map(sub, clocks[1:], clocks[:-1])
+
+
+def outOfOrder(clocks):
+    """
+    Indices of hits whose clock is earlier than the previous hit's
+    >>> outOfOrder([1, 2, 5, 3, 4])
+    [3]
+    """
+    return [i+1 for i, dt in enumerate(clockDeltas(clocks)) if dt < 0]
+
+
+def duplicates(clocks):
+    """
+    Indices of hits with the same clock value as the previous hit
+    >>> duplicates([1, 2, 2, 3, 3, 3])
+    [2, 4, 5]
+    """
+    return [i+1 for i, dt in enumerate(clockDeltas(clocks)) if dt == 0]
+
+
+def isMonotonic(clocks):
+    """
+    True if clocks never decrease
+    >>> isMonotonic([1, 2, 2, 3]), isMonotonic([2, 1])
+    (True, False)
+    """
+    return not outOfOrder(clocks)
+
+
+def gaps(clocks, maxTicks):
+    """
+    Return (index, ticks) for every gap between successive hits larger
+    than maxTicks
+    >>> gaps([0, 10, 100, 110], 50)
+    [(2, 90)]
+    """
+    return [(i+1, dt) for i, dt in enumerate(clockDeltas(clocks)) if dt > maxTicks]
+
+
+def meanRate(clocks):
+    """
+    Mean hit rate (Hz) over the span of the clock values
+    >>> meanRate([0, DOM_CLOCK_HZ/2, DOM_CLOCK_HZ])
+    2.0
+    """
+    if len(clocks) < 2: return 0.
+    span = max(clocks) - min(clocks)
+    if span <= 0: return 0.
+    return (len(clocks) - 1) * float(DOM_CLOCK_HZ) / span
+
+
+def instantaneousRates(clocks):
+    """
+    Rate (Hz) implied by each positive clock difference
+    >>> instantaneousRates([0, 4000, 4000, 44000])
+    [10000.0, 1000.0]
+    """
+    hz = float(DOM_CLOCK_HZ)
+    return [hz/dt for dt in clockDeltas(clocks) if dt > 0]
+
+
+def windowedRates(clocks, window=DOM_CLOCK_HZ):
+    """
+    Count hits in consecutive windows of 'window' ticks, starting at the
+    earliest clock; returns a list of (window start clock, rate in Hz)
+    >>> windowedRates([0, 1, 2, 45, 46], 40)
+    [(0, 3000000.0), (40, 2000000.0)]
+    """
+    if not clocks: return []
+    t0 = min(clocks)
+    counts = {}
+    for c in clocks:
+        k = (c - t0) // window
+        counts[k] = counts.get(k, 0) + 1
+    scale = float(DOM_CLOCK_HZ) / window
+    return [(t0 + k*window, counts.get(k, 0) * scale)
+            for k in xrange(max(counts.keys()) + 1)]
+
+
+def ratesByTrigger(clocks, triggers, bits=(TRIG_SPE, TRIG_MPE, TRIG_BEACON,
+                                           TRIG_PULSER, TRIG_FLASHER)):
+    """
+    Mean rate (Hz) of hits with each trigger bit set, over the span of
+    the whole series
+    >>> ratesByTrigger([0, 20000000, 40000000], [1, 4, 1], bits=(1, 4))
+    {1: 2.0, 4: 1.0}
+    """
+    ret = {}
+    if len(clocks) < 2: return ret
+    span = max(clocks) - min(clocks)
+    for bit in bits:
+        n = len([t for t in triggers if t & bit])
+        ret[bit] = span > 0 and n * float(DOM_CLOCK_HZ) / span or 0.
+    return ret
+
+
+class HitClockSeries:
+    """
+    Accumulate clocks and trigger words over successive payloads
+    from DOMApp.getWaveformData()
+    """
+    def __init__(self, engineering=False):
+        self.clocks   = []
+        self.triggers = []
+        if engineering:
+            self.decode = engClocks
+        else:
+            self.decode = deltaClocks
+
+    def add(self, hitdata):
+        if len(hitdata) == 0: return 0
+        clocks, triggers = self.decode(hitdata)
+        self.clocks.extend(clocks)
+        self.triggers.extend(triggers)
+        return len(clocks)
+
+    def __len__(self):
+        return len(self.clocks)
+
+    def isMonotonic(self):  return isMonotonic(self.clocks)
+    def outOfOrder(self):   return outOfOrder(self.clocks)
+    def duplicates(self):   return duplicates(self.clocks)
+    def gaps(self, maxTicks): return gaps(self.clocks, maxTicks)
+    def meanRate(self):     return meanRate(self.clocks)
+    def windowedRates(self, window=DOM_CLOCK_HZ): return windowedRates(self.clocks, window)
+    def ratesByTrigger(self, **kw): return ratesByTrigger(self.clocks, self.triggers, **kw)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+hitstats.py
+
+Running hit statistics for delta-compressed waveform data, filled straight
+from the raw DOMApp.getWaveformData() payloads without building DeltaHit
+objects.  All counters live in fixed-size arrays, so an accumulator can be
+snapshotted, reset or merged with another one (other DOM, other interval)
+cheaply.
+"""
+
+from array import array
+from copy import copy
+from DeltaHit import DeltaHitBuf, MalformedDeltaCompressedHitBuffer
+
+NTRIGBITS = 13   # Width of the delta-compressed trigger word
+MAXHITSIZE = 0x7FF
+_ARRAYS = ("trigger", "atwdChip", "atwdChannels", "beaconAtwdChannels", "hitsize")
+
+class HitStats:
+    """
+    >>> s = HitStats()
+    >>> s.nhits, s.atwdChip.tolist()
+    (0, [0, 0])
+    >>> t = HitStats(); t.nhits = 3; t.atwdChip[1] = 3
+    >>> s.merge(t); s.merge(t)
+    >>> s.nhits, s.atwdChip.tolist()
+    (6, [0, 6])
+    >>> snap = s.snapshot(); s.reset()
+    >>> snap.nhits, s.nhits, s.atwdChip.tolist()
+    (6, 0, [0, 0])
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.nhits    = 0
+        self.nbytes   = 0
+        self.minbias  = 0
+        self.lcup     = 0
+        self.lcdown   = 0
+        self.atwdAvail = 0
+        self.fadcAvail = 0
+        self.trigger  = array('l', [0]*NTRIGBITS)       # Hits with each trigger bit set
+        self.atwdChip = array('l', [0]*2)               # Hits per ATWD chip (A, B)
+        self.atwdChannels = array('l', [0]*4)           # Hits per # of ATWD channels (1..4)
+        self.beaconAtwdChannels = array('l', [0]*4)     # Same, for beacon hits only
+        self.hitsize  = array('l', [0]*(MAXHITSIZE+1))  # Hit size histogram (bytes)
+
+    def ingest(self, hitdata):
+        """
+        Add every hit in a delta-compressed payload; returns the number of hits.
+        Raises MalformedDeltaCompressedHitBuffer, as DeltaHit does, for a
+        hit without the compression bit.
+        """
+        if len(hitdata) == 0: return 0
+        trigger  = self.trigger
+        hitsize  = self.hitsize
+        chip     = self.atwdChip
+        nch      = self.atwdChannels
+        bnch     = self.beaconAtwdChannels
+        n = minbias = lcup = lcdown = atwd = fadc = nbytes = 0
+        headers = list(DeltaHitBuf(hitdata).headers()) # Check all before counting any
+        for pos, size, w0, w1 in headers:
+            if not w0 & 0x80000000L:
+                raise MalformedDeltaCompressedHitBuffer("no compression bit found")
+        for pos, size, w0, w1 in headers:
+            n      += 1
+            nbytes += size
+            hitsize[size] += 1
+            trig = (w0 >> 18) & 0x1FFF
+            bit = 0
+            while trig:
+                if trig & 1: trigger[bit] += 1
+                trig >>= 1
+                bit  += 1
+            if w0 & 0x40000000: minbias += 1
+            if w0 & 0x20000:    lcup    += 1
+            if w0 & 0x10000:    lcdown  += 1
+            if w0 & 0x8000:     fadc    += 1
+            if w0 & 0x4000:     atwd    += 1
+            chip[(w0 >> 11) & 1] += 1
+            ich = (w0 >> 12) & 0x3
+            nch[ich] += 1
+            if w0 & (0x04 << 18): bnch[ich] += 1
+        self.nhits    += n
+        self.nbytes   += nbytes
+        self.minbias  += minbias
+        self.lcup     += lcup
+        self.lcdown   += lcdown
+        self.atwdAvail += atwd
+        self.fadcAvail += fadc
+        return n
+
+    def merge(self, other):
+        """Add another accumulator's counts (e.g. another DOM or interval) to this one"""
+        self.nhits    += other.nhits
+        self.nbytes   += other.nbytes
+        self.minbias  += other.minbias
+        self.lcup     += other.lcup
+        self.lcdown   += other.lcdown
+        self.atwdAvail += other.atwdAvail
+        self.fadcAvail += other.fadcAvail
+        for name in _ARRAYS:
+            mine, theirs = getattr(self, name), getattr(other, name)
+            for i in xrange(len(mine)):
+                if theirs[i]: mine[i] += theirs[i]
+
+    def snapshot(self):
+        """Return an independent copy of the current counts"""
+        ret = copy(self)
+        for name in _ARRAYS:
+            setattr(ret, name, getattr(self, name)[:])
+        return ret
+
+    def triggerCount(self, mask):
+        """Number of hits counted against the trigger bits in mask (summed over bits)"""
+        return sum([self.trigger[b] for b in xrange(NTRIGBITS) if mask & (1 << b)])
+
+    def __str__(self):
+        return ("%d hits (%d bytes): minbias %d LCUP %d LCDN %d ATWD A/B %d/%d "
+                "#ATWD ch %s trig %s" %
+                (self.nhits, self.nbytes, self.minbias, self.lcup, self.lcdown,
+                 self.atwdChip[0], self.atwdChip[1], self.atwdChannels.tolist(),
+                 self.trigger.tolist()))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
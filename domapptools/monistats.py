@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+monistats.py
+
+Rolling statistics and alarms for the hardware monitoring stream, per DOM
+and per quantity (temperature, HV readback and its difference from the
+set point, SPE/MPE scalers, supply currents, pressure).  Records come from
+DOMApp.getMonitorData() buffers or from .moni files.  Every statistic is
+updated in constant time and memory: running mean/min/max, an EWMA, and
+the slope (per second of DOM clock) of an exponentially weighted linear
+fit, so that old samples fade out at the same rate as in the EWMA.
+"""
+
+from struct import unpack_from
+from monitoring import HW_FIELDS, HardwareMonitorRecord, MonitorRecordFactory, \
+     MonitorStreamType, iterMoniStream, _pressure
+
+DOM_CLOCK_HZ = 40000000.
+
+def _field(name):
+    i = list(HW_FIELDS).index(name)
+    return lambda f: f[i]
+
+# Quantity name -> function of the hardware record body tuple
+EXTRACTORS = {
+    'temperature' : lambda f: f[27] / 256.0,
+    'hvSet'       : lambda f: f[25] * 0.5,
+    'hvMonitor'   : lambda f: f[26] * 0.5,
+    'hvDiff'      : lambda f: (f[26] - f[25]) * 0.5,
+    'pressure'    : lambda f: _pressure(f[3], f[2]),
+    }
+for _name in ('speRate', 'mpeRate', 'i5v', 'i3_3v', 'i2_5v', 'i1_8v', 'i_minus_5v'):
+    EXTRACTORS[_name] = _field(_name)
+
+DEFAULT_QUANTITIES = ('temperature', 'hvMonitor', 'hvDiff', 'speRate', 'mpeRate',
+                      'i5v', 'i3_3v', 'i2_5v', 'i1_8v', 'i_minus_5v')
+
+
+class RollingStat:
+    """
+    >>> s = RollingStat(alpha=0.5)
+    >>> for t, x in [(0, 1.), (1, 3.), (2, 5.)]: s.add(t, x)
+    >>> s.n, s.mean, s.min, s.max, s.ewma
+    (3, 3.0, 1.0, 5.0, 3.5)
+    >>> round(s.slope(), 6)
+    2.0
+    """
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self.n     = 0
+        self.mean  = 0.
+        self.min   = None
+        self.max   = None
+        self.ewma  = None
+        self.last  = None
+        self.t0    = None
+        # Exponentially weighted means of t, x, t*t, t*x (t relative to t0)
+        self._et = self._ex = self._ett = self._etx = 0.
+
+    def add(self, t, x):
+        """Add sample x taken at time t (seconds)"""
+        self.n += 1
+        self.mean += (x - self.mean) / self.n
+        if self.min is None or x < self.min: self.min = x
+        if self.max is None or x > self.max: self.max = x
+        self.last = x
+        if self.ewma is None:
+            self.t0 = t
+            self.ewma = x
+            self._ex = x
+            return
+        a = self.alpha
+        b = 1. - a
+        t -= self.t0
+        self.ewma = b*self.ewma + a*x
+        self._et  = b*self._et  + a*t
+        self._ex  = b*self._ex  + a*x
+        self._ett = b*self._ett + a*t*t
+        self._etx = b*self._etx + a*t*x
+
+    def slope(self):
+        """Weighted least-squares slope of x against t; None until defined"""
+        var = self._ett - self._et*self._et
+        if self.n < 2 or var <= 0: return None
+        return (self._etx - self._et*self._ex) / var
+
+    def __str__(self):
+        slope = self.slope()
+        if slope is None: slope = "-"
+        else: slope = "%.3g/s" % slope
+        return "n=%d mean=%.4g min=%.4g max=%.4g ewma=%.4g slope=%s" % \
+               (self.n, self.mean, self.min, self.max, self.ewma, slope)
+
+
+class MoniAlarm:
+    def __init__(self, domid, quantity, kind, value, limit, domClock):
+        self.domid    = domid
+        self.quantity = quantity
+        self.kind     = kind   # 'low', 'high' or 'drift'
+        self.value    = value
+        self.limit    = limit
+        self.domClock = domClock
+
+    def __str__(self):
+        return "ALARM %s %s %s: %.4g (limit %.4g) at DOM clock %x" % \
+               (self.domid, self.quantity, self.kind, self.value, self.limit, self.domClock)
+
+
+class MoniAggregator:
+    """
+    Per-DOM RollingStats for each quantity in 'quantities' (names from
+    EXTRACTORS).  thresholds maps a quantity to (low, high) limits (either
+    may be None); drifts maps a quantity to the largest allowed |slope|
+    per second, checked once a DOM has minSamples records.  An alarm is
+    raised once when a limit is crossed and re-armed when the value comes
+    back; alarms are kept in self.alarms (the latest maxAlarms) and passed
+    to callback, if given.
+    >>> agg = MoniAggregator(thresholds={'temperature' : (None, 30.)})
+    >>> agg.addFields('57bfc0c8a1b6', 0, (1,) + (0,)*26 + (25*256, 0, 0))
+    >>> agg.addFields('57bfc0c8a1b6', 40000000, (1,) + (0,)*26 + (35*256, 0, 0))
+    >>> print agg.alarms[0]
+    ALARM 57bfc0c8a1b6 temperature high: 35 (limit 30) at DOM clock 2625a00
+    >>> agg.stats['57bfc0c8a1b6']['temperature'].max
+    35.0
+    """
+    def __init__(self, quantities=DEFAULT_QUANTITIES, thresholds={}, drifts={},
+                 alpha=0.1, minSamples=10, callback=None, maxAlarms=1000):
+        self.quantities = [(q, EXTRACTORS[q]) for q in quantities]
+        self.thresholds = thresholds
+        self.drifts     = drifts
+        self.alpha      = alpha
+        self.minSamples = minSamples
+        self.callback   = callback
+        self.maxAlarms  = maxAlarms
+        self.stats      = {} # domid -> {quantity : RollingStat}
+        self.active     = {} # (domid, quantity, kind) of alarms not yet re-armed
+        self.alarms     = []
+        self.nrecords   = 0
+
+    def addFields(self, domid, domClock, fields):
+        """Add one hardware record, given as its body tuple"""
+        self.nrecords += 1
+        stats = self.stats.get(domid)
+        if stats is None:
+            stats = {}
+            for q, extract in self.quantities:
+                stats[q] = RollingStat(self.alpha)
+            self.stats[domid] = stats
+        t = domClock / DOM_CLOCK_HZ
+        for q, extract in self.quantities:
+            x = extract(fields)
+            if x != x: continue # NaN, e.g. pressure with no 5 V reading
+            s = stats[q]
+            s.add(t, x)
+            if q in self.thresholds:
+                (lo, hi) = self.thresholds[q]
+                self._check(domid, q, 'low',  lo is not None and x < lo, x, lo, domClock)
+                self._check(domid, q, 'high', hi is not None and x > hi, x, hi, domClock)
+            if q in self.drifts and s.n >= self.minSamples:
+                slope = s.slope()
+                self._check(domid, q, 'drift',
+                            slope is not None and abs(slope) > self.drifts[q],
+                            slope, self.drifts[q], domClock)
+
+    def _check(self, domid, q, kind, bad, value, limit, domClock):
+        key = (domid, q, kind)
+        if not bad:
+            if key in self.active: del self.active[key]
+            return
+        if key in self.active: return
+        self.active[key] = True
+        alarm = MoniAlarm(domid, q, kind, value, limit, domClock)
+        self.alarms.append(alarm)
+        if len(self.alarms) > self.maxAlarms: del self.alarms[0]
+        if self.callback: self.callback(alarm)
+
+    def add(self, record):
+        """Add a HardwareMonitorRecord (other records are ignored)"""
+        if isinstance(record, HardwareMonitorRecord):
+            self.addFields(record.domid, record.domClock, record.fields)
+
+    def addMoniData(self, monidata, domid):
+        """
+        Add the hardware records in a DOMApp.getMonitorData() buffer; other
+        record types are skipped on their header
+        """
+        pos = 0
+        while len(monidata) - pos >= 4:
+            moniLen, moniType = unpack_from('>hh', monidata, pos)
+            if moniLen <= 0: break
+            if moniType == 0xC8:
+                self.add(MonitorRecordFactory(monidata[pos:pos+moniLen], domid))
+            pos += moniLen
+
+    def addStream(self, f, type=MonitorStreamType.STRINGHUB, **filters):
+        """Add the hardware records of a monitoring stream file (or file name)"""
+        for m in iterMoniStream(f, type, moniTypes=[0xC8], **filters):
+            self.addFields(m.domid, m.domClock, m.fields)
+
+    def summary(self):
+        ret = ""
+        for domid in sorted(self.stats.keys()):
+            for q, extract in self.quantities:
+                s = self.stats[domid][q]
+                if s.n: ret += "%s %-12s %s\n" % (domid, q, s)
+        return ret
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,27 +1,53 @@
 #!/bin/env python
 
-import sys
-from struct import unpack
+import sys, os, re, mmap, zlib, bz2, time, calendar
+from struct import pack, unpack, unpack_from, Struct
+from array import array
+
+# Monitor record header: length, type, 48-bit DOM clock as 16 + 32 bits
+_moniHeader = Struct('>hhHI')
+_hwBody     = Struct('>Bx27hii')
+_configBody = Struct('>B3xIH2xIIH2xH8B2xII')
+
+# Fields of the hardware record body ('>Bx27hii' at byte 10), in order
+HW_FIELDS = ('version', 'voltageSum', 'adc5v', 'pressureADC',
+             'i5v', 'i3_3v', 'i2_5v', 'i1_8v', 'i_minus_5v',
+             'atwd0TriggerBias', 'atwd0RampTop', 'atwd0RampRate', 'atwdAnalogRef',
+             'atwd1TriggerBias', 'atwd1RampTop', 'atwd1RampRate',
+             'feBias', 'mpeDisc', 'speDisc', 'ledBrightness', 'fadcRef',
+             'internalPulser', 'feAmpLowerClamp', 'flRef', 'muxBias',
+             'hvSetDAC', 'hvReadbackADC', 'temperatureADC',
+             'speRate', 'mpeRate')
+
+# Fields of the config record body, in order
+CONFIG_FIELDS = ('configVersion', 'mbIdHi', 'mbIdLo', 'hvIdHi', 'hvIdLo',
+                 'fpgaBuildId', 'swBuildId',
+                 'msgHandlerMajor', 'msgHandlerMinor', 'expControlMajor', 'expControlMinor',
+                 'slowControlMajor', 'slowControlMinor', 'dataAccessMajor', 'dataAccessMinor',
+                 'triggerConfig', 'atwdReadoutInfo')
+
+# Hardware record values in physical units
+HW_UNIT_FIELDS = ('temperature', 'pressure', 'hvSet', 'hvMonitor')
+
+def _pressure(padc, v5):
+    """Same conversion as HardwareMonitorRecord.getPressure(), NaN if the 5 V ADC reads 0"""
+    if v5 == 0: return float('nan')
+    return (float(padc) / v5 + 0.095) / 0.009
 
 def MonitorRecordFactory(buf, domid='????????????', timestamp=0L):
-    domClock = 0L
-    for i in range(6):
-        domClock = (domClock << 8) | unpack('B', buf[i+4])[0]
-    (moniLen, moniType) = unpack('>hh', buf[0:4])
-    if moniType == 0xC8:
-        return HardwareMonitorRecord(domid, timestamp, buf, moniLen, moniType, domClock)
-    elif moniType == 0xC9:
-        return ConfigMonitorRecord(domid, timestamp, buf, moniLen, moniType, domClock)
-    elif moniType == 0xCB:
-        return ASCIIMonitorRecord(domid, timestamp, buf, moniLen, moniType, domClock)
-    else:
-        return MonitorRecord(domid, timestamp, buf, moniLen, moniType, domClock)
+    (moniLen, moniType, clkHi, clkLo) = _moniHeader.unpack_from(buf)
+    domClock = (long(clkHi) << 32) | clkLo
+    cls = MONITOR_RECORD_TYPES.get(moniType, MonitorRecord)
+    return cls(domid, timestamp, buf, moniLen, moniType, domClock)
 
-class MonitorRecord:
+class MonitorRecord(object):
     """
     Generic monitor record type - supports the common base information
     contained in all monitor records.
     """
+    __slots__ = ('domid', 'timestamp', 'buf', 'moniLen', 'moniType', 'domClock')
+    FIELDS = ('domid', 'timestamp', 'domClock', 'moniType')
+
     def __init__(self, domid, timestamp, buf, moniLen, moniType, domClock):
         self.domid = domid
         self.timestamp = timestamp
@@ -34,6 +60,19 @@ class MonitorRecord:
         """Retrieve the DOM timestamp."""
         return self.domClock
 
+    def field(self, name):
+        """Value of one of FIELDS by name; None if this record has no such field"""
+        return getattr(self, name, None)
+
+    def asDict(self, names=None):
+        """Dictionary of the named fields (default: all of FIELDS)"""
+        if names is None: names = self.FIELDS
+        return dict([(name, self.field(name)) for name in names])
+
+    def message(self):
+        """One-line rendering, as used in domapptest debug output"""
+        return "[RECORD TYPE %02X]" % self.moniType
+
     def __str__(self):
         return """
     DOM Id .............................. %s
@@ -42,18 +81,110 @@ class MonitorRecord:
     Record Type ......................... %02X
     """ % (self.domid, self.timestamp, self.domClock, self.moniType)
     
+#---------------------------------------------------------------
+# Parsing of the structured ASCII messages domapp sends.  Each message is
+# classified by its first word (one dict lookup) and then matched with one
+# precompiled regex; messages that may carry their tag further in are
+# found with plain substring tests before any regex runs.
+
+ASCII_FAST             = "F"        # (spe, mpe, hits, deadtime)
+ASCII_PED_ATWD         = "PED-ATWD" # (chip 'A'/'B', channel, trials, bias)
+ASCII_ATWD_CS          = "ATWD CS"  # (chip, channel, entries, array of bin counts)
+ASCII_FADC_CS          = "FADC CS"  # (entries, array of bin counts)
+ASCII_LBM_OVER         = "LBM OVER" # (write pointer, read pointer)
+ASCII_PED_CONTAMINATED = "PED CONTAMINATED" # trial number
+ASCII_PED_LIGHT        = "PED LIGHT"        # None (pedestal kept despite light)
+ASCII_LC_MODE          = "LC MODE"  # (LC mode, LC type)
+
+def _counts(s):
+    return array('l', map(int, s.split()))
+
+# kind, substring that must be present, regex, converter of match groups
+_asciiParsers = (
+    (ASCII_FAST, "F ", re.compile(r'^F (\d+) (\d+) (\d+) (\d+)$'),
+     lambda g: (int(g[0]), int(g[1]), int(g[2]), int(g[3]))),
+    (ASCII_PED_ATWD, "PED-ATWD",
+     re.compile(r'PED-ATWD (\S+) CH (\d+)--(\d+) trials, bias (\d+)'),
+     lambda g: (g[0], int(g[1]), int(g[2]), int(g[3]))),
+    (ASCII_ATWD_CS, "ATWD CS", re.compile(r'ATWD CS (\S+) (\d+)--(\d+) entries: (.+)'),
+     lambda g: (g[0], int(g[1]), int(g[2]), _counts(g[3]))),
+    (ASCII_FADC_CS, "FADC CS", re.compile(r'FADC CS--(\d+) entries: (.+)'),
+     lambda g: (int(g[0]), _counts(g[1]))),
+    (ASCII_LBM_OVER, "LBM OVER", re.compile(r'pointer=(.+?) lbmp=(.+)'),
+     lambda g: (int(g[0], 16), int(g[1], 16))),
+    (ASCII_PED_CONTAMINATED, "pedestal average contaminated",
+     re.compile(r'pedestal average contaminated.*trial (\d+)'),
+     lambda g: int(g[0])),
+    (ASCII_PED_LIGHT, "continuing with possibly light-contaminated pedestal",
+     re.compile(r'continuing with possibly light-contaminated pedestal'),
+     lambda g: None),
+    (ASCII_LC_MODE, "set_HAL_lc_mode",
+     re.compile(r'set_HAL_lc_mode\(LCmode=(\d+), LCtype=(\d+)\)'),
+     lambda g: (int(g[0]), int(g[1]))),
+    )
+
+# First word of the message -> parser to try first
+_asciiFirstWord = { "F" : _asciiParsers[0], "PED-ATWD" : _asciiParsers[1],
+                    "ATWD" : _asciiParsers[2], "FADC" : _asciiParsers[3],
+                    "LBM" : _asciiParsers[4] }
+
+def _applyParser(parser, text):
+    (kind, tag, regex, convert) = parser
+    m = regex.search(text)
+    if m is None: return None
+    try:
+        return kind, convert(m.groups())
+    except ValueError:
+        return None
+
+def parseASCIIMessage(text):
+    """
+    Classify one ASCII monitoring message: returns (kind, values), with
+    kind one of the ASCII_* constants and values as documented there, or
+    (None, None) for messages that aren't recognized
+    """
+    words = text.split(" ")
+    word = words[0]
+    if word == "F" and len(words) == 5:
+        # Fast-moni records come at the highest rate: no regex needed
+        spe, mpe, hits, deadtime = words[1:]
+        if spe.isdigit() and mpe.isdigit() and hits.isdigit() and deadtime.isdigit():
+            return ASCII_FAST, (int(spe), int(mpe), int(hits), int(deadtime))
+    if word in _asciiFirstWord:
+        ret = _applyParser(_asciiFirstWord[word], text)
+        if ret is not None: return ret
+    for parser in _asciiParsers:
+        if parser[1] in text:
+            ret = _applyParser(parser, text)
+            if ret is not None: return ret
+    return None, None
+
 class ASCIIMonitorRecord(MonitorRecord):
     """
     Implements the ASCII type logging monitor record.
     """
-    def __init__(self, domid, timestamp, buf, moniLen, moniType, domClock):
-        MonitorRecord.__init__(self, domid, timestamp, buf, moniLen, moniType, domClock)
-        self.text = self.buf[10:]
+    __slots__ = ('_parsed',)
+    FIELDS = MonitorRecord.FIELDS + ('text',)
+
+    def _getText(self):
+        return self.buf[10:]
+    text = property(_getText)
         
     def getMessage(self):
         """Retrieve the payload message from the DOM monitor record."""
         return self.text
 
+    def message(self):
+        return self.text
+
+    def parse(self):
+        """(kind, values) of the message, see parseASCIIMessage(); cached"""
+        try:
+            return self._parsed
+        except AttributeError:
+            self._parsed = parseASCIIMessage(self.text)
+            return self._parsed
+
     def __str__(self):
         return """
     DOM Id .............................. %s
@@ -62,9 +193,32 @@ class ASCIIMonitorRecord(MonitorRecord):
     Message ............................. %s
     """ % (self.domid, self.timestamp, self.domClock, self.text)
 
-class ConfigMonitorRecord(MonitorRecord):
-    def __init__(self, domid, timestamp, buf, moniLen, moniType, domClock):
-        MonitorRecord.__init__(self, domid, timestamp, buf, moniLen, moniType, domClock)
+class _DecodedRecord(MonitorRecord):
+    """
+    Record whose body is decoded with one Struct the first time a field
+    is needed; the tuple is cached in self._fields
+    """
+    __slots__ = ('_fields',)
+    _body = None
+    _index = {} # Field name -> index in the body tuple
+
+    def _getFields(self):
+        try:
+            return self._fields
+        except AttributeError:
+            self._fields = self._body.unpack_from(self.buf, 10)
+            return self._fields
+    fields = property(_getFields)
+
+    def field(self, name):
+        if name in self._index: return self.fields[self._index[name]]
+        return MonitorRecord.field(self, name)
+
+class ConfigMonitorRecord(_DecodedRecord):
+    __slots__ = ()
+    _body = _configBody
+    _index = dict([(name, i) for i, name in enumerate(CONFIG_FIELDS)])
+    FIELDS = MonitorRecord.FIELDS + CONFIG_FIELDS
 
     def __str__(self):
         return """
@@ -83,23 +237,77 @@ class ConfigMonitorRecord(MonitorRecord):
     Trigger Configuration ............... %x
     ATWD Readout Info ................... %x
     """ % (
-        (self.domid, self.timestamp, self.domClock) +
-        unpack('>B3xIH2xIIH2xH8B2xII', self.buf[10:])
+        (self.domid, self.timestamp, self.domClock) + self.fields
         )
+
+    def message(self):
+        return "[CONFIG %s]" % " ".join([str(v) for v in self.fields])
+
+class StateChangeMonitorRecord(MonitorRecord):
+    """
+    State change record (0xCA): the DOMApp message type and subtype that
+    changed the DOM's state, plus the arguments of the ones we know about.
+    """
+    __slots__ = ()
+    FIELDS = MonitorRecord.FIELDS + ('kind', 'subkind', 'args')
+
+    # (kind, subkind) -> (description, argument layout at byte 12)
+    _changes = { (2, 0x10) : ("ENABLE HV", None),
+                 (2, 0x12) : ("ENABLE HV", None),
+                 (2, 0x0E) : ("SET HV(%d)", '>h'),
+                 (2, 0x0D) : ("SET DAC(%d<-%d)", '>bxh'),
+                 (2, 0x2D) : ("SET LC MODE(%d)", 'b'),
+                 (2, 0x2F) : ("SET LC WIN(%d %d %d %d)", '>LLLL') }
+
+    def _getKind(self):
+        return unpack_from('b', self.buf, 10)[0]
+    kind = property(_getKind)
+
+    def _getSubkind(self):
+        return unpack_from('b', self.buf, 11)[0]
+    subkind = property(_getSubkind)
+
+    def _getArgs(self):
+        """Tuple of the state change arguments; () if unknown"""
+        (desc, fmt) = self._changes.get((self.kind, self.subkind), (None, None))
+        if fmt is None: return ()
+        return unpack_from(fmt, self.buf, 12)
+    args = property(_getArgs)
+
+    def getChange(self):
+        """Description of the state change, e.g. 'SET HV(1200)'"""
+        (desc, fmt) = self._changes.get((self.kind, self.subkind), (None, None))
+        if desc is None: return "0x%0x-0x%0x" % (self.kind, self.subkind)
+        if fmt is None: return desc
+        return desc % self.args
+
+    def message(self):
+        return "[STATE CHANGE %s]" % self.getChange()
+
+    def __str__(self):
+        return """
+    DOM Id .............................. %s
+    UT Timestamp ........................ %x
+    DOM Timestamp ....................... %x
+    State Change ........................ %s
+    """ % (self.domid, self.timestamp, self.domClock, self.getChange())
     
-class HardwareMonitorRecord(MonitorRecord):
-    
-    def __init__(self, domid, timestamp, buf, moniLen, moniType, domClock):
-        MonitorRecord.__init__(self, domid, timestamp, buf, moniLen, moniType, domClock)
+class HardwareMonitorRecord(_DecodedRecord):
+    __slots__ = ()
+    _body = _hwBody
+    _index = dict([(name, i) for i, name in enumerate(HW_FIELDS)])
+    FIELDS = MonitorRecord.FIELDS + HW_FIELDS + HW_UNIT_FIELDS
+
+    # Index in self.fields of the current monitor ADCs
+    _currents = { 'i5v' : 4, 'i3_3v' : 5, 'i2_5v' : 6, 'i1_8v' : 7, 'i_minus_5v' : 8 }
         
     def getVoltageSumADC(self):
         """Gets the voltage sum ADC."""
-        return unpack('>h', self.buf[12:14])[0]
+        return self.fields[1]
         
     def get5VMonitor(self):
         """Gets the ADC monitoring the 5V power line."""
-        adc5v = unpack('>h', self.buf[14:16])[0]
-        return adc5v
+        return self.fields[2]
         
     def __getattr__(self, name):
         """
@@ -110,37 +318,36 @@ class HardwareMonitorRecord(MonitorRecord):
             m.i1_8v - 1.8 V current monitor ADC
             m.i_minus_5v - -5 V current monitor ADC
         """
-        if name == 'i5v':
-            return unpack('>h', self.buf[18:20])[0]
-        elif name == 'i3_3v':
-            return unpack('>h', self.buf[20:22])[0]
-        elif name == 'i2_5v':
-            return unpack('>h', self.buf[22:24])[0]
-        elif name == 'i1_8v':
-            return unpack('>h', self.buf[24:26])[0]
-        elif name == 'i_minus_5v':
-            return unpack('>h', self.buf[26:28])[0]
+        if name in HardwareMonitorRecord._currents:
+            return self.fields[HardwareMonitorRecord._currents[name]]
         else:
-            raise AttributeError
+            raise AttributeError(name)
+
+    def field(self, name):
+        f = self.fields
+        if name == 'temperature': return f[27] / 256.0
+        elif name == 'pressure':  return _pressure(f[3], f[2])
+        elif name == 'hvSet':     return f[25] * 0.5
+        elif name == 'hvMonitor': return f[26] * 0.5
+        return _DecodedRecord.field(self, name)
             
     def getPressure(self):
         """Returns the pressure in kPa."""
-        padc = unpack('>h', self.buf[16:18])[0]
+        padc = self.fields[3]
         vsum = self.get5VMonitor();
         return (float(padc) / float(vsum) + 0.095) / 0.009 
         
     def getTemperature(self):
         """Returns the temperature in deg C."""
-        temp = unpack('>h', self.buf[64:66])[0]
-        return temp / 256.0
+        return self.fields[27] / 256.0
         
     def getHVSet(self):
         """Returns the HV set point (in volts).""" 
-        return unpack('>h', self.buf[60:62])[0] * 0.5
+        return self.fields[25] * 0.5
         
     def getHVMonitor(self):
         """Returns the HV readback (in volts)."""
-        return unpack('>h', self.buf[62:64])[0] * 0.5
+        return self.fields[26] * 0.5
         
     def getSPERate(self):
         """
@@ -149,7 +356,7 @@ class HardwareMonitorRecord(MonitorRecord):
         that was the right behavior for TestDOMApp but is incorrect
         for DOMApp.
         """
-        return unpack('>i', self.buf[66:70])[0]
+        return self.fields[28]
         
     def getMPERate(self):
         """
@@ -158,7 +365,7 @@ class HardwareMonitorRecord(MonitorRecord):
         that was the right behavior for TestDOMApp but is incorrect
         for DOMApp.
         """
-        return unpack('>i', self.buf[70:74])[0]
+        return self.fields[29]
         
     def __str__(self):
         return """
@@ -196,59 +403,704 @@ class HardwareMonitorRecord(MonitorRecord):
         SPE Scaler ................... %d
         MPE Scaler ................... %d
         """ % (
-            (self.domid, self.timestamp, self.domClock) + 
-            unpack('>Bx27hii', self.buf[10:])
+            (self.domid, self.timestamp, self.domClock) + self.fields
             )
 
+    def message(self):
+        # Scalers and ADCs are shown unsigned, as domapptest always has
+        f = self.fields
+        vals = f[0:1] + tuple([v & 0xFFFF for v in f[1:28]]) + \
+               tuple([v & 0xFFFFFFFFL for v in f[28:30]])
+        return "[HW EVT %s]" % " ".join([str(v) for v in vals])
+
+# Record class for each monitor record type.  Shared by the file readers
+# and the live monitoring path in domapptest.py; types not listed here
+# decode as plain MonitorRecords.
+MONITOR_RECORD_TYPES = { 0xC8 : HardwareMonitorRecord,
+                         0xC9 : ConfigMonitorRecord,
+                         0xCA : StateChangeMonitorRecord,
+                         0xCB : ASCIIMonitorRecord }
+
+def registerMonitorRecord(moniType, cls):
+    """Decode records of type moniType with class cls from now on"""
+    MONITOR_RECORD_TYPES[moniType] = cls
+
 class MonitorStreamType:
     """
     Enumeration of encoding types for monitoring streams, differing in the
-    header length and encoding.
+    header length and encoding.  AUTO works out the type of each record
+    from its header, so files of several types may be concatenated.
+    """
+    (STRINGHUB, PAYLOAD, DIRECT, AUTO) = (0, 1, 2, 3)
+
+# Stream header length and layout for each MonitorStreamType
+_streamHeaders = { MonitorStreamType.STRINGHUB : (32, '>iiq8xq'),
+                   MonitorStreamType.PAYLOAD   : (24, '>iiqq'),
+                   MonitorStreamType.DIRECT    : (16, '>iiq') }
+_SNIFF_LEN = 32 + 2 # Longest stream header plus the monitor record length
+
+def _domidFilter(domids):
+    """Set of numeric DOM IDs from hex strings and/or integers, or None"""
+    if domids is None: return None
+    if isinstance(domids, (str, int, long)): domids = [domids]
+    ret = set()
+    for d in domids:
+        if isinstance(d, str): d = long(d, 16)
+        ret.add(d)
+    return ret
+
+def _sniffType(data, pos, prefer=None):
+    """
+    Stream type of the record starting at data[pos]: the one whose
+    stream record length agrees with the length of the monitor record
+    behind the header, trying prefer first.  If none agrees, fall back on
+    prefer as long as its header is sane; None if there is no candidate.
+    """
+    types = [MonitorStreamType.STRINGHUB, MonitorStreamType.PAYLOAD, MonitorStreamType.DIRECT]
+    if prefer is not None:
+        types.remove(prefer)
+        types.insert(0, prefer)
+    avail = len(data) - pos
+    for t in types:
+        hdrLen = _streamHeaders[t][0]
+        if avail < hdrLen + 2: continue
+        (recl, ) = unpack_from('>i', data, pos)
+        (moniLen, ) = unpack_from('>h', data, pos + hdrLen)
+        if recl > hdrLen and moniLen == recl - hdrLen: return t
+    if prefer is not None and avail >= 4 and \
+           unpack_from('>i', data, pos)[0] > _streamHeaders[prefer][0]:
+        return prefer
+    return None
+
+def _streamFields(type, hdr):
+    """(record length, numeric DOM ID, UT timestamp) from an unpacked stream header"""
+    if type == MonitorStreamType.PAYLOAD:
+        (recl, recid, timestamp, domid) = hdr
+    elif type == MonitorStreamType.STRINGHUB:
+        (recl, recid, domid, timestamp) = hdr
+    else:
+        (recl, recid, domid) = hdr
+        timestamp = 0L
+    return recl, domid, timestamp
+
+def _iterRawRecords(f, type, blocksize=1<<20):
+    """
+    Generator over the raw records of a monitoring stream: yields (file
+    offset, record length, numeric DOM ID, UT timestamp, buffer, start,
+    end), where buffer[start:end] is the monitor record without its stream
+    header.  The buffer is only valid until the next record is requested.
+    """
+    if type != MonitorStreamType.AUTO and type not in _streamHeaders:
+        print "Error: unknown monitor stream type",type
+        return
+    data = ""
+    pos = 0
+    base = 0 # File offset of data[0]
+    eof = False
+    last = None # Type of the previous record, for AUTO
+    while True:
+        avail = len(data) - pos
+        if type == MonitorStreamType.AUTO:
+            if avail >= _SNIFF_LEN or (eof and avail > 0):
+                t = _sniffType(data, pos, last)
+                if t is None: return # Not a monitoring record
+            else:
+                t = None
+        else:
+            t = type
+        if t is not None and avail >= _streamHeaders[t][0]:
+            hdrLen, hdrFmt = _streamHeaders[t]
+            hdr = unpack_from(hdrFmt, data, pos)
+            recl = hdr[0]
+            if avail >= recl or eof:
+                (recl, domid, timestamp) = _streamFields(t, hdr)
+                if avail < recl or recl <= hdrLen:
+                    return # Truncated or empty record
+                last = t
+                yield base + pos, recl, domid, timestamp, data, pos + hdrLen, pos + recl
+                pos += recl
+                continue
+        if eof: return
+        more = f.read(blocksize)
+        if not more:
+            eof = True
+            continue
+        base += pos
+        data = data[pos:] + more
+        pos = 0
+
+#---------------------------------------------------------------
+# Compressed streams
+
+def compressionType(filename):
+    """'gzip', 'bzip2' or None, from the first bytes of the file"""
+    f = open(filename, "rb")
+    try:
+        magic = f.read(3)
+    finally:
+        f.close()
+    if magic[:2] == "\x1f\x8b": return "gzip"
+    if magic == "BZh": return "bzip2"
+    return None
+
+class DecompressingReader:
+    """
+    Minimal read-only file object over a gzip or bzip2 file, decompressing
+    blocksize bytes of input at a time.  Concatenated archives (several
+    gzip members or bzip2 streams back to back) are read through.
+    """
+    def __init__(self, f, compression, blocksize=1<<20):
+        self.f = f
+        self.compression = compression
+        self.blocksize = blocksize
+        self.buf = ""
+        self.eof = False
+        self.d = self._decompressor()
+
+    def _decompressor(self):
+        if self.compression == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return bz2.BZ2Decompressor()
+
+    def _feed(self, raw):
+        out = []
+        while raw:
+            try:
+                out.append(self.d.decompress(raw))
+            except EOFError:
+                # bzip2 stream already finished: raw starts the next one
+                self.d = self._decompressor()
+                continue
+            raw = self.d.unused_data
+            if raw: self.d = self._decompressor()
+        self.buf += "".join(out)
+
+    def read(self, n=-1):
+        while (n < 0 or len(self.buf) < n) and not self.eof:
+            raw = self.f.read(self.blocksize)
+            if not raw:
+                self.eof = True
+                break
+            self._feed(raw)
+        if n < 0: n = len(self.buf)
+        ret = self.buf[:n]
+        self.buf = self.buf[n:]
+        return ret
+
+    def close(self):
+        self.f.close()
+
+def openMoniStream(filename, blocksize=1<<20):
+    """
+    Open a monitoring stream file for reading, decompressing gzip and
+    bzip2 files on the fly
+    """
+    compression = compressionType(filename)
+    f = open(filename, "rb")
+    if compression is None: return f
+    return DecompressingReader(f, compression, blocksize)
+
+def iterMoniStream(f, type=MonitorStreamType.STRINGHUB, domids=None,
+                   moniTypes=None, since=None, until=None, blocksize=1<<20,
+                   useIndex=True):
     """
-    (STRINGHUB, PAYLOAD, DIRECT) = (0, 1, 2)
+    Generator over the monitor records in file f, in file order.  The file
+    is read in blocks of blocksize bytes, so memory use does not grow with
+    the file.  If domids (hex strings or integers), moniTypes (record type
+    codes, e.g. 0xCB) or a UT timestamp range since <= t < until are given,
+    records not matching them are skipped on the raw headers, before any
+    record object is built.  If f is a named file with an up-to-date index
+    (see buildMoniIndex()), only the matching records are read from it.
+    f may also be a file name, which is opened with openMoniStream() (so
+    gzip and bzip2 files are decompressed on the fly).
+    """
+    for domid, timestamp, rec in _iterMoniBuffers(f, type, domids, moniTypes, since, until,
+                                                  blocksize, useIndex):
+        yield MonitorRecordFactory(rec, "%12.12x" % (domid), timestamp)
 
-def readMoniStream(f, type=MonitorStreamType.STRINGHUB):
+def _iterMoniBuffers(f, type, domids, moniTypes, since, until, blocksize=1<<20,
+                     useIndex=True):
+    """
+    (numeric DOM ID, UT timestamp, monitor record bytes) for each record
+    selected as described for iterMoniStream()
+    """
+    if isinstance(f, str):
+        f = openMoniStream(f, blocksize)
+        try:
+            for rec in _iterMoniBuffers(f, type, domids, moniTypes, since, until,
+                                        blocksize, useIndex):
+                yield rec
+        finally:
+            f.close()
+        return
+    if useIndex and hasattr(f, 'name'):
+        idx = openMoniIndex(f.name, type)
+        if idx is not None:
+            for offset, length in idx.lookup(domids, moniTypes, since, until):
+                f.seek(offset)
+                rec = f.read(length)
+                (domid, timestamp, hdrLen) = idx.stream(rec)
+                yield domid, timestamp, rec[hdrLen:]
+            return
+    selected = _headerFilter(domids, moniTypes, since, until)
+    for offset, recl, domid, timestamp, data, start, end in _iterRawRecords(f, type, blocksize):
+        if selected(domid, timestamp, data, start):
+            yield domid, timestamp, data[start:end]
+
+def _headerFilter(domids, moniTypes, since, until):
+    """
+    Function (numeric DOM ID, UT timestamp, buffer, record start) -> True
+    if the raw record passes the iterMoniStream() filters
+    """
+    domids = _domidFilter(domids)
+    if moniTypes is not None: moniTypes = set(moniTypes)
+    def selected(domid, timestamp, data, start):
+        if domids is not None and domid not in domids: return False
+        if since is not None and timestamp < since: return False
+        if until is not None and timestamp >= until: return False
+        if moniTypes is not None and \
+               unpack_from('>h', data, start+2)[0] not in moniTypes: return False
+        return True
+    return selected
+
+def followMoniStream(filename, type=MonitorStreamType.STRINGHUB, domids=None,
+                     moniTypes=None, since=None, until=None, offset=0,
+                     poll=0.1, maxPoll=2.0, blocksize=1<<20):
+    """
+    Generator over the records of a monitoring file that is still being
+    written, like 'tail -f': after the records present now, it waits for
+    more and yields them as they appear; it never finishes by itself.
+    Reading starts at byte offset.  The generator keeps the offset of the
+    next unread record, so a partially written record at the end of the
+    file is read again, whole, once the rest of it has arrived.
+    While no new record is complete the file is only stat()ed, at
+    intervals that back off from poll to maxPoll seconds.  If the file is truncated or
+    replaced (new inode), reading restarts from its beginning.  Filters
+    are as for iterMoniStream().
+    """
+    selected = _headerFilter(domids, moniTypes, since, until)
+    f = None
+    ino = None
+    wait = poll
+    seen = None # File size when only a partial record was found
+    try:
+        while True:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                st = None # Being rotated; try again later
+            if st is not None and (st.st_ino != ino or st.st_size < offset):
+                if f is not None:
+                    f.close()
+                    offset = 0
+                f = open(filename, "rb")
+                ino = st.st_ino
+                seen = None
+            if st is None or st.st_size in (offset, seen):
+                time.sleep(wait)
+                wait = min(wait * 2, maxPoll)
+                continue
+            f.seek(offset)
+            start = offset
+            for off, recl, domid, timestamp, data, rstart, rend in \
+                    _iterRawRecords(f, type, blocksize):
+                offset = start + off + recl
+                if selected(domid, timestamp, data, rstart):
+                    yield MonitorRecordFactory(data[rstart:rend], "%12.12x" % (domid), timestamp)
+            if offset == start:
+                # Nothing complete yet (or unreadable data): wait for the
+                # file to grow, still backing off
+                seen = st.st_size
+                time.sleep(wait)
+                wait = min(wait * 2, maxPoll)
+            else:
+                seen = None
+                wait = poll
+    finally:
+        if f is not None: f.close()
+
+def readMoniStream(f, type=MonitorStreamType.STRINGHUB, domids=None, moniTypes=None,
+                   since=None, until=None):
     """
     Read monitor stream from file f.  Header encoding is specified by the
     type argument (stringhub .moni file, payload-wrapped 2ndbuild file,
-    or direct domhub output). The default is stringhub format.
+    or direct domhub output). The default is stringhub format.  Returns a
+    dictionary of record lists keyed by DOM ID; see iterMoniStream() for
+    a version that doesn't hold the whole file in memory.
     """
     xroot = { }
+    for moni in iterMoniStream(f, type, domids, moniTypes, since, until):
+        if moni.domid not in xroot: 
+            xroot[moni.domid] = [ ]
+        xroot[moni.domid].append(moni)
+    return xroot
 
-    while True:
-        if type == MonitorStreamType.STRINGHUB:
-            hdrLen = 32
-            hdr = f.read(hdrLen)
-            if len(hdr) == 0:
-                break
-            (recl, recid, domid, timestamp) = unpack('>iiq8xq', hdr)
+#---------------------------------------------------------------
+# Writing: raw getMonitorData() buffers framed with the StringHub header,
+# so the files read back with iterMoniStream()/decodemoni.py
 
-        elif type == MonitorStreamType.PAYLOAD:
-            hdrLen = 24
-            hdr = f.read(hdrLen)
-            if len(hdr) == 0:
-                break
-            (recl, recid, timestamp, domid) = unpack('>iiqq', hdr)
-            
-        elif type == MonitorStreamType.DIRECT:
-            hdrLen = 16
-            hdr = f.read(hdrLen)
-            if len(hdr) != 16:
-                break
-            (recl, recid, domid) = unpack('>iiq', hdr)
+MONI_RECORD_ID = 102 # StringHub record ID of monitoring records
+_stringHubHeader = Struct(_streamHeaders[MonitorStreamType.STRINGHUB][1])
+
+def utcTimestamp(t=None):
+    """StringHub UT time (tenths of ns since the start of the UTC year) of t or now"""
+    if t is None: t = time.time()
+    start = calendar.timegm((time.gmtime(t)[0], 1, 1, 0, 0, 0))
+    return long((t - start) * 1e6) * 10000L
+
+class MoniFileWriter:
+    """
+    Append the records of getMonitorData() buffers to StringHub-format
+    .moni files.  Framed records are queued in memory and written with
+    one write() per bufsize bytes (and on flush()/close()).  If maxBytes
+    or maxSeconds is set, a new file is started once the current one is
+    that large or old; the files are named <root>.<n><ext> after the
+    given filename and listed in self.filenames.
+    """
+    def __init__(self, filename, domid=0, maxBytes=0, maxSeconds=0, bufsize=1<<16):
+        self.filename   = filename
+        if isinstance(domid, str): domid = long(domid.strip(), 16)
+        self.domid      = domid
+        self.maxBytes   = maxBytes
+        self.maxSeconds = maxSeconds
+        self.bufsize    = bufsize
+        self.filenames  = []
+        self.nrecords   = 0
+        self.f          = None
+        self._open()
+
+    def _open(self):
+        if self.maxBytes or self.maxSeconds:
+            root, ext = os.path.splitext(self.filename)
+            name = "%s.%d%s" % (root, len(self.filenames), ext)
         else:
-            print "Error: unknown monitor stream type",type
-            break
-            
-        domid = "%12.12x" % (domid)
-        buf = f.read(recl - hdrLen)
-        if (len(buf) < (recl - hdrLen)) or (recl == hdrLen):
-            break
+            name = self.filename
+        dirname = os.path.dirname(name)
+        if dirname and not os.path.isdir(dirname): os.makedirs(dirname)
+        self.f        = open(name, "ab")
+        self.filenames.append(name)
+        self.opened   = time.time()
+        self.written  = self.f.tell()
+        self.pending  = []
+        self.npending = 0
 
-        moni = MonitorRecordFactory(buf, domid, timestamp)
+    def write(self, monidata, domid=None, timestamp=None):
+        """
+        Queue every record of a getMonitorData() buffer, all stamped with
+        UT timestamp (default: now); returns the number of records
+        """
+        if len(monidata) == 0: return 0
+        if domid is None: domid = self.domid
+        elif isinstance(domid, str): domid = long(domid.strip(), 16)
+        now = time.time()
+        if timestamp is None: timestamp = utcTimestamp(now)
+        pack = _stringHubHeader.pack
+        pending = self.pending
+        pos = n = 0
+        end = len(monidata)
+        while end - pos >= 10:
+            moniLen, = unpack_from('>h', monidata, pos)
+            if moniLen < 10 or pos + moniLen > end: break
+            pending.append(pack(32 + moniLen, MONI_RECORD_ID, domid, timestamp))
+            pending.append(monidata[pos:pos+moniLen])
+            pos += moniLen
+            n   += 1
+        self.npending += 32*n + pos
+        self.nrecords += n
+        if self.npending >= self.bufsize: self.flush()
+        if (self.maxBytes and self.written + self.npending >= self.maxBytes) or \
+           (self.maxSeconds and now - self.opened >= self.maxSeconds):
+            self.rotate()
+        return n
 
-        if domid not in xroot: 
-            xroot[domid] = [ ]
-        xroot[domid].append(moni)        
+    def flush(self):
+        if not self.pending: return
+        self.f.write("".join(self.pending))
+        self.f.flush()
+        self.written += self.npending
+        self.pending  = []
+        self.npending = 0
 
-    return xroot
+    def rotate(self):
+        """Close the current file and start the next one"""
+        self.flush()
+        if not self.written: return # Nothing in this file yet
+        self.f.close()
+        self._open()
+
+    def close(self):
+        if self.f is None: return
+        self.flush()
+        self.f.close()
+        self.f = None
+
+#---------------------------------------------------------------
+# Sidecar index: <file>.idx next to a monitoring stream file, holding one
+# row per record sorted by (DOM ID, UT timestamp, offset).  The header
+# records the stream type and the size and mtime of the file it indexes,
+# so a stale index is ignored.
+
+MONI_INDEX_MAGIC = "MONIIDX1"
+_indexHeader = Struct('<8sB7xQd')
+_indexRow    = Struct('<QHxxqQQI') # domid, moniType, UT timestamp, DOM clock, offset, length
+
+def moniIndexName(filename):
+    return filename + ".idx"
+
+def buildMoniIndex(filename, type=MonitorStreamType.STRINGHUB):
+    """
+    Scan a monitoring stream file once and write its sidecar index;
+    returns the number of records indexed.  Compressed files can't be
+    indexed, since their records can't be reached by seeking.
+    """
+    if compressionType(filename) is not None:
+        raise ValueError("%s: can't index a compressed file" % filename)
+    rows = []
+    f = open(filename, "rb")
+    try:
+        st = os.fstat(f.fileno())
+        for offset, recl, domid, timestamp, data, start, end in _iterRawRecords(f, type):
+            (moniLen, moniType, hi, lo) = _moniHeader.unpack_from(data, start)
+            rows.append((domid, timestamp, offset, moniType, (long(hi) << 32) | lo, recl))
+    finally:
+        f.close()
+    rows.sort()
+    tmp = moniIndexName(filename) + ".tmp"
+    out = open(tmp, "wb")
+    try:
+        out.write(_indexHeader.pack(MONI_INDEX_MAGIC, type, st.st_size, st.st_mtime))
+        out.write("".join([_indexRow.pack(domid, moniType, timestamp, clock, offset, recl)
+                           for (domid, timestamp, offset, moniType, clock, recl) in rows]))
+    finally:
+        out.close()
+    os.rename(tmp, moniIndexName(filename))
+    return len(rows)
+
+def openMoniIndex(filename, type=MonitorStreamType.STRINGHUB):
+    """MoniIndex for filename, or None if there is no up-to-date index for it"""
+    try:
+        idx = MoniIndex(moniIndexName(filename))
+        st = os.stat(filename)
+    except (IOError, OSError, ValueError):
+        return None
+    if idx.type != type or idx.size != st.st_size or idx.mtime != st.st_mtime:
+        return None
+    return idx
+
+class MoniIndex:
+    """
+    Read access to a sidecar index written by buildMoniIndex()
+    """
+    def __init__(self, idxname):
+        f = open(idxname, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < _indexHeader.size:
+                raise ValueError("%s: short index header" % idxname)
+            self.data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (magic, self.type, self.size, self.mtime) = _indexHeader.unpack_from(self.data)
+        if magic != MONI_INDEX_MAGIC:
+            raise ValueError("%s: not a monitoring index" % idxname)
+        self.nrows = (len(self.data) - _indexHeader.size) / _indexRow.size
+
+    def __len__(self):
+        return self.nrows
+
+    def row(self, i):
+        """(domid, moniType, UT timestamp, DOM clock, offset, length) of row i"""
+        return _indexRow.unpack_from(self.data, _indexHeader.size + i*_indexRow.size)
+
+    def stream(self, rec):
+        """
+        (numeric DOM ID, UT timestamp, stream header length) from the
+        stream header of a raw record
+        """
+        t = self.type
+        if t == MonitorStreamType.AUTO: t = _sniffType(rec, 0)
+        hdrLen, hdrFmt = _streamHeaders[t]
+        (recl, domid, timestamp) = _streamFields(t, unpack_from(hdrFmt, rec))
+        return domid, timestamp, hdrLen
+
+    def _search(self, domid, timestamp):
+        """First row with (domid, timestamp) >= the given key"""
+        lo, hi = 0, self.nrows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            r = self.row(mid)
+            if (r[0], r[2]) < (domid, timestamp): lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def lookup(self, domids=None, moniTypes=None, since=None, until=None):
+        """
+        (offset, length) of the matching records, in file order
+        """
+        if since is None: since = -1L<<63
+        if until is None: until = (1L<<63) - 1
+        domids = _domidFilter(domids)
+        if domids is None:
+            ranges = [(0, self.nrows)]
+        else:
+            ranges = [(self._search(d, since), self._search(d, until)) for d in domids]
+        if moniTypes is not None: moniTypes = set(moniTypes)
+        ret = []
+        for first, last in ranges:
+            for i in xrange(first, last):
+                (domid, moniType, timestamp, clock, offset, length) = self.row(i)
+                if timestamp < since or timestamp >= until: continue
+                if moniTypes is not None and moniType not in moniTypes: continue
+                ret.append((offset, length))
+        ret.sort()
+        return ret
+
+#---------------------------------------------------------------
+# Batch decoding of hardware (0xC8) records into columns
+
+_HW_BODY = 'Bx27hii'
+_HW_BODY_LEN = _hwBody.size
+_HW_CHUNK = 1024 # Records per unpack() call
+
+class HardwareMonitorColumns:
+    """
+    All hardware monitor records of a stream as one column per field:
+    domid and timestamp/domClock lists, array('h') or array('i') for each
+    of HW_FIELDS, and array('d') columns in physical units: temperature
+    (deg C), pressure (kPa), hvSet and hvMonitor (V).  Records are unpacked
+    _HW_CHUNK at a time with a single repeated-format unpack(), and the
+    columns are cut from the result with extended slices.
+    """
+    def __init__(self):
+        self.domid     = []
+        self.timestamp = []
+        self.domClock  = []
+        for name in HW_FIELDS:
+            if name in ('speRate', 'mpeRate'):
+                setattr(self, name, array('i'))
+            elif name == 'version':
+                setattr(self, name, array('B'))
+            else:
+                setattr(self, name, array('h'))
+        self._pending = []
+        self.convert()
+
+    def __len__(self):
+        return len(self.domid)
+
+    def add(self, domid, timestamp, rec):
+        """Queue one raw hardware record (with its 10-byte monitor header)"""
+        if len(rec) < 10 + _HW_BODY_LEN: return
+        self.domid.append(domid)
+        self.timestamp.append(timestamp)
+        (hi, lo) = unpack_from('>HI', rec, 4)
+        self.domClock.append((long(hi) << 32) | lo)
+        self._pending.append(rec[10:10+_HW_BODY_LEN])
+        if len(self._pending) >= _HW_CHUNK: self._unpack()
+
+    def _unpack(self):
+        n = len(self._pending)
+        if n == 0: return
+        vals = unpack('>' + _HW_BODY*n, "".join(self._pending))
+        nf = len(HW_FIELDS)
+        for i, name in enumerate(HW_FIELDS):
+            getattr(self, name).extend(vals[i::nf])
+        self._pending = []
+
+    def convert(self):
+        """Finish unpacking and (re)compute the physical-unit columns"""
+        self._unpack()
+        self.temperature = array('d', map((1/256.).__mul__, self.temperatureADC))
+        self.hvSet       = array('d', map(0.5.__mul__, self.hvSetDAC))
+        self.hvMonitor   = array('d', map(0.5.__mul__, self.hvReadbackADC))
+        self.pressure    = array('d', map(_pressure, self.pressureADC, self.adc5v))
+        return self
+
+    def select(self, domid):
+        """Row indices belonging to one DOM (hex string)"""
+        return [i for i, d in enumerate(self.domid) if d == domid]
+
+def readHardwareColumns(f, type=MonitorStreamType.STRINGHUB, domids=None,
+                        since=None, until=None):
+    """
+    Decode every hardware monitoring record in stream file f (optionally
+    only some DOMs / a UT time range) into a HardwareMonitorColumns,
+    without building a record object per record
+    """
+    cols = HardwareMonitorColumns()
+    for domid, timestamp, rec in _iterMoniBuffers(f, type, domids, [0xC8], since, until):
+        cols.add("%12.12x" % (domid), timestamp, rec)
+    return cols.convert()
+
+#---------------------------------------------------------------
+
+def benchmark(f=None, type=MonitorStreamType.STRINGHUB, n=100000):
+    """
+    Time record construction plus a few field reads; f is a stream file,
+    or None to decode n synthetic hardware/ASCII records.  Returns records
+    per second.
+    """
+    from time import time
+    if f is None:
+        hw  = pack('>hhHI', 74, 0xC8, 0x12, 0x345678) + _hwBody.pack(*([1] + [256]*27 + [100, 5]))
+        txt = pack('>hhHI', 24, 0xCB, 0x12, 0x345679) + "F 123 456 789 0"
+        bufs = [hw, txt] * (n/2)
+    else:
+        bufs = [rec for domid, timestamp, rec in
+                _iterMoniBuffers(f, type, None, None, None, None, useIndex=False)]
+    t0 = time()
+    for buf in bufs:
+        m = MonitorRecordFactory(buf)
+        if m.moniType == 0xC8:
+            m.getTemperature(); m.getHVMonitor(); m.getSPERate(); m.getMPERate()
+        elif m.moniType == 0xCB:
+            m.getMessage()
+    dt = time() - t0
+    if dt <= 0: return 0.
+    return len(bufs) / dt
+
+def benchmarkASCII(f=None, type=MonitorStreamType.STRINGHUB, n=100000):
+    """
+    Time parseASCIIMessage() over the ASCII records of stream file f (or n
+    synthetic messages in the mix of a fast-moni run) against searching
+    each message with every pattern, uncompiled, and converting the groups
+    of the matches, as the domapptest tests used to.  Returns (parsed
+    messages/s, messages/s the old way).
+    """
+    from time import time
+    if f is None:
+        hist = " ".join(["%d" % (i % 7) for i in range(64)])
+        texts = ["F 1234 56 789 1000"] * 16 + \
+                ["ATWD CS A 0--100 entries: " + hist, "FADC CS--100 entries: " + hist,
+                 "PED-ATWD B CH 1--100 trials, bias 850",
+                 "LBM OVER pointer=0x00100000 lbmp=0x00000000",
+                 "set_HAL_lc_mode(LCmode=1, LCtype=1)",
+                 "Some other domapp log message"]
+        texts = (texts * (n / len(texts) + 1))[:n]
+    else:
+        texts = [rec[10:] for domid, timestamp, rec in
+                 _iterMoniBuffers(f, type, None, [0xCB], None, None, useIndex=False)]
+    if not texts: return 0., 0.
+    t0 = time()
+    for text in texts:
+        parseASCIIMessage(text)
+    t1 = time()
+    patterns = [(parser[2].pattern, parser[3]) for parser in _asciiParsers]
+    for text in texts:
+        for pattern, convert in patterns:
+            m = re.search(pattern, text)
+            if m: convert(m.groups())
+    t2 = time()
+    return len(texts) / max(t1 - t0, 1e-9), len(texts) / max(t2 - t1, 1e-9)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        f = open(sys.argv[1], "rb")
+        print "%.0f records/s" % benchmark(f, MonitorStreamType.AUTO)
+        f.seek(0)
+        print "ASCII messages: %.0f parsed/s, %.0f/s with per-pattern search" % \
+              benchmarkASCII(f, MonitorStreamType.AUTO)
+        f.close()
+    else:
+        print "%.0f records/s" % benchmark()
+        print "ASCII messages: %.0f parsed/s, %.0f/s with per-pattern search" % benchmarkASCII()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+waveform.py
+
+Pulse analysis for batches of ATWD/FADC waveforms, e.g. the hit.atwd[3]
+arrays of a whole EngHitBuf.  A batch is any sequence of sample sequences
+(lists or array('H')).  Threshold comparisons are done per waveform with
+map() over a bound float comparison, which yields a list of flags at C
+speed; crossings and times over threshold then come from list.index()
+and sum() instead of a Python loop over every sample.
+
+Polarity: negative=True (the default) means the pulse goes *below* the
+baseline, as the flasher current on ATWD3 does.
+"""
+
+from operator import add
+
+
+def _flags(wf, threshold, negative):
+    """Per-sample flags: sample is beyond threshold in the pulse direction"""
+    if negative:
+        return map(float(threshold).__gt__, wf)
+    return map(float(threshold).__lt__, wf)
+
+
+def _first(flags, start=0):
+    try:
+        return flags.index(True, start)
+    except ValueError:
+        return None
+
+
+def _last(flags, start=0):
+    n = len(flags)
+    flags = flags[start:]
+    flags.reverse()
+    try:
+        return n - 1 - flags.index(True)
+    except ValueError:
+        return None
+
+
+def baselines(wfs, nsamples=8):
+    """
+    Mean of the first nsamples of each waveform
+    >>> baselines([[10, 12, 0, 0], [4, 4, 4, 4]], 2)
+    [11.0, 4.0]
+    """
+    ret = []
+    for wf in wfs:
+        head = wf[:nsamples]
+        ret.append(len(head) and sum(head) / float(len(head)) or 0.)
+    return ret
+
+
+def minima(wfs):
+    """
+    >>> minima([[3, 1, 2], [7, 9]])
+    [1, 7]
+    """
+    return map(min, wfs)
+
+
+def maxima(wfs):
+    """
+    >>> maxima([[3, 1, 2], [7, 9]])
+    [3, 9]
+    """
+    return map(max, wfs)
+
+
+def firstCrossings(wfs, threshold, negative=True):
+    """
+    Index of the first sample beyond threshold (None if never crossed)
+    >>> firstCrossings([[800, 600, 400, 300], [800, 800]], 500)
+    [2, None]
+    """
+    return [_first(_flags(wf, threshold, negative)) for wf in wfs]
+
+
+def pulseWindows(wfs, bot, top):
+    """
+    For negative pulses: (start, end) where start is the first sample
+    below bot and end is the last sample after start above top; either
+    may be None
+    >>> pulseWindows([[800, 400, 300, 800, 900, 600], [800, 400, 450], [800]], 500, 750)
+    [(1, 4), (1, None), (None, None)]
+    """
+    ret = []
+    for wf in wfs:
+        start = _first(_flags(wf, bot, True))
+        end = None
+        if start is not None:
+            end = _last(_flags(wf, top, False), start+1)
+        ret.append((start, end))
+    return ret
+
+
+def timeOverThreshold(wfs, threshold, negative=True):
+    """
+    Number of samples beyond threshold in each waveform
+    >>> timeOverThreshold([[800, 400, 300, 800], [100, 900]], 500)
+    [2, 1]
+    """
+    return [sum(_flags(wf, threshold, negative)) for wf in wfs]
+
+
+def leadingEdges(wfs, threshold, negative=True):
+    """
+    Time (in fractional samples) of the first threshold crossing, linearly
+    interpolated between the two samples around it; None if never crossed
+    >>> leadingEdges([[800, 600, 400, 300], [400, 800], [800]], 500)
+    [1.5, 0.0, None]
+    """
+    ret = []
+    for wf in wfs:
+        i = _first(_flags(wf, threshold, negative))
+        if i is None:
+            ret.append(None)
+        elif i == 0:
+            ret.append(0.)
+        else:
+            s0, s1 = float(wf[i-1]), float(wf[i])
+            ret.append(i - 1 + (s0 - threshold) / (s0 - s1))
+    return ret
+
+
+def charges(wfs, bases, negative=True):
+    """
+    Integrated pulse area relative to baseline, in ADC counts * samples;
+    positive for pulses in the selected polarity
+    >>> charges([[10, 10, 4, 6], [10, 12]], [10., 10.])
+    [10.0, -2.0]
+    """
+    ret = []
+    for wf, base in zip(wfs, bases):
+        q = sum(wf) - base * len(wf)
+        ret.append(negative and -q or q)
+    return ret
+
+
+def accumulate(sums, wf):
+    """
+    Per-sample sum of a waveform into sums, returning the new sums
+    >>> accumulate([0, 1, 2], [5, 5, 5])
+    [5, 6, 7]
+    """
+    return map(add, sums, wf)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()